@@ -4,16 +4,50 @@ import os
 import re
 import pytz
 import pdfplumber
+import numpy as np
 import pandas as pd
-from io import BytesIO
-from flask import Flask, jsonify, request, render_template, send_file, session, redirect, url_for, flash
+from io import BytesIO, StringIO
+from flask import Flask, jsonify, request, render_template, send_file, session, redirect, url_for, flash, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
-from sqlalchemy import func, cast, Date
+from datetime import date, datetime, timedelta
+from sqlalchemy import func, cast, Date, select, insert, update, delete, union_all, case, and_, literal, event, text, inspect, bindparam, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import object_session
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+import click
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import sqlite3
+import tempfile
+import threading
+import time
 import traceback
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+from concurrent.futures.process import BrokenProcessPool
+from extracao_pdf import extrair_paginas_pdf, gerar_paginas_pdf
+from defusedxml import ElementTree as ET # os XMLs vêm de uploads: recusa DTDs e entidades
 from werkzeug.security import generate_password_hash, check_password_hash
 import unicodedata
-from itertools import groupby 
+try:
+    # Opcional: só a exportação em Parquet precisa do pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 
 # --- FUNÇÃO HELPER PARA NORMALIZAR TEXTO ---
@@ -34,8 +68,68 @@ app = Flask(__name__, template_folder='templates', static_folder='static')
 # --- NOVA CONFIGURAÇÃO DE CHAVE SECRETA ---
 
 app.config['SECRET_KEY'] = '4765063-Funeral-##' 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'insumos.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'insumos.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Lê o consumo por período da tabela ConsumoDiario (False = sempre das movimentações brutas)
+app.config['USAR_CONSUMO_DIARIO'] = True
+# Cache de respostas dos dashboards: LRU em memória e, opcionalmente, um diretório
+# partilhado entre os workers do Gunicorn (CACHE_RESPOSTAS_DIR)
+app.config['CACHE_RESPOSTAS_MAX_ITENS'] = 256
+app.config['CACHE_RESPOSTAS_TTL'] = 300 # segundos; limita a deriva das janelas baseadas em "agora"
+app.config['CACHE_RESPOSTAS_DIR'] = os.environ.get('CACHE_RESPOSTAS_DIR')
+app.config['CACHE_RESPOSTAS_MAX_ARQUIVOS'] = 1024
+# Preenchido na inicialização: True se o SQLite suporta FTS5 com o tokenizer trigram
+app.config['BUSCA_FTS_DISPONIVEL'] = False
+app.config['BUSCA_MAX_CANDIDATOS'] = 500 # resultados do índice ordenados por relevância no autocomplete
+# Autocomplete (Select2) respondido a partir de um snapshot do catálogo em memória, por worker.
+# A versão do catálogo na base de dados é consultada no máximo a cada CATALOGO_VERIFICAR_SEGUNDOS.
+app.config['CATALOGO_EM_MEMORIA'] = True
+app.config['CATALOGO_VERIFICAR_SEGUNDOS'] = 2.0
+# Número máximo de linhas aceites por pedido em /api/transferencias/lote
+app.config['TRANSFERENCIA_LOTE_MAX_ITENS'] = 1000
+# Concorrência entre workers: WAL deixa as leituras correr durante uma escrita e o
+# busy_timeout espera pelo lock; se ainda assim o lock falhar, a unidade de escrita
+# é repetida com backoff exponencial (com jitter) até ESCRITA_TENTATIVAS vezes.
+app.config['SQLITE_WAL'] = True
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000
+app.config['ESCRITA_TENTATIVAS'] = 5
+app.config['ESCRITA_ESPERA_INICIAL'] = 0.05 # segundos
+# Extração de PDFs de notas fiscais: fila persistida no SQLite e processada em segundo
+# plano por um pool de processos (páginas em paralelo). False = extração dentro do pedido.
+app.config['PDF_TAREFAS_ASSINCRONAS'] = True
+app.config['PDF_PROCESSOS'] = min(4, os.cpu_count() or 1)
+app.config['PDF_TAREFAS_INTERVALO_SEGUNDOS'] = 2.0 # consulta à fila quando não há avisos locais
+app.config['PDF_TAREFAS_TIMEOUT_SEGUNDOS'] = 600 # tarefas "PROCESSANDO" há mais tempo voltam à fila
+app.config['PDF_TAREFAS_MAX_TENTATIVAS'] = 3
+# Cache em disco da extração bruta dos PDFs (texto, tabelas, CNPJs e número do documento),
+# indexado pelo SHA-256 do ficheiro; os mais antigos são apagados acima de PDF_CACHE_MAX_BYTES
+app.config['PDF_CACHE_DIR'] = os.environ.get('PDF_CACHE_DIR', os.path.join(app.instance_path, 'cache_pdf'))
+app.config['PDF_CACHE_MAX_BYTES'] = 200 * 1024 * 1024
+# Leitura das páginas em fluxo: o texto (CNPJ e número do documento) só é lido nas primeiras
+# PDF_PAGINAS_CABECALHO páginas e a leitura pára na tabela de itens ou em PDF_MAX_PAGINAS
+app.config['PDF_PAGINAS_CABECALHO'] = 2
+app.config['PDF_MAX_PAGINAS'] = 50
+# Correspondência aproximada das descrições das notas com o catálogo: todas as palavras têm
+# de ter par (igual ou abreviação) e o coeficiente de Dice das palavras iguais tem de chegar
+# a este valor; abaixo dele é cadastrado um insumo novo
+app.config['PDF_SIMILARIDADE_MINIMA'] = 0.5
+# Importação do XML da NF-e; um ZIP pode trazer até este número de notas
+app.config['NFE_ZIP_MAX_ARQUIVOS'] = 1000
+# Exportações (?format=xlsx|csv|parquet): linhas por bloco enviado no CSV e por row group no Parquet
+app.config['EXPORTACAO_CSV_LINHAS_POR_BLOCO'] = 2000
+app.config['EXPORTACAO_PARQUET_LINHAS_POR_GRUPO'] = 50000
+# Relatórios gerados em segundo plano (/api/relatorios/<tipo>): os ficheiros são reaproveitados
+# enquanto os dados não mudarem e apagados por idade e pelo tamanho total do diretório
+app.config['RELATORIOS_DIR'] = os.environ.get('RELATORIOS_DIR', os.path.join(app.instance_path, 'relatorios'))
+app.config['RELATORIOS_MAX_BYTES'] = 500 * 1024 * 1024
+app.config['RELATORIOS_MAX_IDADE_SEGUNDOS'] = 2 * 24 * 3600
+app.config['RELATORIOS_INTERVALO_SEGUNDOS'] = 2.0 # consulta à fila quando não há avisos locais
+app.config['RELATORIOS_TIMEOUT_SEGUNDOS'] = 1800 # tarefas "PROCESSANDO" há mais tempo voltam à fila
+app.config['RELATORIOS_MAX_TENTATIVAS'] = 3
+# Histórico de ajustes de inventário: linhas por página da API (?limit=) e por bloco lido na exportação
+app.config['HISTORICO_INVENTARIO_LIMITE_PADRAO'] = 100
+app.config['HISTORICO_INVENTARIO_LIMITE_MAXIMO'] = 500
+app.config['HISTORICO_INVENTARIO_LINHAS_POR_BLOCO'] = 1000
 db = SQLAlchemy(app)
 # --- MODELOS (Estrutura do Banco de Dados REVISADA) ---
 
@@ -105,6 +199,10 @@ class Insumo(db.Model):
         }
 
 class Estoque(db.Model):
+    __table_args__ = (
+        # Uma linha por (insumo, posição): alvo dos upserts de entrada de estoque
+        db.Index('uq_estoque_insumo_posicao', 'insumo_id', 'posicao', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     insumo_id = db.Column(db.Integer, db.ForeignKey('insumo.id'), nullable=False)
     posicao = db.Column(db.String(100), nullable=False, index=True)
@@ -112,6 +210,19 @@ class Estoque(db.Model):
     
     insumo = db.relationship('Insumo', back_populates='posicoes_estoque')
 
+class PlanilhaSincronizada(db.Model):
+    # SHA-256 da última versão de cada planilha do ERP aplicada à base ('skus', 'estoque')
+    nome = db.Column(db.String(50), primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    sincronizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class SaldoInsumo(db.Model):
+    # Saldo consolidado por insumo (soma de todas as posições de Estoque).
+    # Mantido na mesma transação das rotas que alteram o estoque. Guarda só a
+    # quantidade: o valor é calculado nas leituras com o valor_unitario atual.
+    insumo_id = db.Column(db.Integer, db.ForeignKey('insumo.id'), primary_key=True)
+    quantidade_total = db.Column(db.Float, nullable=False, default=0)
+
 class Movimentacao(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     insumo_id = db.Column(db.Integer, db.ForeignKey('insumo.id'), nullable=False)
@@ -127,6 +238,23 @@ class Movimentacao(db.Model):
     insumo = db.relationship('Insumo', back_populates='movimentacoes')
     setor = db.relationship('Setor', back_populates='movimentacoes')
 
+    __table_args__ = (
+        db.Index('ix_movimentacao_tipo_data_hora', 'tipo', 'data_hora'),
+        db.Index('ix_movimentacao_setor_tipo_data_hora', 'setor_id', 'tipo', 'data_hora'),
+    )
+
+class ConsumoDiario(db.Model):
+    # Consolidação das SAIDAs por dia (UTC), insumo e setor.
+    # Gravada junto com cada SAIDA em transferir_insumo. Guarda só quantidades: os
+    # valores são calculados nas leituras com o valor_unitario atual do insumo.
+    id = db.Column(db.Integer, primary_key=True)
+    dia = db.Column(db.Date, nullable=False, index=True)
+    insumo_id = db.Column(db.Integer, db.ForeignKey('insumo.id'), nullable=False)
+    setor_id = db.Column(db.Integer, db.ForeignKey('setor.id'), nullable=True, index=True)
+    quantidade = db.Column(db.Float, nullable=False, default=0)
+
+    __table_args__ = (db.UniqueConstraint('dia', 'insumo_id', 'setor_id'),)
+
 class Setor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), unique=True, nullable=False)
@@ -174,9 +302,49 @@ class ItemRecebido(db.Model):
 
 
 
+class TarefaExtracaoPdf(db.Model):
+    # Fila persistente das extrações de PDF (sobrevive a reinícios dos workers).
+    # status: PENDENTE -> PROCESSANDO -> CONCLUIDA | ERRO
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    status = db.Column(db.String(20), nullable=False, default='PENDENTE', index=True)
+    nome_arquivo = db.Column(db.String(255))
+    conteudo = db.Column(db.LargeBinary) # apagado quando a tarefa termina
+    resultado = db.Column(db.Text) # JSON com a mesma estrutura da resposta síncrona
+    erro = db.Column(db.Text)
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    usuario = db.Column(db.String(80))
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class TarefaRelatorio(db.Model):
+    # Fila persistente dos relatórios gerados em segundo plano. O ficheiro fica em
+    # RELATORIOS_DIR/<chave>.<formato> e serve todos os pedidos com a mesma chave.
+    # status: PENDENTE -> PROCESSANDO -> CONCLUIDA | VAZIO (sem dados) | ERRO
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    chave = db.Column(db.String(64), nullable=False, index=True) # ver chave_relatorio
+    tipo = db.Column(db.String(50), nullable=False)
+    formato = db.Column(db.String(10), nullable=False)
+    parametros = db.Column(db.Text, nullable=False) # JSON com os parâmetros do pedido
+    status = db.Column(db.String(20), nullable=False, default='PENDENTE', index=True)
+    nome_download = db.Column(db.String(255))
+    erro = db.Column(db.Text)
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    usuario = db.Column(db.String(80))
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class VersaoDados(db.Model):
+    # id=1: contador global incrementado em cada transação que altera dados.
+    #       Usado para invalidar o cache de respostas em todos os workers.
+    # id=2: versão do catálogo (Insumo/Fornecedor), usada pelo autocomplete em memória.
+    id = db.Column(db.Integer, primary_key=True)
+    valor = db.Column(db.Integer, nullable=False, default=0)
+
 class AjusteInventario(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    estoque_id = db.Column(db.Integer, db.ForeignKey('estoque.id'), nullable=False)
+    estoque_id = db.Column(db.Integer, db.ForeignKey('estoque.id'), nullable=False, index=True)
     quantidade_anterior = db.Column(db.Float, nullable=False)
     quantidade_nova = db.Column(db.Float, nullable=False)
     diferenca = db.Column(db.Float, nullable=False)
@@ -185,21 +353,75 @@ class AjusteInventario(db.Model):
     observacao = db.Column(db.String(255))
 
     estoque = db.relationship('Estoque')
+
+    __table_args__ = (
+        # Ordem e cursor da paginação do histórico: (data_ajuste, id) decrescente
+        db.Index('ix_ajuste_inventario_data_ajuste_id', 'data_ajuste', 'id'),
+    )
 # --- FUNÇÃO PARA GERAR NOVO SKU ---
+SKU_INICIAL = 30000000
+
+
+class Sequencia(db.Model):
+    # Contadores com reserva atómica de blocos; 'proximo' é o próximo valor livre
+    nome = db.Column(db.String(50), primary_key=True)
+    proximo = db.Column(db.BigInteger, nullable=False)
+
+
+def _proximo_sku_existente(skus=None):
+    """
+    Próximo SKU a seguir aos existentes: o maior SKU numérico começado por '3' (ou,
+    se não houver, o maior SKU numérico) + 1; SKU_INICIAL numa base vazia.
+    Sem 'skus', calcula sobre a tabela de insumos numa só consulta por critério.
+    """
+    if skus is None:
+        numerico = and_(Insumo.sku != '', Insumo.sku.op('NOT GLOB')('*[^0-9]*'))
+        maior_sku = func.max(cast(Insumo.sku, db.BigInteger))
+        maior = db.session.query(maior_sku).filter(numerico, Insumo.sku.like('3%')).scalar()
+        if maior is None:
+            maior = db.session.query(maior_sku).filter(numerico).scalar()
+    else:
+        numericos = [int(sku) for sku in skus if sku and sku.isdigit()]
+        maior = max((n for n in numericos if str(n).startswith('3')), default=None)
+        if maior is None:
+            maior = max(numericos, default=None)
+    return SKU_INICIAL if maior is None else maior + 1
+
+
+def sincronizar_sequencia_sku(skus=None):
+    """
+    Cria o contador de SKUs ou avança-o para lá dos SKUs existentes (ou dos 'skus'
+    indicados, ex.: os de uma planilha antes de serem gravados). Nunca recua.
+    """
+    valor = _proximo_sku_existente(skus)
+    db.session.execute(
+        sqlite_insert(Sequencia).values(nome='sku', proximo=valor)
+        .on_conflict_do_update(index_elements=['nome'], set_={'proximo': func.max(Sequencia.proximo, valor)})
+    )
+
+
+def gerar_novos_skus(quantidade):
+    """
+    Reserva um bloco de 'quantidade' SKUs sequenciais com um único UPDATE ... RETURNING
+    no contador, atómico entre workers (o bloco volta ao contador se a transação
+    for desfeita). Números já usados por SKUs digitados à mão são saltados.
+    """
+    skus = []
+    while len(skus) < quantidade:
+        falta = quantidade - len(skus)
+        fim = db.session.execute(
+            update(Sequencia).where(Sequencia.nome == 'sku')
+            .values(proximo=Sequencia.proximo + falta).returning(Sequencia.proximo)
+        ).scalar_one()
+        bloco = [str(numero) for numero in range(fim - falta, fim)]
+        ocupados = {sku for (sku,) in db.session.query(Insumo.sku).filter(Insumo.sku.in_(bloco))}
+        skus.extend(sku for sku in bloco if sku not in ocupados)
+    return skus
+
+
 def gerar_novo_sku():
     # Esta função gera um novo SKU sequencial caso um insumo não tenha um código definido.
-    ultimo_insumo_num = Insumo.query.filter(Insumo.sku.like('3%')).order_by(Insumo.sku.desc()).first()
-    if ultimo_insumo_num and ultimo_insumo_num.sku.isdigit():
-        novo_numero = int(ultimo_insumo_num.sku) + 1
-    else:
-        # Fallback para caso o último SKU não seja um número puro
-        # ou não existam SKUs começando com '3'.
-        all_skus = [int(i.sku) for i in Insumo.query.all() if i.sku and i.sku.isdigit()]
-        if all_skus:
-            novo_numero = max(all_skus) + 1
-        else:
-            novo_numero = 30000000 # Valor inicial
-    return str(novo_numero)
+    return gerar_novos_skus(1)[0]
 
 
 # app.py -> Adicionar estas duas classes junto com os outros modelos
@@ -207,13 +429,13 @@ def gerar_novo_sku():
 class OrdemDeCompra(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     numero_ordem = db.Column(db.String(50), unique=True, nullable=False)
-    data_compra = db.Column(db.Date, nullable=False, default=datetime.utcnow)
+    data_compra = db.Column(db.Date, nullable=False, default=datetime.utcnow, index=True)
     data_entrega_prevista = db.Column(db.Date)
     tipo_compra = db.Column(db.String(50))
     metodo_pagamento = db.Column(db.String(50))
     departamento_solicitante = db.Column(db.String(100))
     
-    fornecedor_id = db.Column(db.Integer, db.ForeignKey('fornecedor.id'), nullable=False)
+    fornecedor_id = db.Column(db.Integer, db.ForeignKey('fornecedor.id'), nullable=False, index=True)
     fornecedor = db.relationship('Fornecedor')
     
     subtotal = db.Column(db.Float, default=0.0)
@@ -236,7 +458,7 @@ class OrdemDeCompra(db.Model):
 itens = db.relationship('ItemDaOrdem', back_populates='ordem_de_compra', cascade="all, delete-orphan")
 class ItemDaOrdem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    ordem_de_compra_id = db.Column(db.Integer, db.ForeignKey('ordem_de_compra.id'), nullable=False)
+    ordem_de_compra_id = db.Column(db.Integer, db.ForeignKey('ordem_de_compra.id'), nullable=False, index=True)
     insumo_id = db.Column(db.Integer, db.ForeignKey('insumo.id'), nullable=False)
     quantidade = db.Column(db.Float, nullable=False)
     preco_unitario = db.Column(db.Float, nullable=False)
@@ -245,120 +467,2043 @@ class ItemDaOrdem(db.Model):
     insumo = db.relationship('Insumo')
 
 
+# --- CONCORRÊNCIA NO SQLITE E MUTAÇÕES ATÓMICAS DE ESTOQUE ---
+@event.listens_for(Engine, 'connect')
+def _configurar_conexao_sqlite(conexao_dbapi, _registro):
+    if not isinstance(conexao_dbapi, sqlite3.Connection):
+        return
+    cursor = conexao_dbapi.cursor()
+    if app.config['SQLITE_WAL']:
+        cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    cursor.close()
+
+
+def _erro_de_bloqueio(erro):
+    """True para os erros de lock do SQLite ('database is locked' / 'busy')."""
+    mensagem = str(getattr(erro, 'orig', erro)).lower()
+    return 'locked' in mensagem or 'busy' in mensagem
+
+
+def executar_escrita(unidade):
+    """
+    Corre a função 'unidade' (que devolve a resposta da rota) e faz commit se a
+    resposta for de sucesso; respostas de erro desfazem a transação. Se o SQLite
+    recusar o lock, desfaz e repete a unidade inteira com backoff exponencial e
+    jitter, para que os workers em disputa não voltem a colidir ao mesmo tempo.
+    """
+    tentativas = app.config['ESCRITA_TENTATIVAS']
+    for tentativa in range(1, tentativas + 1):
+        try:
+            resposta = make_response(unidade())
+            if resposta.status_code < 400:
+                db.session.commit()
+            else:
+                db.session.rollback()
+            return resposta
+        except OperationalError as e:
+            db.session.rollback()
+            if tentativa == tentativas or not _erro_de_bloqueio(e):
+                raise
+            time.sleep(random.uniform(0, app.config['ESCRITA_ESPERA_INICIAL'] * 2 ** (tentativa - 1)))
+
+
+def debitar_estoque(insumo_id, posicao, quantidade):
+    """
+    Retira 'quantidade' da posição com um único UPDATE condicional (só aplica se
+    houver saldo suficiente) e remove a posição se ficar vazia, a não ser que tenha
+    ajustes de inventário (o histórico liga-se a ela). Devolve False se a posição
+    não existe ou não tem a quantidade pedida. Não faz commit.
+    """
+    tabela = Estoque.__table__
+    na_posicao = and_(tabela.c.insumo_id == insumo_id, tabela.c.posicao == posicao)
+    resultado = db.session.execute(
+        update(tabela)
+        .where(na_posicao, tabela.c.quantidade >= quantidade)
+        .values(quantidade=tabela.c.quantidade - quantidade)
+    )
+    if resultado.rowcount != 1:
+        return False
+    sem_ajustes = ~select(AjusteInventario.id).where(AjusteInventario.estoque_id == tabela.c.id).exists()
+    db.session.execute(delete(tabela).where(na_posicao, tabela.c.quantidade <= 0, sem_ajustes))
+    return True
+
+
+def creditar_estoque(insumo_id, posicao, quantidade):
+    """Soma 'quantidade' à posição, criando-a se não existir (upsert). Não faz commit."""
+    creditar_estoques([{'insumo_id': insumo_id, 'posicao': posicao, 'quantidade': quantidade}])
+
+
+def creditar_estoques(entradas):
+    """
+    Versão em lote de creditar_estoque: 'entradas' é uma lista de dicionários
+    {insumo_id, posicao, quantidade}, aplicada num único executemany.
+    """
+    tabela = Estoque.__table__
+    stmt = sqlite_insert(tabela)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['insumo_id', 'posicao'],
+        set_={'quantidade': tabela.c.quantidade + stmt.excluded.quantidade}
+    ), entradas)
+
+
+def unificar_posicoes_duplicadas():
+    """
+    Funde as linhas de Estoque repetidas para o mesmo (insumo, posição), somando as
+    quantidades na de menor id. Necessário antes de criar o índice único em bases antigas.
+    """
+    duplicadas = db.session.query(
+        Estoque.insumo_id, Estoque.posicao, func.min(Estoque.id), func.sum(Estoque.quantidade)
+    ).group_by(Estoque.insumo_id, Estoque.posicao).having(func.count(Estoque.id) > 1).all()
+    for insumo_id, posicao, id_mantido, total in duplicadas:
+        ids_removidos = [
+            estoque_id for (estoque_id,) in db.session.query(Estoque.id).filter(
+                Estoque.insumo_id == insumo_id, Estoque.posicao == posicao, Estoque.id != id_mantido
+            )
+        ]
+        db.session.query(AjusteInventario).filter(AjusteInventario.estoque_id.in_(ids_removidos))\
+            .update({'estoque_id': id_mantido}, synchronize_session=False)
+        db.session.query(Estoque).filter(Estoque.id.in_(ids_removidos)).delete(synchronize_session=False)
+        db.session.query(Estoque).filter(Estoque.id == id_mantido).update({'quantidade': total}, synchronize_session=False)
+    db.session.commit()
+    return len(duplicadas)
+
+
+# --- FUNÇÕES DE SALDO CONSOLIDADO ---
+def atualizar_saldo_insumo(insumo, delta_quantidade):
+    """
+    Aplica uma variação de quantidade ao saldo consolidado do insumo, num único
+    upsert (seguro entre workers). Não faz commit: deve correr na transação da rota.
+    """
+    atualizar_saldos_insumos([(insumo.id, delta_quantidade)])
+
+
+def atualizar_saldos_insumos(variacoes):
+    """
+    Versão em lote de atualizar_saldo_insumo: 'variacoes' é uma lista de
+    (insumo_id, delta_quantidade), aplicada num único executemany.
+    """
+    tabela = SaldoInsumo.__table__
+    stmt = sqlite_insert(tabela)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['insumo_id'],
+        set_={'quantidade_total': tabela.c.quantidade_total + stmt.excluded.quantidade_total}
+    ), [{'insumo_id': insumo_id, 'quantidade_total': delta} for insumo_id, delta in variacoes])
+
+
+def recalcular_saldos():
+    """Reconstrói toda a tabela de saldos a partir das posições de Estoque."""
+    db.session.query(SaldoInsumo).delete()
+    linhas = db.session.query(Estoque.insumo_id, func.sum(Estoque.quantidade)).group_by(Estoque.insumo_id).all()
+    db.session.add_all([
+        SaldoInsumo(insumo_id=insumo_id, quantidade_total=qtd or 0)
+        for insumo_id, qtd in linhas
+    ])
+    db.session.commit()
+    return len(linhas)
+
+
+def recalcular_saldos_insumos(insumo_ids, tamanho_bloco=5000):
+    """Reconstrói só os saldos dos insumos indicados (após alterações em massa ao Estoque). Não faz commit."""
+    saldo, estoque = SaldoInsumo.__table__, Estoque.__table__
+    ids = list(insumo_ids)
+    for i in range(0, len(ids), tamanho_bloco):
+        bloco = ids[i:i + tamanho_bloco]
+        db.session.execute(delete(saldo).where(saldo.c.insumo_id.in_(bloco)))
+        db.session.execute(insert(saldo).from_select(
+            ['insumo_id', 'quantidade_total'],
+            select(estoque.c.insumo_id, func.sum(estoque.c.quantidade))
+            .where(estoque.c.insumo_id.in_(bloco)).group_by(estoque.c.insumo_id)
+        ))
+
+
+def valor_total_estoque():
+    """Valor de todo o estoque: saldos consolidados ao valor unitário atual de cada insumo."""
+    return db.session.query(
+        func.sum(SaldoInsumo.quantidade_total * func.coalesce(Insumo.valor_unitario, 0))
+    ).join(Insumo, Insumo.id == SaldoInsumo.insumo_id).scalar() or 0
+
+
+def verificar_saldos(tolerancia=1e-6):
+    """
+    Compara a tabela de saldos com a soma das posições de Estoque.
+    Retorna uma lista com os insumos divergentes.
+    """
+    estoque_sq = db.session.query(
+        Estoque.insumo_id.label('insumo_id'),
+        func.sum(Estoque.quantidade).label('total')
+    ).group_by(Estoque.insumo_id).subquery()
+
+    linhas = db.session.query(
+        Insumo.id,
+        Insumo.sku,
+        func.coalesce(estoque_sq.c.total, 0),
+        func.coalesce(SaldoInsumo.quantidade_total, 0)
+    ).outerjoin(estoque_sq, estoque_sq.c.insumo_id == Insumo.id)\
+     .outerjoin(SaldoInsumo, SaldoInsumo.insumo_id == Insumo.id).all()
+
+    divergencias = []
+    for insumo_id, sku, qtd_estoque, qtd_saldo in linhas:
+        if abs(qtd_estoque - qtd_saldo) > tolerancia:
+            divergencias.append({'insumo_id': insumo_id, 'sku': sku, 'estoque': qtd_estoque, 'saldo': qtd_saldo})
+    return divergencias
+
+
+@app.cli.command('recalcular-saldos')
+@click.option('--verificar', is_flag=True, help='Apenas compara os saldos com o Estoque, sem alterar nada.')
+def recalcular_saldos_command(verificar):
+    """Reconstrói (ou verifica) a tabela de saldos consolidados por insumo."""
+    if verificar:
+        divergencias = verificar_saldos()
+        for d in divergencias:
+            click.echo(f"SKU {d['sku']}: estoque={d['estoque']} saldo={d['saldo']}")
+        click.echo(f'{len(divergencias)} insumo(s) com saldo divergente.')
+        return
+    total = recalcular_saldos()
+    click.echo(f'{total} saldo(s) recalculado(s) a partir do Estoque.')
+
+
+# --- CONSOLIDAÇÃO DIÁRIA DE CONSUMO ---
+def registrar_consumo_diario(movimentacao, insumo):
+    """Soma uma movimentação de SAIDA à linha (dia, insumo, setor) com um upsert. Não faz commit."""
+    tabela = ConsumoDiario.__table__
+    stmt = sqlite_insert(tabela).values(
+        dia=movimentacao.data_hora.date(),
+        insumo_id=insumo.id,
+        setor_id=movimentacao.setor_id,
+        quantidade=movimentacao.quantidade
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['dia', 'insumo_id', 'setor_id'],
+        set_={'quantidade': tabela.c.quantidade + stmt.excluded.quantidade}
+    ))
+
+
+def consolidar_consumo_diario():
+    """Reconstrói a tabela ConsumoDiario a partir de todo o histórico de SAIDAs."""
+    dia = func.date(Movimentacao.data_hora)
+    agrupado = select(
+        dia,
+        Movimentacao.insumo_id,
+        Movimentacao.setor_id,
+        func.sum(Movimentacao.quantidade)
+    ).where(Movimentacao.tipo == 'SAIDA')\
+     .group_by(dia, Movimentacao.insumo_id, Movimentacao.setor_id)
+
+    db.session.query(ConsumoDiario).delete()
+    db.session.execute(insert(ConsumoDiario).from_select(
+        ['dia', 'insumo_id', 'setor_id', 'quantidade'], agrupado))
+    db.session.commit()
+    return ConsumoDiario.query.count()
+
+
+def verificar_consumo_diario(tolerancia=1e-6):
+    """
+    Compara as quantidades da tabela ConsumoDiario com as SAIDAs brutas.
+    Retorna uma lista com as chaves (dia, insumo, setor) divergentes.
+    """
+    dia = func.date(Movimentacao.data_hora)
+    bruto = {
+        (str(d), insumo_id, setor_id): qtd
+        for d, insumo_id, setor_id, qtd in db.session.query(
+            dia, Movimentacao.insumo_id, Movimentacao.setor_id, func.sum(Movimentacao.quantidade)
+        ).filter(Movimentacao.tipo == 'SAIDA').group_by(dia, Movimentacao.insumo_id, Movimentacao.setor_id)
+    }
+    consolidado = {
+        (str(d), insumo_id, setor_id): qtd
+        for d, insumo_id, setor_id, qtd in db.session.query(
+            ConsumoDiario.dia, ConsumoDiario.insumo_id, ConsumoDiario.setor_id, ConsumoDiario.quantidade)
+    }
+    divergencias = []
+    for chave in sorted(set(bruto) | set(consolidado), key=str):
+        qtd_bruto, qtd_consolidado = bruto.get(chave, 0), consolidado.get(chave, 0)
+        if abs(qtd_bruto - qtd_consolidado) > tolerancia:
+            divergencias.append({'dia': chave[0], 'insumo_id': chave[1], 'setor_id': chave[2],
+                                 'movimentacoes': qtd_bruto, 'consolidado': qtd_consolidado})
+    return divergencias
+
+
+def fonte_consumo(data_limite=None):
+    """
+    Retorna uma subconsulta (dia, insumo_id, setor_id, quantidade) com as SAIDAs
+    a partir de data_limite. Os dias completos vêm de ConsumoDiario; apenas o
+    primeiro dia (parcial) da janela é lido das movimentações brutas.
+    Com USAR_CONSUMO_DIARIO desligado, lê tudo das movimentações.
+    """
+    bruto = select(
+        func.date(Movimentacao.data_hora).label('dia'),
+        Movimentacao.insumo_id.label('insumo_id'),
+        Movimentacao.setor_id.label('setor_id'),
+        Movimentacao.quantidade.label('quantidade')
+    ).where(Movimentacao.tipo == 'SAIDA')
+    if data_limite is not None:
+        bruto = bruto.where(Movimentacao.data_hora >= data_limite)
+
+    if not app.config.get('USAR_CONSUMO_DIARIO'):
+        return bruto.subquery()
+
+    consolidado = select(
+        ConsumoDiario.dia.label('dia'),
+        ConsumoDiario.insumo_id.label('insumo_id'),
+        ConsumoDiario.setor_id.label('setor_id'),
+        ConsumoDiario.quantidade.label('quantidade')
+    )
+    if data_limite is None:
+        return consolidado.subquery()
+
+    primeiro_dia_completo = data_limite.date() + timedelta(days=1)
+    bruto = bruto.where(Movimentacao.data_hora < datetime.combine(primeiro_dia_completo, datetime.min.time()))
+    consolidado = consolidado.where(ConsumoDiario.dia >= primeiro_dia_completo)
+    return union_all(bruto, consolidado).subquery()
+
+
+@app.cli.command('consolidar-consumo')
+@click.option('--verificar', is_flag=True, help='Apenas compara a consolidação com as movimentações, sem alterar nada.')
+def consolidar_consumo_command(verificar):
+    """Reconstrói (ou verifica) a tabela de consumo diário a partir do histórico."""
+    if verificar:
+        divergencias = verificar_consumo_diario()
+        for d in divergencias:
+            click.echo(f"{d['dia']} insumo={d['insumo_id']} setor={d['setor_id']}: "
+                       f"movimentacoes={d['movimentacoes']} consolidado={d['consolidado']}")
+        click.echo(f'{len(divergencias)} linha(s) de consumo divergente(s).')
+        return
+    total = consolidar_consumo_diario()
+    click.echo(f'{total} linha(s) de consumo diário consolidadas.')
+
+
+def remover_colunas_de_valor():
+    """
+    Bases com as antigas colunas de valor (NOT NULL) nos saldos e na consolidação
+    diária: as tabelas são recriadas sem elas e reconstruídas a partir do Estoque
+    e das SAIDAs (faz commit). Devolve os nomes das tabelas recriadas.
+    """
+    recriadas = []
+    for modelo, coluna, reconstruir in ((SaldoInsumo, 'valor_total', recalcular_saldos),
+                                        (ConsumoDiario, 'valor', consolidar_consumo_diario)):
+        if coluna in {c['name'] for c in inspect(db.engine).get_columns(modelo.__table__.name)}:
+            modelo.__table__.drop(bind=db.engine)
+            modelo.__table__.create(bind=db.engine)
+            reconstruir()
+            recriadas.append(modelo.__table__.name)
+    return recriadas
+
+
+# --- VERSÃO DOS DADOS E CACHE DE RESPOSTAS ---
+# Qualquer flush ou DML (insert/update/delete em massa) marca a sessão como alterada;
+# no commit, o contador de VersaoDados é incrementado na mesma transação.
+@event.listens_for(db.session, 'after_flush')
+def _marcar_dados_alterados(session, flush_context):
+    session.info['dados_alterados'] = True
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _marcar_dml_alterado(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['dados_alterados'] = True
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in (Insumo, Fornecedor):
+            orm_execute_state.session.info['catalogo_alterado'] = True
+
+
+def _marcar_catalogo_alterado(mapper, connection, alvo):
+    session = object_session(alvo)
+    if session is not None:
+        session.info['catalogo_alterado'] = True
+
+
+for _modelo in (Insumo, Fornecedor):
+    for _evento in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_modelo, _evento, _marcar_catalogo_alterado)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _incrementar_versao_dados(session):
+    # O commit só faz o flush final depois deste evento: força-o aqui para que
+    # as alterações ainda pendentes também marquem a sessão.
+    session.flush()
+    tabela = VersaoDados.__table__
+    if session.info.pop('dados_alterados', False):
+        session.connection().execute(update(tabela).where(tabela.c.id == 1).values(valor=tabela.c.valor + 1))
+    if session.info.pop('catalogo_alterado', False):
+        session.connection().execute(update(tabela).where(tabela.c.id == 2).values(valor=tabela.c.valor + 1))
+        session.info['catalogo_commit'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidar_catalogo_local(session):
+    # As escritas feitas por este worker invalidam o seu snapshot de imediato;
+    # os outros workers detetam a nova versão na próxima verificação.
+    if session.info.pop('catalogo_commit', False):
+        _catalogo['sujo'] = True
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _limpar_dados_alterados(session):
+    session.info.pop('dados_alterados', None)
+    session.info.pop('catalogo_alterado', None)
+    session.info.pop('catalogo_commit', None)
+
+
+def versao_dados(contador=1):
+    """Retorna o valor atual de um contador de versão (1 = dados, 2 = catálogo)."""
+    return db.session.query(VersaoDados.valor).filter_by(id=contador).scalar() or 0
+
+
+_cache_respostas = OrderedDict()
+_cache_respostas_lock = threading.Lock()
+
+
+def _caminho_cache_disco(chave):
+    diretorio = app.config.get('CACHE_RESPOSTAS_DIR')
+    if not diretorio:
+        return None
+    return os.path.join(diretorio, hashlib.sha256(chave.encode('utf-8')).hexdigest() + '.json')
+
+
+def _guardar_cache_memoria(chave, criado_em, corpo):
+    with _cache_respostas_lock:
+        _cache_respostas[chave] = (criado_em, corpo)
+        _cache_respostas.move_to_end(chave)
+        while len(_cache_respostas) > app.config['CACHE_RESPOSTAS_MAX_ITENS']:
+            _cache_respostas.popitem(last=False)
+
+
+def ler_cache_resposta(chave):
+    """Procura o corpo de uma resposta em memória e depois no diretório partilhado."""
+    agora = time.time()
+    ttl = app.config['CACHE_RESPOSTAS_TTL']
+    with _cache_respostas_lock:
+        item = _cache_respostas.get(chave)
+        if item and agora - item[0] <= ttl:
+            _cache_respostas.move_to_end(chave)
+            return item[1]
+
+    caminho = _caminho_cache_disco(chave)
+    if caminho:
+        try:
+            criado_em = os.path.getmtime(caminho)
+            if agora - criado_em <= ttl:
+                with open(caminho, 'rb') as f:
+                    corpo = f.read()
+                _guardar_cache_memoria(chave, criado_em, corpo)
+                return corpo
+        except OSError:
+            pass
+    return None
+
+
+def gravar_cache_resposta(chave, corpo):
+    """Guarda o corpo de uma resposta em memória e, se configurado, no diretório partilhado."""
+    _guardar_cache_memoria(chave, time.time(), corpo)
+
+    caminho = _caminho_cache_disco(chave)
+    if not caminho:
+        return
+    try:
+        diretorio = os.path.dirname(caminho)
+        os.makedirs(diretorio, exist_ok=True)
+        temporario = f'{caminho}.{os.getpid()}.tmp'
+        with open(temporario, 'wb') as f:
+            f.write(corpo)
+        os.replace(temporario, caminho) # escrita atómica entre workers
+
+        arquivos = [os.path.join(diretorio, n) for n in os.listdir(diretorio) if n.endswith('.json')]
+        excesso = len(arquivos) - app.config['CACHE_RESPOSTAS_MAX_ARQUIVOS']
+        if excesso > 0:
+            for antigo in sorted(arquivos, key=os.path.getmtime)[:excesso]:
+                os.remove(antigo)
+    except OSError:
+        traceback.print_exc()
+
+
+def cache_de_resposta(view):
+    """
+    Decorador para rotas GET que devolvem JSON. A chave combina a versão dos dados,
+    o caminho e os parâmetros da query; qualquer escrita invalida as entradas antigas.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        versao = versao_dados()
+        chave = f"{versao}|{request.path}|{urlencode(sorted(request.args.items(multi=True)))}"
+        corpo = ler_cache_resposta(chave)
+        if corpo is None:
+            resposta = make_response(view(*args, **kwargs))
+            if resposta.status_code != 200 or resposta.mimetype != 'application/json':
+                return resposta
+            corpo = resposta.get_data()
+            gravar_cache_resposta(chave, corpo)
+
+        resposta = app.response_class(corpo, mimetype='application/json')
+        resposta.headers['X-Versao-Dados'] = str(versao)
+        return resposta
+    return wrapper
+
+
+# --- ÍNDICE DE BUSCA (FTS5 TRIGRAM) ---
+# Tabelas virtuais com o texto normalizado (sem acentos, minúsculas) de insumos e
+# fornecedores. O rowid de cada linha é o id do registo original.
+INDICES_BUSCA = {
+    'insumo_busca': lambda i: normalize_text(f"{i.descricao or ''} {i.sku or ''}"),
+    'fornecedor_busca': lambda f: normalize_text(f"{f.razao_social or ''} {f.nome_fantasia or ''} {f.cnpj or ''}"),
+}
+
+
+def criar_indices_busca():
+    """Cria as tabelas FTS5. Retorna False se o SQLite não suportar FTS5/trigram."""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    try:
+        for tabela in INDICES_BUSCA:
+            db.session.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {tabela} USING fts5(texto, tokenize='trigram')"))
+        db.session.commit()
+        return True
+    except OperationalError:
+        db.session.rollback()
+        print(">>> AVISO: FTS5 (trigram) indisponível neste SQLite. A busca usará ILIKE.")
+        return False
+
+
+def reconstruir_indice_busca(tabela):
+    """Reconstrói um índice de busca a partir da tabela de origem. Não faz commit."""
+    modelo = Insumo if tabela == 'insumo_busca' else Fornecedor
+    db.session.execute(text(f"DELETE FROM {tabela}"))
+    linhas = [{'id': r.id, 'texto': INDICES_BUSCA[tabela](r)} for r in modelo.query]
+    if linhas:
+        db.session.execute(text(f"INSERT INTO {tabela}(rowid, texto) VALUES (:id, :texto)"), linhas)
+    return len(linhas)
+
+
+def atualizar_indice_busca(tabela, ids, tamanho_bloco=5000):
+    """Refaz no índice de busca só os registos indicados (inserções e atualizações em massa não disparam os eventos do ORM). Não faz commit."""
+    modelo = Insumo if tabela == 'insumo_busca' else Fornecedor
+    apagar = text(f"DELETE FROM {tabela} WHERE rowid IN :ids").bindparams(bindparam('ids', expanding=True))
+    ids = list(ids)
+    for i in range(0, len(ids), tamanho_bloco):
+        bloco = ids[i:i + tamanho_bloco]
+        db.session.execute(apagar, {'ids': bloco})
+        linhas = [{'id': r.id, 'texto': INDICES_BUSCA[tabela](r)} for r in modelo.query.filter(modelo.id.in_(bloco))]
+        if linhas:
+            db.session.execute(text(f"INSERT INTO {tabela}(rowid, texto) VALUES (:id, :texto)"), linhas)
+
+
+def _sincronizar_indice_busca(tabela, connection, alvo, remover=False):
+    if not app.config['BUSCA_FTS_DISPONIVEL']:
+        return
+    connection.execute(text(f"DELETE FROM {tabela} WHERE rowid = :id"), {'id': alvo.id})
+    if not remover:
+        connection.execute(text(f"INSERT INTO {tabela}(rowid, texto) VALUES (:id, :texto)"),
+                           {'id': alvo.id, 'texto': INDICES_BUSCA[tabela](alvo)})
+
+
+for _modelo, _tabela in ((Insumo, 'insumo_busca'), (Fornecedor, 'fornecedor_busca')):
+    event.listen(_modelo, 'after_insert', lambda m, c, alvo, t=_tabela: _sincronizar_indice_busca(t, c, alvo))
+    event.listen(_modelo, 'after_update', lambda m, c, alvo, t=_tabela: _sincronizar_indice_busca(t, c, alvo))
+    event.listen(_modelo, 'after_delete', lambda m, c, alvo, t=_tabela: _sincronizar_indice_busca(t, c, alvo, remover=True))
+
+
+def subconsulta_busca(tabela, termo, max_candidatos=None):
+    """
+    Retorna uma subconsulta (id, rank) com os registos cujo texto contém todas as
+    palavras do termo. Palavras com menos de 3 letras não cabem no trigram e são
+    filtradas com LIKE sobre o texto normalizado.
+    Com max_candidatos, só esse número de resultados é lido do índice e ordenado
+    por relevância: primeiro os que contêm o termo inteiro, depois os que o têm
+    mais perto do início e os textos mais curtos. (O bm25 do FTS5 sobre trigramas
+    percorre todas as listas de ocorrências e é lento para termos comuns.)
+    Sem max_candidatos, todos os resultados são devolvidos com rank 0.
+    Retorna None se o termo for vazio ou se o FTS5 não estiver disponível.
+    """
+    palavras = normalize_text(termo).split()
+    if not palavras or not app.config['BUSCA_FTS_DISPONIVEL']:
+        return None
+
+    longas = [p for p in palavras if len(p) >= 3]
+    curtas = [p for p in palavras if len(p) < 3]
+    condicoes, parametros = [], {}
+    if longas:
+        condicoes.append(f"{tabela} MATCH :consulta")
+        parametros['consulta'] = ' '.join('"' + p.replace('"', '""') + '"' for p in longas)
+    for i, palavra in enumerate(curtas):
+        condicoes.append(f"texto LIKE :curta{i} ESCAPE '\\'")
+        parametros[f'curta{i}'] = '%' + re.sub(r'([%_\\])', r'\\\1', palavra) + '%'
+
+    rank = '0'
+    if max_candidatos is not None:
+        rank = "(instr(texto, :frase) = 0) * 1000000 + instr(texto, :primeira) * 1000 + length(texto)"
+        parametros['frase'], parametros['primeira'] = ' '.join(palavras), palavras[0]
+    sql = f"SELECT rowid AS id, {rank} AS rank FROM {tabela} WHERE {' AND '.join(condicoes)}"
+    if max_candidatos is not None:
+        sql += " LIMIT :max_candidatos"
+        parametros['max_candidatos'] = max_candidatos
+    return text(sql).bindparams(**parametros).columns(id=db.Integer, rank=db.Integer).subquery(f'{tabela}_resultado')
+
+
+def condicao_busca_insumo(termo, coluna_id, coluna_descricao, coluna_sku):
+    """Condição de filtro por descrição/SKU, usando o índice FTS5 quando disponível."""
+    resultado = subconsulta_busca('insumo_busca', termo)
+    if resultado is None:
+        return coluna_descricao.ilike(f'%{termo}%') | coluna_sku.ilike(f'%{termo}%')
+    return coluna_id.in_(select(resultado.c.id))
+
+
+# --- CATÁLOGO EM MEMÓRIA (AUTOCOMPLETE) ---
+# Snapshot só de leitura, por worker, com o necessário para responder ao Select2
+# sem ir à base de dados: chaves normalizadas, listas ordenadas para busca por
+# prefixo e um texto único com todas as chaves para busca por substring.
+_catalogo = {'versao': None, 'verificado_em': 0.0, 'sujo': True, 'insumos': None, 'fornecedores': None}
+_catalogo_lock = threading.Lock()
+
+
+def _montar_indice_autocomplete(ids, respostas, chaves, prefixos):
+    """
+    ids/respostas/chaves são listas paralelas; prefixos é uma lista, por registo,
+    dos valores normalizados pesquisáveis por prefixo (ex.: descrição e SKU).
+    """
+    inicios, posicao = array('q'), 0
+    for chave in chaves:
+        inicios.append(posicao)
+        posicao += len(chave) + 1
+    ordenados = sorted((valor, i) for i, valores in enumerate(prefixos) for valor in valores if valor)
+    return {
+        'ids': array('q', ids),
+        'respostas': respostas,
+        'chaves': chaves,
+        'texto': '\n'.join(chaves),
+        'inicios': inicios,
+        'prefixos': [valor for valor, _ in ordenados],
+        'prefixos_indices': array('q', (i for _, i in ordenados)),
+    }
+
+
+def _normalizar_chave(*partes):
+    return ' '.join(normalize_text(' '.join(p or '' for p in partes)).split())
+
+
+def carregar_catalogo(versao):
+    """Monta o snapshot de insumos e fornecedores ativos a partir de duas consultas."""
+    ids, respostas, chaves, prefixos = [], [], [], []
+    for insumo_id, descricao, sku, valor_unitario in db.session.query(
+            Insumo.id, Insumo.descricao, Insumo.sku, Insumo.valor_unitario).order_by(Insumo.id):
+        ids.append(insumo_id)
+        respostas.append((f"{descricao} (SKU: {sku})", valor_unitario))
+        chaves.append(_normalizar_chave(descricao, sku))
+        prefixos.append((_normalizar_chave(descricao), _normalizar_chave(sku)))
+    insumos = _montar_indice_autocomplete(ids, respostas, chaves, prefixos)
+
+    ids, respostas, chaves, prefixos = [], [], [], []
+    for fornecedor_id, razao_social, nome_fantasia, cnpj in db.session.query(
+            Fornecedor.id, Fornecedor.razao_social, Fornecedor.nome_fantasia, Fornecedor.cnpj)\
+            .filter(Fornecedor.ativo == True).order_by(Fornecedor.id):
+        ids.append(fornecedor_id)
+        respostas.append((razao_social,))
+        chaves.append(_normalizar_chave(razao_social, nome_fantasia, cnpj))
+        prefixos.append((_normalizar_chave(razao_social), _normalizar_chave(nome_fantasia), _normalizar_chave(cnpj)))
+    fornecedores = _montar_indice_autocomplete(ids, respostas, chaves, prefixos)
+
+    _catalogo.update(versao=versao, insumos=insumos, fornecedores=fornecedores, sujo=False)
+
+
+def obter_catalogo():
+    """
+    Retorna o snapshot atual, reconstruindo-o se a versão do catálogo mudou.
+    A versão só é lida da base de dados a cada CATALOGO_VERIFICAR_SEGUNDOS
+    (ou logo após uma escrita de catálogo feita por este worker).
+    """
+    agora = time.monotonic()
+    if _catalogo['sujo'] or agora - _catalogo['verificado_em'] >= app.config['CATALOGO_VERIFICAR_SEGUNDOS']:
+        with _catalogo_lock:
+            versao = versao_dados(2)
+            if _catalogo['sujo'] or versao != _catalogo['versao']:
+                carregar_catalogo(versao)
+            _catalogo['verificado_em'] = agora
+    return _catalogo
+
+
+def buscar_no_indice(indice, termo, limite=15):
+    """
+    Retorna as posições (no índice) dos registos que correspondem ao termo:
+    primeiro os que começam pelo termo, depois os que contêm todas as palavras.
+    """
+    palavras = normalize_text(termo).split()
+    if not palavras:
+        return list(range(min(limite, len(indice['ids']))))
+
+    encontrados, vistos = [], set()
+    frase = ' '.join(palavras)
+    prefixos, prefixos_indices = indice['prefixos'], indice['prefixos_indices']
+    j = bisect_left(prefixos, frase)
+    while j < len(prefixos) and len(encontrados) < limite and prefixos[j].startswith(frase):
+        i = prefixos_indices[j]
+        if i not in vistos:
+            vistos.add(i)
+            encontrados.append(i)
+        j += 1
+
+    # Percorre as ocorrências de uma palavra-pivô e confirma as restantes em cada
+    # chave candidata. Começa pela palavra mais longa (normalmente seletiva); se
+    # esgotar o orçamento de candidatos, troca para a palavra mais rara (estimada
+    # numa amostra do texto, para não varrer o catálogo inteiro por palavra).
+    texto, inicios, chaves = indice['texto'], indice['inicios'], indice['chaves']
+    pivo, orcamento = max(palavras, key=len), 2000
+    pos = texto.find(pivo)
+    while pos != -1 and len(encontrados) < limite:
+        i = bisect_right(inicios, pos) - 1
+        if i not in vistos and all(p in chaves[i] for p in palavras):
+            vistos.add(i)
+            encontrados.append(i)
+        orcamento -= 1
+        if not orcamento and len(palavras) > 1:
+            amostra = texto[:1 << 18]
+            raro = min(palavras, key=amostra.count)
+            if raro != pivo:
+                # Recomeça do início com o novo pivô; os já vistos são ignorados
+                pivo = raro
+                pos = texto.find(pivo)
+                continue
+        # Salta para a chave seguinte: cada registo entra no máximo uma vez
+        pos = texto.find(pivo, inicios[i + 1]) if i + 1 < len(inicios) else -1
+    return encontrados
+
+
+@app.cli.command('reindexar-busca')
+def reindexar_busca_command():
+    """Reconstrói os índices de busca de insumos e fornecedores."""
+    if not app.config['BUSCA_FTS_DISPONIVEL']:
+        click.echo('FTS5 indisponível: nada a reindexar.')
+        return
+    for tabela in INDICES_BUSCA:
+        total = reconstruir_indice_busca(tabela)
+        click.echo(f'{tabela}: {total} registo(s) indexado(s).')
+    db.session.commit()
+
+
+# --- CORRESPONDÊNCIA DE ITENS COM O CATÁLOGO ---
+# Índice das descrições dos insumos, por worker, reconstruído quando a versão do
+# catálogo muda: descrição normalizada -> id e palavra -> ids (para a busca aproximada).
+_indice_descricoes = {'versao': None, 'exatas': {}, 'palavras': {}, 'por_id': {}}
+_indice_descricoes_lock = threading.Lock()
+
+
+def _palavras_descricao(chave):
+    return tuple(dict.fromkeys(re.findall(r'\w+', chave)))
+
+
+def obter_indice_descricoes():
+    versao = versao_dados(2)
+    with _indice_descricoes_lock:
+        if _indice_descricoes['versao'] != versao:
+            exatas, palavras, por_id = {}, {}, {}
+            for insumo_id, descricao in db.session.query(Insumo.id, Insumo.descricao).order_by(Insumo.id):
+                chave = _normalizar_chave(descricao)
+                exatas.setdefault(chave, insumo_id)
+                por_id[insumo_id] = _palavras_descricao(chave)
+                for palavra in por_id[insumo_id]:
+                    palavras.setdefault(palavra, []).append(insumo_id)
+            _indice_descricoes.update(versao=versao, exatas=exatas, palavras=palavras, por_id=por_id)
+        return _indice_descricoes
+
+
+# Preposições e conjunções: não distinguem produtos e as notas muitas vezes omitem-nas
+PALAVRAS_IGNORADAS = frozenset({'de', 'da', 'do', 'das', 'dos', 'e', 'em', 'na', 'no'})
+
+
+def _palavra_exata(palavra):
+    """Palavras que não admitem abreviação: com dígitos (medidas, códigos) ou de 1-2 letras (tamanhos P/M/G/GG, U)."""
+    return len(palavra) < 3 or any(c.isdigit() for c in palavra)
+
+
+def similaridade_descricoes(palavras_a, palavras_b):
+    """
+    Coeficiente de Dice entre as palavras iguais de duas descrições, ou 0.0 se não
+    descreverem o mesmo produto: as palavras exatas (ver _palavra_exata) têm de
+    coincidir e cada uma das restantes sem igual tem de ser abreviação de uma palavra
+    do outro lado ("transp" e "transparente"). Uma cor ou um tamanho trocados anulam.
+    """
+    palavras_a = [p for p in palavras_a if p not in PALAVRAS_IGNORADAS]
+    palavras_b = [p for p in palavras_b if p not in PALAVRAS_IGNORADAS]
+    if not palavras_a or not palavras_b:
+        return 0.0
+    if {p for p in palavras_a if _palavra_exata(p)} != {p for p in palavras_b if _palavra_exata(p)}:
+        return 0.0
+
+    sem_par = [p for p in palavras_a if p not in palavras_b]
+    restantes = [p for p in palavras_b if p not in palavras_a]
+    if len(sem_par) != len(restantes):
+        return 0.0
+    for palavra in sorted(sem_par, key=len, reverse=True):
+        par = next((p for p in restantes if p.startswith(palavra) or palavra.startswith(p)), None)
+        if par is None:
+            return 0.0
+        restantes.remove(par)
+    iguais = len(palavras_a) - len(sem_par)
+    return 2 * iguais / (len(palavras_a) + len(palavras_b))
+
+
+def buscar_descricao_aproximada(indice, chave, max_candidatos=2000):
+    """
+    Id do insumo com a descrição mais parecida (ver similaridade_descricoes, a partir
+    de PDF_SIMILARIDADE_MINIMA), ou None. Os candidatos vêm das listas das duas
+    palavras mais raras da descrição.
+    """
+    palavras = _palavras_descricao(chave)
+    conhecidas = sorted((p for p in palavras if p in indice['palavras'] and p not in PALAVRAS_IGNORADAS),
+                        key=lambda p: len(indice['palavras'][p]))
+    candidatos = set()
+    for palavra in conhecidas[:2]:
+        candidatos.update(indice['palavras'][palavra][:max_candidatos])
+
+    melhor, melhor_id = app.config['PDF_SIMILARIDADE_MINIMA'], None
+    for insumo_id in sorted(candidatos):
+        pontuacao = similaridade_descricoes(palavras, indice['por_id'][insumo_id])
+        if pontuacao >= melhor and (melhor_id is None or pontuacao > melhor):
+            melhor, melhor_id = pontuacao, insumo_id
+    return melhor_id
+
+
+def corresponder_itens_catalogo(linhas):
+    """
+    Resolve as linhas de uma nota contra o catálogo de uma só vez. 'linhas' é uma
+    lista de (descricao_pdf, quantidade, valor_unitario, sku_pdf). Devolve, pela
+    mesma ordem, (insumo, correspondencia), com correspondencia em 'sku',
+    'descricao', 'aproximada' ou 'novo'.
+    Prioridade por linha: SKU da coluna, SKU de 8 dígitos na descrição, descrição
+    normalizada igual, descrição aproximada e, por fim, cadastro de um insumo novo.
+    Os SKUs são resolvidos com uma consulta IN, as descrições com o índice em
+    memória, e os SKUs dos insumos novos são reservados em bloco. Faz flush, não commit.
+    """
+    skus_descricao = []
+    for descricao_pdf, _, _, _ in linhas:
+        match = re.search(r'\b(\d{8})\b', descricao_pdf)
+        skus_descricao.append(match.group(1) if match else None)
+    candidatos = {sku for *_, sku in linhas if sku} | {sku for sku in skus_descricao if sku}
+    por_sku = {i.sku: i for i in Insumo.query.filter(Insumo.sku.in_(candidatos))} if candidatos else {}
+    indice = obter_indice_descricoes()
+
+    resultado, ids, novos, por_descricao = [], set(), [], {}
+    for (descricao_pdf, _, valor_unit, sku_pdf), sku_descricao in zip(linhas, skus_descricao):
+        chave = _normalizar_chave(descricao_pdf)
+        if sku_pdf and sku_pdf in por_sku:
+            resultado.append((por_sku[sku_pdf], 'sku'))
+        elif sku_descricao and sku_descricao in por_sku:
+            resultado.append((por_sku[sku_descricao], 'sku'))
+        elif chave in por_descricao:
+            # Repetição de um insumo cadastrado por uma linha anterior da mesma nota
+            resultado.append((por_descricao[chave], 'descricao'))
+        elif chave in indice['exatas']:
+            ids.add(indice['exatas'][chave])
+            resultado.append((indice['exatas'][chave], 'descricao'))
+        else:
+            aproximado = buscar_descricao_aproximada(indice, chave)
+            if aproximado is not None:
+                ids.add(aproximado)
+                resultado.append((aproximado, 'aproximada'))
+            else:
+                novo = Insumo(descricao=descricao_pdf.title(), sku=sku_descricao, valor_unitario=valor_unit)
+                novos.append((novo, descricao_pdf))
+                if sku_descricao:
+                    por_sku[sku_descricao] = novo
+                por_descricao[chave] = novo
+                resultado.append((novo, 'novo'))
+
+    sequenciais = [novo for novo, _ in novos if not novo.sku]
+    for novo, sku in zip(sequenciais, gerar_novos_skus(len(sequenciais))):
+        novo.sku = sku
+    if novos:
+        for novo, descricao_pdf in novos:
+            print(f"AVISO: Insumo '{descricao_pdf}' não encontrado. Criando novo com SKU: {novo.sku}...")
+        db.session.add_all([novo for novo, _ in novos])
+        db.session.flush()
+
+    existentes = {i.id: i for i in Insumo.query.filter(Insumo.id.in_(ids))} if ids else {}
+    return [(existentes[ref] if isinstance(ref, int) else ref, tipo) for ref, tipo in resultado]
+
+
+# --- EXTRAÇÃO DE PDF EM SEGUNDO PLANO ---
+# O upload só grava a tarefa; um thread despachante por worker reclama-a com um
+# UPDATE condicional e distribui as páginas por um pool de processos. As operações
+# na fila usam uma conexão própria (fora da sessão), para não mexer na versão dos dados.
+_despachante_pdf = {'pid': None, 'thread': None, 'pool': None, 'evento': threading.Event()}
+_despachante_pdf_lock = threading.Lock()
+
+
+def _pool_pdf():
+    """
+    Pool de processos do worker atual, criado na primeira tarefa. Os processos nascem
+    do forkserver (ou por spawn onde não existe), nunca por fork deste processo, que
+    já tem outros threads a correr; só importam extracao_pdf e recebem o caminho do ficheiro.
+    """
+    if _despachante_pdf['pool'] is None:
+        metodo = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        contexto = multiprocessing.get_context(metodo)
+        if metodo == 'forkserver':
+            contexto.set_forkserver_preload(['extracao_pdf'])
+        _despachante_pdf['pool'] = ProcessPoolExecutor(max_workers=app.config['PDF_PROCESSOS'], mp_context=contexto)
+    return _despachante_pdf['pool']
+
+
+def iterar_paginas_pdf(conteudo, pool=None):
+    """
+    Gera (texto, tabelas, ms_texto, ms_tabelas) página a página, até PDF_MAX_PAGINAS,
+    para que quem consome possa parar cedo. Com um pool, as páginas são extraídas em
+    ondas de PDF_PROCESSOS páginas em paralelo, a partir de um ficheiro temporário.
+    """
+    limite = app.config['PDF_MAX_PAGINAS']
+    paginas_texto = app.config['PDF_PAGINAS_CABECALHO']
+    if pool is None:
+        # Sem pool: o documento é aberto uma vez e lido página a página
+        yield from gerar_paginas_pdf(BytesIO(conteudo), 0, limite, paginas_texto)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as arquivo:
+        arquivo.write(conteudo)
+        arquivo.flush()
+        with pdfplumber.open(arquivo.name) as pdf:
+            total_paginas = min(len(pdf.pages), limite)
+        onda = app.config['PDF_PROCESSOS']
+        for inicio in range(0, total_paginas, onda):
+            futuros = [
+                pool.submit(extrair_paginas_pdf, arquivo.name, indice, indice + 1, paginas_texto)
+                for indice in range(inicio, min(inicio + onda, total_paginas))
+            ]
+            try:
+                for futuro in futuros:
+                    yield from futuro.result()
+            finally:
+                # Paragem antecipada: as páginas da onda que ainda não começaram são canceladas
+                for futuro in futuros:
+                    futuro.cancel()
+
+
+def localizar_colunas_itens(tabela):
+    """
+    Índices (descrição, quantidade, valor unitário, SKU) a partir do cabeçalho da
+    tabela, ou None se não for uma tabela de itens. O SKU é -1 quando não existe.
+    """
+    if not tabela or not tabela[0]:
+        return None
+
+    header_processado = [str(h).replace('\n', ' ').strip().upper() if h else '' for h in tabela[0]]
+
+    idx_desc, idx_qtd, idx_vlr_unit, idx_sku_col = -1, -1, -1, -1
+    for i, h in enumerate(header_processado):
+        if 'DESCRI' in h: idx_desc = i
+        elif 'QTD' in h or 'QUANT' in h: idx_qtd = i
+        elif 'UNIT' in h: idx_vlr_unit = i
+        elif 'SKU' in h or 'CÓD' in h: idx_sku_col = i
+
+    if not (idx_desc != -1 and idx_qtd != -1 and idx_vlr_unit != -1):
+        return None
+    return idx_desc, idx_qtd, idx_vlr_unit, idx_sku_col
+
+
+def ler_linha_item(linha_dados, colunas):
+    """(descrição, quantidade, valor unitário) de uma linha da tabela de itens, ou None."""
+    idx_desc, idx_qtd, idx_vlr_unit, _ = colunas
+    if not linha_dados or len(linha_dados) <= max(idx_desc, idx_qtd, idx_vlr_unit): return None
+
+    descricao_pdf = str(linha_dados[idx_desc] or '').replace('\n', ' ').strip()
+    if not descricao_pdf: return None
+
+    try:
+        qtd_str = str(linha_dados[idx_qtd] or '0').replace('.', '').replace(',', '.')
+        vlr_unit_str = str(linha_dados[idx_vlr_unit] or '0').replace('.', '').replace(',', '.')
+        return descricao_pdf, float(qtd_str), float(vlr_unit_str)
+    except (ValueError, TypeError):
+        return None
+
+
+def tabela_de_itens_valida(tabela):
+    """True se a tabela tem o cabeçalho de itens e pelo menos uma linha legível."""
+    colunas = localizar_colunas_itens(tabela)
+    return colunas is not None and any(ler_linha_item(linha, colunas) for linha in tabela[1:])
+
+
+# Incrementar quando mudar o que extrair_dados_brutos_pdf produz: invalida o cache em disco
+FORMATO_CACHE_PDF = 2
+
+
+def _caminho_cache_pdf(digest):
+    return os.path.join(app.config['PDF_CACHE_DIR'], f'{digest}.json')
+
+
+def ler_cache_pdf(digest):
+    """Extração bruta guardada para este SHA-256, ou None."""
+    caminho = _caminho_cache_pdf(digest)
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            dados = json.load(f)
+        os.utime(caminho) # marca como usado: a limpeza apaga os menos recentes
+    except (OSError, ValueError):
+        return None
+    return dados if dados.get('formato') == FORMATO_CACHE_PDF else None
+
+
+def gravar_cache_pdf(digest, dados):
+    """Guarda a extração bruta e apaga os ficheiros mais antigos acima do limite de bytes."""
+    caminho = _caminho_cache_pdf(digest)
+    try:
+        diretorio = os.path.dirname(caminho)
+        os.makedirs(diretorio, exist_ok=True)
+        temporario = f'{caminho}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporario, 'w', encoding='utf-8') as f:
+            json.dump(dict(dados, formato=FORMATO_CACHE_PDF), f, ensure_ascii=False)
+        os.replace(temporario, caminho) # escrita atómica entre workers
+
+        arquivos = []
+        for entrada in os.scandir(diretorio):
+            if entrada.name.endswith('.json'):
+                try:
+                    info = entrada.stat()
+                except OSError:
+                    continue # apagado por outro worker entretanto
+                arquivos.append((info.st_mtime, info.st_size, entrada.path))
+        excesso = sum(tamanho for _, tamanho, _ in arquivos) - app.config['PDF_CACHE_MAX_BYTES']
+        for _, tamanho, antigo in sorted(arquivos):
+            if excesso <= 0:
+                break
+            try:
+                os.remove(antigo)
+            except OSError:
+                pass
+            excesso -= tamanho
+    except OSError:
+        traceback.print_exc()
+
+
+def extrair_dados_brutos_pdf(conteudo, pool=None):
+    """
+    Parte pesada e independente do catálogo: texto, tabelas, CNPJs e número do
+    documento do PDF. O resultado fica em cache pelo SHA-256 do ficheiro, pelo que
+    um PDF repetido não volta a passar pelo pdfplumber.
+    As páginas são lidas em fluxo e a leitura termina na primeira tabela de itens
+    válida (a mesma em que interpretar_dados_pdf pára); as tabelas seguintes e as
+    páginas restantes não são processadas.
+    """
+    digest = hashlib.sha256(conteudo).hexdigest()
+    dados = ler_cache_pdf(digest)
+    if dados is not None:
+        return dados
+
+    inicio = time.perf_counter()
+    textos, todas_as_tabelas = [], []
+    tempos = {'texto_ms': 0.0, 'tabelas_ms': 0.0, 'paginas_lidas': 0}
+    paginas = iterar_paginas_pdf(conteudo, pool)
+    try:
+        for texto, tabelas, ms_texto, ms_tabelas in paginas:
+            textos.append(texto)
+            tempos['texto_ms'] += ms_texto
+            tempos['tabelas_ms'] += ms_tabelas
+            tempos['paginas_lidas'] += 1
+            encontrada = False
+            for tabela in tabelas:
+                todas_as_tabelas.append(tabela)
+                if tabela_de_itens_valida(tabela):
+                    encontrada = True
+                    break
+            if encontrada:
+                break
+    finally:
+        paginas.close()
+    text_completo = ''.join(textos)
+    tempos['extracao_ms'] = (time.perf_counter() - inicio) * 1000
+    print(f">>> PDF {digest[:12]}: {tempos['paginas_lidas']} página(s) lida(s) em {tempos['extracao_ms']:.0f} ms "
+          f"(texto {tempos['texto_ms']:.0f} ms, tabelas {tempos['tabelas_ms']:.0f} ms)")
+
+    numero_documento = ''
+    numero_doc_match = re.search(r'N[º°]\.?\s*([\d\.-]+)', text_completo, re.IGNORECASE)
+    if numero_doc_match:
+        numero_documento = numero_doc_match.group(1).replace('.', '').replace('-', '')
+    dados = {
+        'texto': text_completo,
+        'tabelas': todas_as_tabelas,
+        'cnpjs': re.findall(r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})', text_completo),
+        'numero_documento': numero_documento,
+        'tempos': {chave: round(valor, 1) for chave, valor in tempos.items()},
+    }
+    gravar_cache_pdf(digest, dados)
+    return dados
+
+
+def montar_sugestao_recebimento(cnpjs, numero_documento, linhas, origem='PDF'):
+    """
+    Resposta do ecrã de recebimento a partir dos dados de uma nota fiscal (PDF ou
+    XML): fornecedor pelo primeiro CNPJ cadastrado e itens resolvidos contra o
+    catálogo (ver corresponder_itens_catalogo). 'linhas' é uma lista de
+    (descricao, quantidade, valor_unitario, codigo). Cadastra os insumos não
+    encontrados e faz commit. Devolve a descrição limpa da base de dados em vez
+    da descrição da nota.
+    """
+    # Lógica para identificar o fornecedor pelos CNPJs do documento...
+    fornecedor_sugerido = None
+    for cnpj_str in cnpjs:
+        cnpj_limpo = re.sub(r'[./-]', '', cnpj_str)
+        fornecedor = Fornecedor.query.filter_by(cnpj=cnpj_limpo).first()
+        if fornecedor:
+            fornecedor_sugerido = {'id': fornecedor.id, 'text': fornecedor.razao_social}
+            break
+
+    itens_sugeridos = []
+    novos_produtos_criados = 0
+    correspondencias = corresponder_itens_catalogo(linhas) if linhas else []
+    for (descricao_doc, quantidade_doc, valor_unit, _), (insumo_encontrado, correspondencia) in zip(linhas, correspondencias):
+        foi_criado_agora = correspondencia == 'novo'
+        if foi_criado_agora:
+            novos_produtos_criados += 1
+
+        # *** PONTO-CHAVE DA CORREÇÃO ***
+        # Usa a descrição do insumo encontrado na base de dados, não a do PDF.
+        itens_sugeridos.append({
+            'insumo_id': insumo_encontrado.id,
+            'descricao': insumo_encontrado.descricao, # <-- USA A DESCRIÇÃO DO BANCO DE DADOS
+            'quantidade_documento': quantidade_doc,
+            'valor_unitario': valor_unit,
+            'unidade_medida': insumo_encontrado.unidade_medida,
+            'novo': foi_criado_agora,
+            'correspondencia': correspondencia, # sku | descricao | aproximada | novo
+            # Descrição lida na nota, para o utilizador confirmar as correspondências aproximadas
+            'descricao_documento': descricao_doc
+        })
+
+    db.session.commit()
+    
+    mensagem = "Dados extraídos com sucesso!"
+    if novos_produtos_criados > 0:
+        mensagem = f"{novos_produtos_criados} novo(s) produto(s) foi/foram cadastrado(s) automaticamente!"
+    elif not itens_sugeridos:
+        mensagem = f"{origem} lido, mas nenhum item correspondente foi encontrado na base de dados."
+
+    return {
+        'fornecedor': fornecedor_sugerido,
+        'numero_documento': numero_documento,
+        'itens': itens_sugeridos,
+        'message': mensagem
+    }
+
+
+def interpretar_dados_pdf(dados_brutos):
+    """
+    Identifica fornecedor e itens a partir da extração bruta do PDF (ver
+    extrair_dados_brutos_pdf e montar_sugestao_recebimento).
+    """
+    inicio = time.perf_counter()
+
+    # --- LÓGICA DE PROCESSAMENTO DE ITENS REFINADA ---
+    # Usa a primeira tabela de itens com linhas legíveis
+    linhas_pdf = []
+    for tabela in dados_brutos['tabelas']:
+        colunas = localizar_colunas_itens(tabela)
+        if colunas is None:
+            continue
+        idx_sku_col = colunas[3]
+
+        for linha_dados in tabela[1:]:
+            item_pdf = ler_linha_item(linha_dados, colunas)
+            if item_pdf is None: continue
+            sku_pdf = ''
+            if idx_sku_col != -1 and len(linha_dados) > idx_sku_col:
+                sku_pdf = str(linha_dados[idx_sku_col] or '').strip()
+            linhas_pdf.append(item_pdf + (sku_pdf,))
+
+        if linhas_pdf: break
+
+    resposta = montar_sugestao_recebimento(dados_brutos['cnpjs'], dados_brutos['numero_documento'], linhas_pdf)
+    resposta['tempos'] = dict(dados_brutos.get('tempos', {}), correspondencia_ms=round((time.perf_counter() - inicio) * 1000, 1))
+    return resposta
+
+
+def enfileirar_tarefa_pdf(conteudo, nome_arquivo, usuario):
+    """Grava a tarefa PENDENTE e acorda o despachante deste worker. Devolve o id."""
+    tarefa_id = uuid.uuid4().hex
+    agora = datetime.utcnow()
+    with db.engine.begin() as conexao:
+        conexao.execute(insert(TarefaExtracaoPdf.__table__).values(
+            id=tarefa_id, status='PENDENTE', nome_arquivo=nome_arquivo, conteudo=conteudo,
+            tentativas=0, usuario=usuario, criado_em=agora, atualizado_em=agora
+        ))
+    garantir_despachante_pdf()
+    _despachante_pdf['evento'].set()
+    return tarefa_id
+
+
+def _finalizar_tarefa_pdf(tarefa_id, status, resultado=None, erro=None):
+    tabela = TarefaExtracaoPdf.__table__
+    with db.engine.begin() as conexao:
+        conexao.execute(update(tabela).where(tabela.c.id == tarefa_id).values(
+            status=status, resultado=resultado, erro=erro, conteudo=None, atualizado_em=datetime.utcnow()
+        ))
+
+
+def processar_proxima_tarefa_pdf():
+    """
+    Reclama a tarefa pendente mais antiga e processa-a. Devolve False se a fila
+    estiver vazia. Várias instâncias (workers) podem correr em simultâneo: só a
+    que vence o UPDATE condicional fica com a tarefa.
+    """
+    tabela = TarefaExtracaoPdf.__table__
+    agora = datetime.utcnow()
+    with db.engine.begin() as conexao:
+        # Tarefas de workers que morreram a meio voltam à fila
+        conexao.execute(update(tabela).where(
+            tabela.c.status == 'PROCESSANDO',
+            tabela.c.atualizado_em < agora - timedelta(seconds=app.config['PDF_TAREFAS_TIMEOUT_SEGUNDOS'])
+        ).values(status='PENDENTE'))
+        tarefa_id = conexao.execute(
+            select(tabela.c.id).where(tabela.c.status == 'PENDENTE').order_by(tabela.c.criado_em).limit(1)
+        ).scalar()
+        if tarefa_id is None:
+            return False
+        reclamada = conexao.execute(
+            update(tabela).where(tabela.c.id == tarefa_id, tabela.c.status == 'PENDENTE')
+            .values(status='PROCESSANDO', tentativas=tabela.c.tentativas + 1, atualizado_em=agora)
+        ).rowcount
+        tarefa = conexao.execute(
+            select(tabela.c.conteudo, tabela.c.tentativas).where(tabela.c.id == tarefa_id)
+        ).first()
+    if not reclamada:
+        return True # outro worker ficou com ela; tenta a seguinte
+
+    if tarefa.tentativas > app.config['PDF_TAREFAS_MAX_TENTATIVAS']:
+        _finalizar_tarefa_pdf(tarefa_id, 'ERRO', erro='O ficheiro excedeu o número máximo de tentativas de processamento.')
+        return True
+    try:
+        resultado = interpretar_dados_pdf(extrair_dados_brutos_pdf(tarefa.conteudo, _pool_pdf()))
+        _finalizar_tarefa_pdf(tarefa_id, 'CONCLUIDA', resultado=json.dumps(resultado))
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERRO CRÍTICO AO PROCESSAR PDF (tarefa {tarefa_id}): {e}")
+        traceback.print_exc()
+        if isinstance(e, BrokenProcessPool):
+            _despachante_pdf['pool'] = None
+        _finalizar_tarefa_pdf(tarefa_id, 'ERRO', erro=f'Ocorreu um erro inesperado ao ler o ficheiro PDF: {e}')
+    return True
+
+
+def _ciclo_despachante_pdf():
+    evento = _despachante_pdf['evento']
+    while True:
+        try:
+            with app.app_context():
+                while processar_proxima_tarefa_pdf():
+                    pass
+        except Exception:
+            traceback.print_exc()
+        evento.wait(app.config['PDF_TAREFAS_INTERVALO_SEGUNDOS'])
+        evento.clear()
+
+
+def garantir_despachante_pdf():
+    """Arranca o thread despachante neste processo (também depois de um fork do Gunicorn)."""
+    thread = _despachante_pdf['thread']
+    if _despachante_pdf['pid'] == os.getpid() and thread is not None and thread.is_alive():
+        return
+    with _despachante_pdf_lock:
+        if _despachante_pdf['pid'] != os.getpid():
+            # Processo novo: o pool herdado (se houver) pertence ao processo pai
+            _despachante_pdf.update(pid=os.getpid(), thread=None, pool=None, evento=threading.Event())
+        thread = _despachante_pdf['thread']
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_ciclo_despachante_pdf, name='despachante-pdf', daemon=True)
+            _despachante_pdf['thread'] = thread
+            thread.start()
+
+
+@app.before_request
+def _iniciar_despachante_pdf():
+    # Só os processos que servem pedidos processam a fila (os comandos "flask ..." não)
+    if app.config['PDF_TAREFAS_ASSINCRONAS']:
+        garantir_despachante_pdf()
+
+
+# --- IMPORTAÇÃO DO XML DA NF-e ---
+# Totais do grupo ICMSTot devolvidos com a nota
+_TOTAIS_NFE = {'vProd': 'valor_produtos', 'vDesc': 'valor_desconto', 'vFrete': 'valor_frete', 'vNF': 'valor_nota'}
+
+
+def ler_nfe_xml(origem):
+    """
+    Lê uma NF-e (NFe ou nfeProc) em fluxo com iterparse, sem montar a árvore:
+    CNPJ do emitente, número (nNF), chave de acesso, itens (cProd, xProd, qCom,
+    vUnCom) e totais. Cada <det> é descartado logo depois de lido.
+    Levanta ValueError se o ficheiro não for uma NF-e ou declarar um DOCTYPE
+    (uma NF-e nunca tem DTD; assim ficam de fora as bombas de entidades).
+    """
+    nota = {'cnpj_emitente': None, 'numero_documento': None, 'chave_acesso': None, 'linhas': [], 'totais': {}}
+    caminho, produto, encontrou_nfe = [], {}, False
+    for evento, elem in ET.iterparse(origem, events=('start', 'end'), forbid_dtd=True):
+        nome = elem.tag.rsplit('}', 1)[-1] # ignora o namespace do portal fiscal
+        if evento == 'start':
+            caminho.append(nome)
+            if nome == 'infNFe':
+                encontrou_nfe = True
+                nota['chave_acesso'] = (elem.get('Id') or '').removeprefix('NFe') or None
+            continue
+
+        caminho.pop()
+        pai = caminho[-1] if caminho else None
+        texto = (elem.text or '').strip()
+        if pai == 'prod' and nome in ('cProd', 'xProd', 'qCom', 'vUnCom'):
+            produto[nome] = texto
+        elif nome == 'prod':
+            nota['linhas'].append((
+                produto.get('xProd', ''), float(produto.get('qCom') or 0),
+                float(produto.get('vUnCom') or 0), produto.get('cProd', '')
+            ))
+            produto = {}
+        elif nome == 'det':
+            elem.clear()
+        elif pai == 'emit' and nome in ('CNPJ', 'CPF'):
+            nota['cnpj_emitente'] = texto
+        elif pai == 'ide' and nome == 'nNF':
+            nota['numero_documento'] = texto
+        elif pai == 'ICMSTot' and nome in _TOTAIS_NFE:
+            nota['totais'][_TOTAIS_NFE[nome]] = float(texto or 0)
+
+    if not encontrou_nfe:
+        raise ValueError("o ficheiro não contém uma NF-e (infNFe).")
+    return nota
+
+
+def interpretar_nfe_xml(origem):
+    """Lê o XML da NF-e e monta a mesma resposta da extração do PDF, com a chave de acesso e os totais."""
+    inicio = time.perf_counter()
+    nota = ler_nfe_xml(origem)
+    leitura_ms = round((time.perf_counter() - inicio) * 1000, 1)
+
+    resposta = montar_sugestao_recebimento(
+        [nota['cnpj_emitente']] if nota['cnpj_emitente'] else [], nota['numero_documento'], nota['linhas'], 'XML'
+    )
+    resposta.update(chave_acesso=nota['chave_acesso'], totais=nota['totais'], tempos={
+        'leitura_ms': leitura_ms,
+        'correspondencia_ms': round((time.perf_counter() - inicio) * 1000 - leitura_ms, 1)
+    })
+    return resposta
+
+
+# --- CARGA INICIAL DAS PLANILHAS (flask importar-planilhas) ---
+PLANILHA_SKUS = 'Dados limpos Insumos - SKU.xlsx'
+PLANILHA_ESTOQUE = 'Dados limpos Insumos - ESTOQUE.xlsx'
+SETORES_INICIAIS = ['Recebimento', 'Controle de Estoque', 'Reabastecimento', 'Picking', 'Expedição', 'Abastecimento de Lojas', 'ADM']
+
+
+def _ler_planilha(caminho):
+    # Exportações em CSV são lidas muito mais depressa do que o xlsx (openpyxl)
+    if caminho.lower().endswith('.csv'):
+        return pd.read_csv(caminho, sep=None, engine='python', encoding='utf-8-sig')
+    return pd.read_excel(caminho)
+
+
+def _coluna_planilha(df, nome):
+    return df[nome] if nome in df.columns else pd.Series(pd.NA, index=df.index, dtype='object')
+
+
+def _texto_planilha(serie):
+    # Texto sem espaços nas pontas; células vazias ficam NA
+    texto = serie.astype('string').str.strip()
+    return texto.mask(texto == '')
+
+
+def normalizar_planilha_skus(df):
+    """
+    Planilha de SKUs -> uma linha por material (chave em maiúsculas, sku, estoque_minimo,
+    valor_unitario). Um material repetido fica com os valores da última linha, na
+    posição da primeira. SKUs numéricos lidos como float voltam a texto inteiro;
+    células numéricas vazias ficam NA.
+    """
+    sku_numerico = pd.to_numeric(_coluna_planilha(df, 'SKU'), errors='coerce')
+    inteiro = sku_numerico.abs() < 1e18 # exclui NaN e infinitos
+    sku = _texto_planilha(_coluna_planilha(df, 'SKU'))
+    sku = sku.mask(inteiro, sku_numerico[inteiro].astype('int64').astype('string'))
+
+    tabela = pd.DataFrame({
+        'chave': _texto_planilha(_coluna_planilha(df, 'Material')).str.upper(),
+        'sku': sku,
+        'estoque_minimo': np.trunc(pd.to_numeric(_coluna_planilha(df, 'estoque_minimo'), errors='coerce')).astype('Int64'),
+        'valor_unitario': pd.to_numeric(_coluna_planilha(df, 'Valor Unit.'), errors='coerce').astype(float),
+    }).dropna(subset=['chave'])
+    ordem = tabela.drop_duplicates('chave')['chave']
+    return tabela.drop_duplicates('chave', keep='last').set_index('chave').loc[ordem].reset_index()
+
+
+def normalizar_planilha_estoque(df):
+    """Planilha de estoque -> (chave do material, posição sem espaços, quantidade numérica ou NaN)."""
+    posicao = _coluna_planilha(df, 'Posição').astype('string').str.replace(r'\s+', '', regex=True)
+    return pd.DataFrame({
+        'chave': _texto_planilha(_coluna_planilha(df, 'Material')).str.upper(),
+        'posicao': posicao.mask(posicao == '').fillna('N/D'),
+        'quantidade': pd.to_numeric(_coluna_planilha(df, 'Quantidade'), errors='coerce'),
+    }).dropna(subset=['chave'])
+
+
+def importar_planilhas(caminho_skus=PLANILHA_SKUS, caminho_estoque=PLANILHA_ESTOQUE):
+    """
+    Carga inicial de insumos, posições de estoque e saldos a partir das duas
+    planilhas: normalização vetorizada no pandas, estoque ligado aos SKUs por um
+    merge na descrição e inserções em massa, tudo numa só transação (commit no fim).
+    Devolve as contagens de linhas lidas, importadas e rejeitadas.
+    """
+    df_skus, df_estoque = _ler_planilha(caminho_skus), _ler_planilha(caminho_estoque)
+    skus = normalizar_planilha_skus(df_skus).fillna({'estoque_minimo': 0, 'valor_unitario': 0.0}).astype({'estoque_minimo': 'int64'})
+    estoque = normalizar_planilha_estoque(df_estoque)
+
+    # SKUs em falta reservados num só bloco, depois dos SKUs da planilha
+    sincronizar_sequencia_sku(skus['sku'].dropna().tolist())
+    sem_sku = skus['sku'].isna()
+    skus.loc[sem_sku, 'sku'] = gerar_novos_skus(int(sem_sku.sum()))
+    # O mesmo SKU em materiais diferentes: fica o primeiro (o estoque dos outros vai para ele)
+    insumos = skus.drop_duplicates('sku')
+    db.session.execute(insert(Insumo), [
+        {'sku': linha.sku, 'descricao': linha.chave.title(), 'valor_unitario': linha.valor_unitario,
+         'estoque_minimo': linha.estoque_minimo, 'unidade_medida': 'UN'}
+        for linha in insumos.itertuples(index=False)
+    ])
+    ids = dict(db.session.query(Insumo.sku, Insumo.id)) # base vazia: só os insumos da planilha
+
+    estoque = estoque.merge(skus[['chave', 'sku']], on='chave', how='left')
+    estoque['insumo_id'] = estoque['sku'].map(ids)
+    desconhecido = estoque['insumo_id'].isna()
+    valida = ~desconhecido & (estoque['quantidade'] > 0)
+    posicoes = (estoque[valida].astype({'insumo_id': 'int64', 'quantidade': float})
+                .groupby(['insumo_id', 'posicao'], sort=False, as_index=False)['quantidade'].sum())
+    if not posicoes.empty:
+        db.session.execute(insert(Estoque), posicoes[['insumo_id', 'posicao', 'quantidade']].to_dict('records'))
+
+        saldos = posicoes.groupby('insumo_id', sort=False, as_index=False)['quantidade'].sum()
+        db.session.execute(insert(SaldoInsumo), saldos.rename(columns={'quantidade': 'quantidade_total'}).to_dict('records'))
+
+    # Inserções em massa não passam pelos eventos do ORM que mantêm o índice de busca
+    if app.config['BUSCA_FTS_DISPONIVEL']:
+        reconstruir_indice_busca('insumo_busca')
+    db.session.commit()
+
+    return {
+        'linhas_skus': len(df_skus),
+        'linhas_estoque': len(df_estoque),
+        'insumos': len(insumos),
+        'skus_gerados': int(sem_sku.sum()),
+        'posicoes': len(posicoes),
+        'sem_material': int(_texto_planilha(_coluna_planilha(df_skus, 'Material')).isna().sum()),
+        'sku_repetido': len(skus) - len(insumos),
+        'materiais_desconhecidos': estoque.loc[desconhecido, 'chave'].unique().tolist(),
+        'material_desconhecido': int(desconhecido.sum()),
+        'quantidade_invalida': int((~desconhecido & ~valida).sum()),
+    }
+
+
+@app.cli.command('importar-planilhas')
+@click.option('--skus', 'caminho_skus', default=PLANILHA_SKUS, show_default=True,
+              type=click.Path(exists=True, dir_okay=False), help='Planilha de SKUs, xlsx ou csv (Material, SKU, estoque_minimo, Valor Unit.).')
+@click.option('--estoque', 'caminho_estoque', default=PLANILHA_ESTOQUE, show_default=True,
+              type=click.Path(exists=True, dir_okay=False), help='Planilha de estoque, xlsx ou csv (Posição, Material, Quantidade).')
+def importar_planilhas_command(caminho_skus, caminho_estoque):
+    """Carga inicial de insumos e estoque a partir das planilhas (só numa base sem insumos)."""
+    if Insumo.query.first():
+        raise click.ClickException('A base de dados já tem insumos: a carga inicial só corre numa base vazia.')
+    inicio = time.perf_counter()
+    try:
+        r = importar_planilhas(caminho_skus, caminho_estoque)
+        registrar_planilhas_sincronizadas({'skus': sha256_arquivo(caminho_skus), 'estoque': sha256_arquivo(caminho_estoque)})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    duracao = time.perf_counter() - inicio
+
+    for material in r['materiais_desconhecidos']:
+        click.echo(f"  - AVISO: Material '{material}' do ficheiro de estoque não encontrado no mapa de SKUs. Posição ignorada.")
+    click.echo(f"{r['insumos']} insumo(s) ({r['skus_gerados']} com SKU gerado) e {r['posicoes']} posição(ões) de estoque "
+               f"importados em {duracao:.2f}s ({(r['linhas_skus'] + r['linhas_estoque']) / duracao:.0f} linhas/s).")
+    click.echo(f"Planilha de SKUs: {r['linhas_skus']} linha(s), rejeitadas {r['sem_material']} sem material "
+               f"e {r['sku_repetido']} com SKU já usado por outro material.")
+    click.echo(f"Planilha de estoque: {r['linhas_estoque']} linha(s), rejeitadas {r['material_desconhecido']} com material "
+               f"fora da planilha de SKUs e {r['quantidade_invalida']} com quantidade inválida.")
+
+
+# --- SINCRONIZAÇÃO INCREMENTAL DAS PLANILHAS (flask sincronizar-planilhas) ---
+def sha256_arquivo(caminho):
+    sha = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1 << 20), b''):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+
+def registrar_planilhas_sincronizadas(hashes):
+    """Guarda o SHA-256 das planilhas aplicadas ({'skus': ..., 'estoque': ...}). Não faz commit."""
+    tabela = PlanilhaSincronizada.__table__
+    stmt = sqlite_insert(tabela)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['nome'],
+        set_={'sha256': stmt.excluded.sha256, 'sincronizado_em': stmt.excluded.sincronizado_em}
+    ), [{'nome': nome, 'sha256': sha, 'sincronizado_em': datetime.utcnow()} for nome, sha in hashes.items()])
+
+
+def _nativo(valor):
+    # Escalares do pandas/numpy -> tipos do Python (NA -> None) para o executemany
+    return None if pd.isna(valor) else valor.item() if hasattr(valor, 'item') else valor
+
+
+def sincronizar_planilhas(caminho_skus=PLANILHA_SKUS, caminho_estoque=PLANILHA_ESTOQUE):
+    """
+    Compara as planilhas do ERP com o estado atual de Insumo e Estoque numa passagem
+    vetorizada e aplica só as diferenças, com instruções em massa. Não faz commit.
+    - Insumos: os novos são inseridos; descrição, valor unitário e estoque mínimo
+      diferentes são atualizados (células vazias mantêm o valor atual). Linhas sem
+      SKU correspondem ao insumo com a mesma descrição (SKU gerado na carga).
+      Insumos ausentes da planilha não são apagados: têm histórico.
+    - Estoque: a planilha é a fotografia das posições; posições novas são inseridas,
+      quantidades diferentes atualizadas e posições que já não existem apagadas. As
+      que têm ajustes de inventário ficam com quantidade 0, para o histórico as manter.
+    Saldos e índice de busca são refeitos só para os insumos tocados.
+    """
+    df_skus, df_estoque = _ler_planilha(caminho_skus), _ler_planilha(caminho_estoque)
+    skus, estoque = normalizar_planilha_skus(df_skus), normalizar_planilha_estoque(df_estoque)
+
+    atuais = pd.DataFrame(
+        db.session.query(Insumo.id, Insumo.sku, Insumo.descricao, Insumo.valor_unitario, Insumo.estoque_minimo).all(),
+        columns=['id', 'sku', 'descricao', 'valor_unitario', 'estoque_minimo']
+    )
+    por_descricao = (atuais.assign(chave=atuais['descricao'].str.strip().str.upper())
+                     .drop_duplicates('chave').set_index('chave')['sku'])
+    sem_sku = skus['sku'].isna()
+    skus.loc[sem_sku, 'sku'] = skus.loc[sem_sku, 'chave'].map(por_descricao)
+    sincronizar_sequencia_sku(skus['sku'].dropna().tolist())
+    sem_sku = skus['sku'].isna()
+    skus.loc[sem_sku, 'sku'] = gerar_novos_skus(int(sem_sku.sum()))
+
+    # --- Insumos ---
+    planilha = skus.drop_duplicates('sku').merge(atuais, on='sku', how='left', suffixes=('', '_atual'))
+    novos = planilha[planilha['id'].isna()]
+    existentes = planilha[planilha['id'].notna()].assign(descricao_nova=lambda t: t['chave'].str.title())
+    muda_descricao = existentes['descricao_nova'] != existentes['descricao']
+    muda_valor = existentes['valor_unitario'].notna() & (
+        existentes['valor_unitario_atual'].isna()
+        | (existentes['valor_unitario'] - existentes['valor_unitario_atual']).abs().gt(1e-9)
+    )
+    muda_minimo = existentes['estoque_minimo'].notna() & (
+        existentes['estoque_minimo'].ne(existentes['estoque_minimo_atual']).fillna(True).astype(bool)
+    )
+    alterados = existentes[muda_descricao | muda_valor | muda_minimo]
+
+    if not novos.empty:
+        db.session.execute(insert(Insumo), [
+            {'sku': linha.sku, 'descricao': linha.chave.title(), 'unidade_medida': 'UN',
+             'valor_unitario': _nativo(linha.valor_unitario) or 0.0, 'estoque_minimo': _nativo(linha.estoque_minimo) or 0}
+            for linha in novos.itertuples(index=False)
+        ])
+    if not alterados.empty:
+        db.session.execute(update(Insumo), [
+            {'id': int(linha.id), 'descricao': linha.descricao_nova,
+             'valor_unitario': _nativo(linha.valor_unitario) if pd.notna(linha.valor_unitario) else _nativo(linha.valor_unitario_atual),
+             'estoque_minimo': _nativo(linha.estoque_minimo) if pd.notna(linha.estoque_minimo) else _nativo(linha.estoque_minimo_atual)}
+            for linha in alterados.itertuples(index=False)
+        ])
+    ids = dict(db.session.query(Insumo.sku, Insumo.id))
+
+    # --- Estoque ---
+    estoque = estoque.merge(skus[['chave', 'sku']], on='chave', how='left')
+    estoque['insumo_id'] = estoque['sku'].map(ids)
+    desconhecido = estoque['insumo_id'].isna()
+    valida = ~desconhecido & (estoque['quantidade'] > 0)
+    alvo = (estoque[valida].astype({'insumo_id': 'int64', 'quantidade': float})
+            .groupby(['insumo_id', 'posicao'], sort=False, as_index=False)['quantidade'].sum())
+    posicoes_atuais = pd.DataFrame(
+        db.session.query(Estoque.id, Estoque.insumo_id, Estoque.posicao, Estoque.quantidade).all(),
+        columns=['id', 'insumo_id', 'posicao', 'quantidade_atual']
+    ).astype({'insumo_id': 'int64'})
+    diferencas = alvo.merge(posicoes_atuais, on=['insumo_id', 'posicao'], how='outer', indicator=True)
+    inserir = diferencas[diferencas['_merge'] == 'left_only']
+    apagar = diferencas[diferencas['_merge'] == 'right_only']
+    mudar = diferencas[(diferencas['_merge'] == 'both')
+                       & (diferencas['quantidade'] - diferencas['quantidade_atual']).abs().gt(1e-9)]
+    ids_ausentes = apagar['id'].astype('int64').tolist()
+    com_ajustes = set()
+    for i in range(0, len(ids_ausentes), 5000):
+        com_ajustes.update(estoque_id for (estoque_id,) in db.session.query(AjusteInventario.estoque_id)
+                           .filter(AjusteInventario.estoque_id.in_(ids_ausentes[i:i + 5000])).distinct())
+    referenciadas = apagar['id'].isin(com_ajustes)
+    zerar = apagar[referenciadas & apagar['quantidade_atual'].ne(0)]
+    apagar = apagar[~referenciadas]
+
+    if not inserir.empty:
+        db.session.execute(insert(Estoque), [
+            {'insumo_id': int(linha.insumo_id), 'posicao': linha.posicao, 'quantidade': float(linha.quantidade)}
+            for linha in inserir.itertuples(index=False)
+        ])
+    if not mudar.empty:
+        db.session.execute(update(Estoque), [
+            {'id': int(linha.id), 'quantidade': float(linha.quantidade)} for linha in mudar.itertuples(index=False)
+        ])
+    if not zerar.empty:
+        db.session.execute(update(Estoque), [{'id': int(estoque_id), 'quantidade': 0.0} for estoque_id in zerar['id']])
+    ids_apagar = apagar['id'].astype('int64').tolist()
+    for i in range(0, len(ids_apagar), 5000):
+        db.session.execute(delete(Estoque.__table__).where(Estoque.__table__.c.id.in_(ids_apagar[i:i + 5000])))
+
+    # Saldos: só os insumos com posições alteradas (o valor é calculado nas leituras)
+    tocados = set(pd.concat([inserir['insumo_id'], mudar['insumo_id'], apagar['insumo_id'], zerar['insumo_id']]).astype('int64').tolist())
+    recalcular_saldos_insumos(sorted(tocados))
+    if app.config['BUSCA_FTS_DISPONIVEL']:
+        atualizar_indice_busca('insumo_busca', [ids[sku] for sku in novos['sku']]
+                               + alterados.loc[muda_descricao.reindex(alterados.index), 'id'].astype('int64').tolist())
+
+    return {
+        'linhas_skus': len(df_skus),
+        'linhas_estoque': len(df_estoque),
+        'insumos_novos': len(novos),
+        'insumos_alterados': len(alterados),
+        'insumos_ausentes': int((~atuais['sku'].isin(planilha['sku'])).sum()),
+        'posicoes_novas': len(inserir),
+        'posicoes_alteradas': len(mudar),
+        'posicoes_apagadas': len(apagar),
+        'posicoes_zeradas': len(zerar),
+        'material_desconhecido': int(desconhecido.sum()),
+        'quantidade_invalida': int((~desconhecido & ~valida).sum()),
+    }
+
+
+@app.cli.command('sincronizar-planilhas')
+@click.option('--skus', 'caminho_skus', default=PLANILHA_SKUS, show_default=True,
+              type=click.Path(exists=True, dir_okay=False), help='Planilha de SKUs exportada do ERP (xlsx ou csv).')
+@click.option('--estoque', 'caminho_estoque', default=PLANILHA_ESTOQUE, show_default=True,
+              type=click.Path(exists=True, dir_okay=False), help='Planilha de estoque exportada do ERP (xlsx ou csv).')
+@click.option('--forcar', is_flag=True, help='Sincroniza mesmo que as planilhas sejam iguais às da última vez.')
+@click.option('--simular', is_flag=True, help='Mostra as diferenças sem gravar nada.')
+def sincronizar_planilhas_command(caminho_skus, caminho_estoque, forcar, simular):
+    """Aplica à base só o que mudou nas planilhas do ERP desde a última sincronização."""
+    hashes = {'skus': sha256_arquivo(caminho_skus), 'estoque': sha256_arquivo(caminho_estoque)}
+    anteriores = dict(db.session.query(PlanilhaSincronizada.nome, PlanilhaSincronizada.sha256))
+    if not forcar and all(anteriores.get(nome) == sha for nome, sha in hashes.items()):
+        click.echo('Planilhas iguais às da última sincronização: nada a fazer (use --forcar para repetir).')
+        return
+
+    inicio = time.perf_counter()
+    try:
+        r = sincronizar_planilhas(caminho_skus, caminho_estoque)
+        if simular:
+            db.session.rollback()
+        else:
+            registrar_planilhas_sincronizadas(hashes)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    duracao = time.perf_counter() - inicio
+
+    click.echo(f"{'Simulação: ' if simular else ''}insumos: {r['insumos_novos']} novo(s), {r['insumos_alterados']} alterado(s), "
+               f"{r['insumos_ausentes']} ausente(s) da planilha (mantidos).")
+    click.echo(f"Posições de estoque: {r['posicoes_novas']} nova(s), {r['posicoes_alteradas']} alterada(s), "
+               f"{r['posicoes_apagadas']} apagada(s), {r['posicoes_zeradas']} zerada(s) por terem ajustes de inventário.")
+    click.echo(f"{r['linhas_skus'] + r['linhas_estoque']} linha(s) comparadas em {duracao:.2f}s "
+               f"({(r['linhas_skus'] + r['linhas_estoque']) / duracao:.0f} linhas/s); rejeitadas no estoque: "
+               f"{r['material_desconhecido']} com material fora da planilha de SKUs e {r['quantidade_invalida']} com quantidade inválida.")
+
+
+# --- EXPORTAÇÕES EM FLUXO (XLSX, CSV E PARQUET) ---
+FORMATOS_EXPORTACAO = ('xlsx', 'csv', 'parquet')
+MIMETYPES_EXPORTACAO = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def gerar_xlsx_em_disco(nome_folha, cabecalhos, linhas, amostra=200, arquivo=None):
+    """
+    Escreve um .xlsx com o openpyxl em modo write-only num ficheiro temporário (ou
+    no 'arquivo' binário indicado) e devolve-o posicionado no início. As linhas são
+    consumidas do iterável à medida que são escritas, por isso a memória não
+    depende do tamanho do relatório; a largura das colunas é estimada a partir
+    das primeiras 'amostra' linhas, já que tem de ser escrita antes delas.
+    """
+    linhas = iter(linhas)
+    primeiras = list(itertools.islice(linhas, amostra))
+
+    livro = Workbook(write_only=True)
+    folha = livro.create_sheet(nome_folha)
+    for idx, cabecalho in enumerate(cabecalhos):
+        largura = max([len(str(cabecalho))] + [len(str(linha[idx])) for linha in primeiras if linha[idx] is not None])
+        folha.column_dimensions[get_column_letter(idx + 1)].width = largura + 2 # um pouco de espaço extra
+
+    folha.append(cabecalhos)
+    for linha in itertools.chain(primeiras, linhas):
+        folha.append(linha)
+
+    arquivo = tempfile.TemporaryFile() if arquivo is None else arquivo
+    livro.save(arquivo)
+    arquivo.seek(0)
+    return arquivo
+
+
+def _em_lotes(linhas, tamanho):
+    linhas = iter(linhas)
+    while lote := list(itertools.islice(linhas, tamanho)):
+        yield lote
+
+
+def validar_formato_exportacao(formato):
+    """Resposta de erro para um ?format= inválido ou indisponível; None se puder ser gerado."""
+    if formato not in FORMATOS_EXPORTACAO:
+        return jsonify({'error': f"Formato inválido: use {', '.join(FORMATOS_EXPORTACAO)}."}), 400
+    if formato == 'parquet' and pq is None:
+        return jsonify({'error': 'Exportação em Parquet indisponível: o pacote pyarrow não está instalado.'}), 501
+    return None
+
+
+def _gerar_csv(cabecalhos, linhas):
+    buffer = StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(cabecalhos)
+    for lote in _em_lotes(linhas, app.config['EXPORTACAO_CSV_LINHAS_POR_BLOCO']):
+        escritor.writerows(lote)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gerar_parquet_em_disco(colunas, linhas, arquivo=None):
+    """
+    Escreve um ficheiro Parquet temporário (ou no 'arquivo' indicado), um row group
+    por lote de linhas, com o esquema das 'colunas' ((nome, tipo Python)). Células
+    vazias ('') das colunas não textuais ficam nulas. Devolve o ficheiro
+    posicionado no início.
+    """
+    tipos = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_(),
+             datetime: pa.timestamp('us'), date: pa.date32()}
+    esquema = pa.schema([(nome, tipos.get(tipo, pa.string())) for nome, tipo in colunas])
+    arquivo = tempfile.TemporaryFile() if arquivo is None else arquivo
+    with pq.ParquetWriter(arquivo, esquema) as escritor:
+        for lote in _em_lotes(linhas, app.config['EXPORTACAO_PARQUET_LINHAS_POR_GRUPO']):
+            valores = zip(*lote)
+            escritor.write_table(pa.Table.from_arrays([
+                pa.array(coluna if campo.type == pa.string() else [None if v == '' else v for v in coluna], type=campo.type)
+                for coluna, campo in zip(valores, esquema)
+            ], schema=esquema))
+    arquivo.seek(0)
+    return arquivo
+
+
+def responder_exportacao(formato, nome_arquivo, nome_folha, colunas, linhas):
+    """
+    Resposta de download de um relatório no formato pedido. 'colunas' é uma lista
+    de (nome, tipo Python) e 'linhas' um iterável de tuplas, consumido em fluxo:
+    o CSV é gerado à medida que é enviado; xlsx e Parquet são escritos em disco.
+    No CSV a sessão do pedido já foi fechada quando as linhas são lidas, por isso
+    'linhas' deve ser um gerador que só faz as suas consultas ao ser percorrido.
+    """
+    cabecalhos = [nome for nome, _ in colunas]
+    nome_completo = f'{nome_arquivo}_{datetime.now().strftime("%Y-%m-%d")}.{formato}'
+    if formato == 'csv':
+        resposta = app.response_class(stream_with_context(_gerar_csv(cabecalhos, linhas)), mimetype='text/csv')
+        resposta.headers['Content-Disposition'] = f'attachment; filename="{nome_completo}"'
+        return resposta
+    if formato == 'parquet':
+        return enviar_relatorio(gerar_parquet_em_disco(colunas, linhas), formato, nome_completo)
+    return enviar_relatorio(gerar_xlsx_em_disco(nome_folha, cabecalhos, linhas), formato, nome_completo)
+
+
+def gravar_exportacao(formato, nome_folha, colunas, linhas, arquivo):
+    """Escreve o relatório completo, no formato pedido, num ficheiro binário já aberto."""
+    cabecalhos = [nome for nome, _ in colunas]
+    if formato == 'csv':
+        for bloco in _gerar_csv(cabecalhos, linhas):
+            arquivo.write(bloco.encode('utf-8'))
+    elif formato == 'parquet':
+        gerar_parquet_em_disco(colunas, linhas, arquivo)
+    else:
+        gerar_xlsx_em_disco(nome_folha, cabecalhos, linhas, arquivo=arquivo)
+
+
+def enviar_relatorio(arquivo, formato, nome_download):
+    return send_file(arquivo, mimetype=MIMETYPES_EXPORTACAO[formato], as_attachment=True, download_name=nome_download)
+
+
+def parametros_exportacao(tipo, formato):
+    """
+    Filtros do relatório 'tipo' no pedido atual, com o formato já validado. Só entram
+    os filtros que o relatório usa, e não vazios: parâmetros alheios (como o '_' dos
+    pedidos anti-cache) não mudam a chave do ficheiro guardado.
+    """
+    filtros = RELATORIOS[tipo][2]
+    parametros = {chave: valor.strip() for chave, valor in request.args.items() if chave in filtros and valor.strip()}
+    return dict(parametros, format=formato)
+
+
+def responder_relatorio(tipo, formato):
+    """
+    Resposta das rotas de exportação: o ficheiro já gerado em segundo plano para o
+    mesmo pedido com os dados atuais, se existir; senão o relatório gerado agora.
+    None se o relatório estiver vazio.
+    """
+    parametros = parametros_exportacao(tipo, formato)
+    guardado = abrir_relatorio_guardado(chave_relatorio(tipo, parametros))
+    if guardado:
+        return enviar_relatorio(*guardado)
+    relatorio = RELATORIOS[tipo][0](parametros)
+    return None if relatorio is None else responder_exportacao(formato, *relatorio)
+
+
+# --- RELATÓRIOS EM SEGUNDO PLANO ---
+# Os pedidos a /api/relatorios/<tipo> só gravam a tarefa; um thread despachante por
+# worker (como na extração de PDF) gera o ficheiro em RELATORIOS_DIR. A chave do
+# ficheiro junta o tipo, os parâmetros, a versão dos dados e o dia (o estado
+# "Atrasado" das ordens depende da data): enquanto nada mudar, os pedidos iguais
+# recebem o ficheiro já gerado. A fila usa uma conexão própria, fora da sessão,
+# para não mexer na versão dos dados.
+_despachante_relatorios = {'pid': None, 'thread': None, 'evento': threading.Event()}
+_despachante_relatorios_lock = threading.Lock()
+
+# Incrementar quando mudar o conteúdo de algum relatório: invalida os ficheiros guardados
+FORMATO_RELATORIOS = 1
+
+
+def chave_relatorio(tipo, parametros, versao=None):
+    """SHA-256 que identifica um relatório: tipo, parâmetros, versão dos dados e dia."""
+    versao = versao_dados() if versao is None else versao
+    texto = f"{FORMATO_RELATORIOS}|{tipo}|{datetime.now().strftime('%Y-%m-%d')}|{versao}|{urlencode(sorted(parametros.items()))}"
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()
+
+
+def _caminho_relatorio(chave, formato):
+    return os.path.join(app.config['RELATORIOS_DIR'], f'{chave}.{formato}')
+
+
+def abrir_relatorio_guardado(chave):
+    """
+    Ficheiro já gerado para esta chave, aberto para leitura, com o formato e o nome
+    de download: (arquivo, formato, nome_download). None se não existir ou se já
+    tiver sido apagado pela limpeza.
+    """
+    tabela = TarefaRelatorio.__table__
+    with db.engine.connect() as conexao:
+        tarefa = conexao.execute(
+            select(tabela.c.formato, tabela.c.nome_download)
+            .where(tabela.c.chave == chave, tabela.c.status == 'CONCLUIDA')
+            .order_by(tabela.c.atualizado_em.desc()).limit(1)
+        ).first()
+    if tarefa is None:
+        return None
+    try:
+        return open(_caminho_relatorio(chave, tarefa.formato), 'rb'), tarefa.formato, tarefa.nome_download
+    except OSError:
+        return None
+
+
+def enfileirar_relatorio(tipo, parametros, usuario):
+    """
+    Devolve o id da tarefa que serve este pedido: uma já concluída (com o ficheiro
+    ainda em disco) ou em curso com a mesma chave, ou uma nova PENDENTE.
+    """
+    chave = chave_relatorio(tipo, parametros)
+    tabela = TarefaRelatorio.__table__
+    agora = datetime.utcnow()
+    with db.engine.begin() as conexao:
+        tarefas = conexao.execute(
+            select(tabela.c.id, tabela.c.status, tabela.c.formato)
+            .where(tabela.c.chave == chave, tabela.c.status != 'ERRO')
+            .order_by(tabela.c.criado_em.desc())
+        ).all()
+        for tarefa in tarefas:
+            if tarefa.status != 'CONCLUIDA' or os.path.exists(_caminho_relatorio(chave, tarefa.formato)):
+                return tarefa.id
+        tarefa_id = uuid.uuid4().hex
+        conexao.execute(insert(tabela).values(
+            id=tarefa_id, chave=chave, tipo=tipo, formato=parametros['format'],
+            parametros=json.dumps(parametros, ensure_ascii=False), status='PENDENTE',
+            tentativas=0, usuario=usuario, criado_em=agora, atualizado_em=agora
+        ))
+    return tarefa_id
+
+
+def _finalizar_relatorio(tarefa_id, status, **valores):
+    tabela = TarefaRelatorio.__table__
+    with db.engine.begin() as conexao:
+        conexao.execute(update(tabela).where(tabela.c.id == tarefa_id).values(
+            status=status, atualizado_em=datetime.utcnow(), **valores
+        ))
+
+
+def processar_proximo_relatorio():
+    """
+    Reclama o relatório pendente mais antigo e gera o ficheiro. Devolve False se a
+    fila estiver vazia. A chave é recalculada com a versão dos dados lida antes da
+    geração, para que o ficheiro sirva os pedidos feitos a partir deste momento.
+    """
+    tabela = TarefaRelatorio.__table__
+    agora = datetime.utcnow()
+    with db.engine.begin() as conexao:
+        # Tarefas de workers que morreram a meio voltam à fila
+        conexao.execute(update(tabela).where(
+            tabela.c.status == 'PROCESSANDO',
+            tabela.c.atualizado_em < agora - timedelta(seconds=app.config['RELATORIOS_TIMEOUT_SEGUNDOS'])
+        ).values(status='PENDENTE'))
+        tarefa_id = conexao.execute(
+            select(tabela.c.id).where(tabela.c.status == 'PENDENTE').order_by(tabela.c.criado_em).limit(1)
+        ).scalar()
+        if tarefa_id is None:
+            return False
+        reclamada = conexao.execute(
+            update(tabela).where(tabela.c.id == tarefa_id, tabela.c.status == 'PENDENTE')
+            .values(status='PROCESSANDO', tentativas=tabela.c.tentativas + 1, atualizado_em=agora)
+        ).rowcount
+        tarefa = conexao.execute(
+            select(tabela.c.tipo, tabela.c.formato, tabela.c.parametros, tabela.c.tentativas).where(tabela.c.id == tarefa_id)
+        ).first()
+    if not reclamada:
+        return True # outro worker ficou com ela; tenta a seguinte
+
+    if tarefa.tentativas > app.config['RELATORIOS_MAX_TENTATIVAS']:
+        _finalizar_relatorio(tarefa_id, 'ERRO', erro='O relatório excedeu o número máximo de tentativas de geração.')
+        return True
+    temporario = None
+    try:
+        parametros = json.loads(tarefa.parametros)
+        chave = chave_relatorio(tarefa.tipo, parametros)
+        montar, mensagem_vazio, *_ = RELATORIOS[tarefa.tipo]
+        relatorio = montar(parametros)
+        if relatorio is None:
+            _finalizar_relatorio(tarefa_id, 'VAZIO', chave=chave, erro=mensagem_vazio)
+            return True
+        nome_arquivo, nome_folha, colunas, linhas = relatorio
+
+        caminho = _caminho_relatorio(chave, tarefa.formato)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        temporario = f'{caminho}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporario, 'wb') as arquivo:
+            gravar_exportacao(tarefa.formato, nome_folha, colunas, linhas, arquivo)
+        os.replace(temporario, caminho) # escrita atómica entre workers
+        _finalizar_relatorio(
+            tarefa_id, 'CONCLUIDA', chave=chave,
+            nome_download=f'{nome_arquivo}_{datetime.now().strftime("%Y-%m-%d")}.{tarefa.formato}'
+        )
+        limpar_relatorios()
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERRO AO GERAR RELATÓRIO (tarefa {tarefa_id}): {e}")
+        traceback.print_exc()
+        _finalizar_relatorio(tarefa_id, 'ERRO', erro=f'Ocorreu um erro ao gerar o relatório: {e}')
+    finally:
+        db.session.close()
+        if temporario and os.path.exists(temporario):
+            os.remove(temporario)
+    return True
+
+
+def limpar_relatorios():
+    """
+    Apaga os ficheiros com mais de RELATORIOS_MAX_IDADE_SEGUNDOS e, dos restantes,
+    os mais antigos até o diretório caber em RELATORIOS_MAX_BYTES. As tarefas
+    terminadas há mais tempo que a idade máxima saem da fila.
+    """
+    diretorio = app.config['RELATORIOS_DIR']
+    limite = time.time() - app.config['RELATORIOS_MAX_IDADE_SEGUNDOS']
+    arquivos = []
+    try:
+        for entrada in os.scandir(diretorio):
+            try:
+                info = entrada.stat()
+                if info.st_mtime < limite:
+                    os.remove(entrada.path)
+                elif not entrada.name.endswith('.tmp'): # ficheiros ainda a ser gerados
+                    arquivos.append((info.st_mtime, info.st_size, entrada.path))
+            except OSError:
+                continue # apagado por outro worker entretanto
+    except OSError:
+        traceback.print_exc()
+        return
+
+    excesso = sum(tamanho for _, tamanho, _ in arquivos) - app.config['RELATORIOS_MAX_BYTES']
+    for _, tamanho, antigo in sorted(arquivos):
+        if excesso <= 0:
+            break
+        try:
+            os.remove(antigo)
+        except OSError:
+            pass
+        excesso -= tamanho
+
+    tabela = TarefaRelatorio.__table__
+    with db.engine.begin() as conexao:
+        conexao.execute(delete(tabela).where(
+            tabela.c.status.in_(('CONCLUIDA', 'VAZIO', 'ERRO')),
+            tabela.c.atualizado_em < datetime.utcnow() - timedelta(seconds=app.config['RELATORIOS_MAX_IDADE_SEGUNDOS'])
+        ))
+
+
+def _ciclo_despachante_relatorios():
+    evento = _despachante_relatorios['evento']
+    while True:
+        try:
+            with app.app_context():
+                while processar_proximo_relatorio():
+                    pass
+        except Exception:
+            traceback.print_exc()
+        evento.wait(app.config['RELATORIOS_INTERVALO_SEGUNDOS'])
+        evento.clear()
+
+
+def garantir_despachante_relatorios():
+    """Arranca o thread que gera os relatórios neste processo (também depois de um fork)."""
+    thread = _despachante_relatorios['thread']
+    if _despachante_relatorios['pid'] == os.getpid() and thread is not None and thread.is_alive():
+        return
+    with _despachante_relatorios_lock:
+        if _despachante_relatorios['pid'] != os.getpid():
+            _despachante_relatorios.update(pid=os.getpid(), thread=None, evento=threading.Event())
+        thread = _despachante_relatorios['thread']
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_ciclo_despachante_relatorios, name='despachante-relatorios', daemon=True)
+            _despachante_relatorios['thread'] = thread
+            thread.start()
+
+
 # --- INICIALIZAÇÃO DA BASE DE DADOS ---
 # Este bloco irá garantir que a base de dados e as tabelas sejam criadas
 # sempre que a aplicação iniciar, seja com Gunicorn no OnRender ou localmente.
 with app.app_context():
     db.create_all()
+    # create_all não acrescenta índices novos a tabelas já existentes
+    for _modelo in (Movimentacao, OrdemDeCompra, ItemDaOrdem, AjusteInventario):
+        for indice in _modelo.__table__.indexes:
+            indice.create(bind=db.engine, checkfirst=True)
+    remover_colunas_de_valor()
+    if 'uq_estoque_insumo_posicao' not in {i['name'] for i in inspect(db.engine).get_indexes('estoque')}:
+        unificar_posicoes_duplicadas()
+        for indice in Estoque.__table__.indexes:
+            indice.create(bind=db.engine, checkfirst=True)
+    for _contador in (1, 2):
+        if not db.session.get(VersaoDados, _contador):
+            db.session.add(VersaoDados(id=_contador, valor=0))
+    # Contador de SKUs: criado (ou adiantado) a partir dos SKUs já cadastrados
+    sincronizar_sequencia_sku()
+    # Setores iniciais; insumos e estoque são carregados com `flask importar-planilhas`
+    if not Setor.query.first():
+        db.session.execute(sqlite_insert(Setor).on_conflict_do_nothing(), [{'nome': nome} for nome in SETORES_INICIAIS])
+    db.session.commit()
+    # Bases criadas antes da tabela de saldos: popula a partir do Estoque
+    if not SaldoInsumo.query.first() and Estoque.query.first():
+        recalcular_saldos()
+    if not ConsumoDiario.query.first() and Movimentacao.query.filter_by(tipo='SAIDA').first():
+        consolidar_consumo_diario()
+    app.config['BUSCA_FTS_DISPONIVEL'] = criar_indices_busca()
+    if app.config['BUSCA_FTS_DISPONIVEL']:
+        # Índices novos ou dessincronizados (ex.: cargas em massa) são reconstruídos
+        for _tabela, _modelo in (('insumo_busca', Insumo), ('fornecedor_busca', Fornecedor)):
+            if db.session.execute(text(f"SELECT count(*) FROM {_tabela}")).scalar() != _modelo.query.count():
+                reconstruir_indice_busca(_tabela)
+        db.session.commit()
+    if app.config['CATALOGO_EM_MEMORIA']:
+        obter_catalogo()
     
-# --- ROTA PRINCIPAL E CARGA DE DADOS INICIAL ---
+# --- ROTA PRINCIPAL ---
 @app.route('/')
 def index():
     if 'user_id' not in session:
         return redirect(url_for('login'))   
     
-    with app.app_context():
-        # Executa a carga inicial apenas se a tabela de Insumos estiver vazia
-        if not Insumo.query.first():
-            print(">>> Base de dados vazia. A iniciar o carregamento inicial de dados...")
-            try:
-                # --- PASSO 1: Carregar o ficheiro de SKUs (CORRIGIDO PARA LER CSV) ---
-                # Usando os nomes exatos dos ficheiros que você enviou
-                df_sku = pd.read_excel('Dados limpos Insumos - SKU.xlsx')
-                mapa_insumos = {}
-                
-                print(">>> A processar o ficheiro de SKUs...")
-                for _, row in df_sku.iterrows():
-                    descricao = str(row.get('Material', '')).strip()
-                    if not descricao: continue
-
-                    sku_val = row.get('SKU')
-                    sku = None
-                    if pd.notna(sku_val) and str(sku_val).strip():
-                        try:
-                            sku = str(int(float(sku_val)))
-                        except (ValueError, TypeError):
-                            sku = str(sku_val).strip()
-
-                    estoque_minimo = pd.to_numeric(row.get('estoque_minimo'), errors='coerce')
-                    valor_unitario = pd.to_numeric(row.get('Valor Unit.'), errors='coerce')
-
-                    mapa_insumos[descricao.upper()] = {
-                        'sku': sku,
-                        'estoque_minimo': 0 if pd.isna(estoque_minimo) else int(estoque_minimo),
-                        'valor_unitario': 0.0 if pd.isna(valor_unitario) else float(valor_unitario)
-                    }
-
-                # --- PASSO 2: Criar todos os Insumos na base de dados ---
-                print(f">>> {len(mapa_insumos)} materiais únicos encontrados. A criar registos de Insumos...")
-                for desc_mapa, dados in mapa_insumos.items():
-                    if not dados['sku']:
-                        dados['sku'] = gerar_novo_sku()
-                        print(f"      - Material '{desc_mapa}' sem SKU. Gerado novo SKU: {dados['sku']}")
-
-                    insumo_existente = Insumo.query.filter_by(sku=dados['sku']).first()
-                    if not insumo_existente:
-                        novo_insumo = Insumo(
-                            descricao=desc_mapa.title(),
-                            sku=dados['sku'],
-                            valor_unitario=dados['valor_unitario'],
-                            estoque_minimo=dados['estoque_minimo'],
-                            unidade_medida='UN'
-                        )
-                        db.session.add(novo_insumo)
-                
-                db.session.commit()
-                print(">>> Insumos criados com sucesso!")
-
-                # --- PASSO 3: Carregar o ficheiro de Estoque (CORRIGIDO PARA LER CSV) ---
-                print(">>> A processar o ficheiro de Estoque...")
-                df_estoque = pd.read_excel('Dados limpos Insumos - ESTOQUE.xlsx')
-                posicoes_adicionadas = 0
-                for _, row in df_estoque.iterrows():
-                    descricao_estoque = str(row.get('Material')).strip().upper()
-                    if not descricao_estoque or descricao_estoque.lower() == 'nan': continue
-                    
-                    dados_mapa = mapa_insumos.get(descricao_estoque)
-                    if dados_mapa and dados_mapa.get('sku'):
-                        insumo_db = Insumo.query.filter_by(sku=dados_mapa['sku']).first()
-                        if insumo_db:
-                            quantidade = pd.to_numeric(row.get('Quantidade'), errors='coerce')
-                            if pd.notna(quantidade) and quantidade > 0:
-                                posicao_limpa = re.sub(r'\\s+', '', str(row.get('Posição', 'N/D')))
-                                novo_estoque = Estoque(
-                                    insumo_id=insumo_db.id,
-                                    posicao=posicao_limpa,
-                                    quantidade=float(quantidade)
-                                )
-                                db.session.add(novo_estoque)
-                                posicoes_adicionadas += 1
-                    else:
-                        print(f"      - AVISO: Material '{row.get('Material')}' do ficheiro de estoque não encontrado no mapa de SKUs. Posição ignorada.")
-
-                db.session.commit()
-                print(f">>> {posicoes_adicionadas} posições de estoque adicionadas com sucesso!")
-                print("\\n>>> CARGA DE DADOS INICIAL CONCLUÍDA! <<<\\n")
-
-            except FileNotFoundError:
-                print("\\nERRO CRÍTICO: Os ficheiros CSV de dados não foram encontrados.")
-            except Exception as e:
-                print(f"\\n>>> ERRO CRÍTICO DURANTE O CARREGAMENTO INICIAL: {e}")
-                traceback.print_exc()
-                db.session.rollback()
-
-    # --- Bloco 2: Popula os Setores ---
-    if not Setor.query.first():
-            print(">>> Base de dados de Setores vazia. A popular com dados iniciais...")
-            try:
-                setores_iniciais = ['Recebimento', 'Controle de Estoque', 'Reabastecimento', 'Picking', 'Expedição', 'Abastecimento de Lojas', 'ADM']
-                for nome_setor in setores_iniciais:
-                    db.session.add(Setor(nome=nome_setor))
-                db.session.commit()
-                print(">>> Setores cadastrados com sucesso!")
-            except Exception as e:
-                 print(f"\\n>>> ERRO AO CADASTRAR SETORES: {e}")
-                 db.session.rollback()
-    
     return render_template('index.html', username=session.get('username'))
 
 
@@ -376,8 +2521,7 @@ def get_posicao_estoque():
     
     if query_insumo:
         base_query = base_query.filter(
-            Insumo.descricao.ilike(f'%{query_insumo}%') | 
-            Insumo.sku.ilike(f'%{query_insumo}%')
+            condicao_busca_insumo(query_insumo, Insumo.id, Insumo.descricao, Insumo.sku)
         )
         
     if query_posicao_raw:
@@ -420,71 +2564,215 @@ def transferir_insumo():
     usuario = session.get('username', 'Sistema')
     
 
-    if not all([sku, posicao_origem_str, quantidade_transferir > 0, posicao_destino]):
-        return jsonify({'error': 'Todos os campos são obrigatórios.'}), 400
+    if not all([sku, posicao_origem_str, quantidade_transferir > 0, posicao_destino]):
+        return jsonify({'error': 'Todos os campos são obrigatórios.'}), 400
+
+    estoque_origem = db.session.query(Estoque).join(Insumo).filter(
+        Insumo.sku == sku,
+        Estoque.posicao == posicao_origem_str
+    ).first()
+
+    if not estoque_origem:
+        return jsonify({'error': f'Item com SKU {sku} na posição {posicao_origem_str} não encontrado.'}), 404
+    
+    if quantidade_transferir > estoque_origem.quantidade:
+        return jsonify({'error': 'Quantidade a transferir é maior que o disponível.'}), 400
+
+    insumo = estoque_origem.insumo
+
+    def registrar_transferencia():
+        setor_id_associado = None  # Variável para guardar o ID do setor
+
+        if posicao_destino.upper().startswith('SETOR-'):
+            nome_setor = posicao_destino.split('-', 1)[1]
+            setor = Setor.query.filter(func.lower(Setor.nome) == func.lower(nome_setor)).first()
+
+            if not setor:
+                # Se o setor não existe, criamos um novo para evitar erros
+                setor = Setor(nome=nome_setor.capitalize())
+                db.session.add(setor)
+                db.session.flush() # Para obter o ID do novo setor imediatamente
+
+            setor_id_associado = setor.id
+            tipo_movimentacao = 'SAIDA'
+            mensagem = f'Saída de {quantidade_transferir} do insumo {sku} para o setor {nome_setor} registada com sucesso.'
+        else:
+            tipo_movimentacao = 'TRANSFERENCIA'
+            mensagem = f'Transferência de {quantidade_transferir} do insumo {sku} de {posicao_origem_str} para {posicao_destino} realizada.'
+
+        # Débito condicional: se outro worker consumiu o saldo entretanto, nada é alterado
+        if not debitar_estoque(insumo.id, posicao_origem_str, quantidade_transferir):
+            return jsonify({'error': 'Quantidade a transferir é maior que o disponível.'}), 400
+        if tipo_movimentacao == 'SAIDA':
+            atualizar_saldo_insumo(insumo, -quantidade_transferir)
+        else:
+            creditar_estoque(insumo.id, posicao_destino, quantidade_transferir)
+
+        mov = Movimentacao(
+            insumo_id=insumo.id,
+            setor_id=setor_id_associado, # <-- PONTO-CHAVE: Guardamos o ID do setor aqui!
+            quantidade=quantidade_transferir,
+            tipo=tipo_movimentacao,
+            posicao_origem=posicao_origem_str,
+            posicao_destino=posicao_destino,
+            usuario=usuario,
+            data_hora=datetime.utcnow()
+        )
+        db.session.add(mov)
+        if tipo_movimentacao == 'SAIDA':
+            registrar_consumo_diario(mov, insumo)
+        return jsonify({'message': mensagem})
+
+    try:
+        return executar_escrita(registrar_transferencia)
+    except Exception as e:
+        db.session.rollback()
+        traceback.print_exc()
+        return jsonify({'error': f'Erro ao salvar a transferência: {e}'}), 500
+
 
-    estoque_origem = db.session.query(Estoque).join(Insumo).filter(
-        Insumo.sku == sku,
-        Estoque.posicao == posicao_origem_str
-    ).first()
+@app.route('/api/transferencias/lote', methods=['POST'])
+def transferir_insumos_lote():
+    """
+    Aplica uma lista de transferências/saídas numa única transação.
+    Corpo: {"itens": [{"sku", "posicao_origem", "qtd", "destino"}, ...], "dry_run": false}
+    Insumos, posições e setores são resolvidos com uma consulta por tabela. As linhas
+    são validadas em sequência (uma linha vê o efeito das anteriores); se alguma
+    falhar nada é gravado. Com "dry_run" apenas valida e devolve o resultado por linha.
+    """
+    data = request.get_json(silent=True) or {}
+    itens = data.get('itens')
+    dry_run = bool(data.get('dry_run'))
+    usuario = session.get('username', 'Sistema')
 
-    if not estoque_origem:
-        return jsonify({'error': f'Item com SKU {sku} na posição {posicao_origem_str} não encontrado.'}), 404
-    
-    if quantidade_transferir > estoque_origem.quantidade:
-        return jsonify({'error': 'Quantidade a transferir é maior que o disponível.'}), 400
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'error': 'Envie a lista de transferências em "itens".'}), 400
+    if len(itens) > app.config['TRANSFERENCIA_LOTE_MAX_ITENS']:
+        return jsonify({'error': f'O lote excede o máximo de {app.config["TRANSFERENCIA_LOTE_MAX_ITENS"]} linhas.'}), 400
 
-    insumo_id = estoque_origem.insumo_id
-    setor_id_associado = None  # Variável para guardar o ID do setor
+    # 1. Normaliza as linhas (mesmas regras da rota unitária)
+    linhas = []
+    for item in itens:
+        item = item if isinstance(item, dict) else {}
+        try:
+            quantidade = float(item.get('qtd', 0) or 0)
+        except (TypeError, ValueError):
+            quantidade = 0
+        linhas.append({
+            'sku': item.get('sku'),
+            'origem': item.get('posicao_origem'),
+            'qtd': quantidade,
+            'destino': str(item.get('destino') or '').strip().upper(),
+        })
 
-    if posicao_destino.upper().startswith('SETOR-'):
-        nome_setor = posicao_destino.split('-', 1)[1]
-        setor = Setor.query.filter(func.lower(Setor.nome) == func.lower(nome_setor)).first()
-        
-        if not setor:
-            # Se o setor não existe, criamos um novo para evitar erros
-            setor = Setor(nome=nome_setor.capitalize())
-            db.session.add(setor)
-            db.session.flush() # Para obter o ID do novo setor imediatamente
-        
-        setor_id_associado = setor.id
-        estoque_origem.quantidade -= quantidade_transferir
-        tipo_movimentacao = 'SAIDA'
-        mensagem = f'Saída de {quantidade_transferir} do insumo {sku} para o setor {nome_setor} registada com sucesso.'
-    else:
-        estoque_destino = Estoque.query.filter_by(insumo_id=insumo_id, posicao=posicao_destino).first()
-        if not estoque_destino:
-            estoque_destino = Estoque(insumo_id=insumo_id, posicao=posicao_destino, quantidade=0)
-            db.session.add(estoque_destino)
-        
-        estoque_origem.quantidade -= quantidade_transferir
-        estoque_destino.quantidade += quantidade_transferir
-        tipo_movimentacao = 'TRANSFERENCIA'
-        mensagem = f'Transferência de {quantidade_transferir} do insumo {sku} de {posicao_origem_str} para {posicao_destino} realizada.'
-
-    if estoque_origem.quantidade <= 0:
-        db.session.delete(estoque_origem)
-
-    mov = Movimentacao(
-        insumo_id=insumo_id,
-        setor_id=setor_id_associado, # <-- PONTO-CHAVE: Guardamos o ID do setor aqui!
-        quantidade=quantidade_transferir,
-        tipo=tipo_movimentacao,
-        posicao_origem=posicao_origem_str,
-        posicao_destino=posicao_destino,
-        usuario=usuario,
-        data_hora=datetime.utcnow()
-        
-    )
-    db.session.add(mov)
+    # 2. Consultas em conjunto: insumos, todas as suas posições e setores de destino
+    skus = {l['sku'] for l in linhas if l['sku']}
+    insumos = {i.sku: i for i in Insumo.query.filter(Insumo.sku.in_(skus)).all()} if skus else {}
+    estoques = {}
+    if insumos:
+        for e in Estoque.query.filter(Estoque.insumo_id.in_([i.id for i in insumos.values()])).order_by(Estoque.id):
+            estoques.setdefault((e.insumo_id, e.posicao), e)
+    nomes_setor = {l['destino'].split('-', 1)[1].lower() for l in linhas if l['destino'].startswith('SETOR-')}
+    setores = {
+        s.nome.lower(): s
+        for s in Setor.query.filter(func.lower(Setor.nome).in_(nomes_setor)).all()
+    } if nomes_setor else {}
+
+    # 3. Validação sequencial sobre as quantidades disponíveis, sem tocar na sessão
+    disponivel = {chave: e.quantidade for chave, e in estoques.items()}
+    resultados, erros = [], 0
+    for n, l in enumerate(linhas, start=1):
+        resultado = {'linha': n, 'sku': l['sku']}
+        resultados.append(resultado)
+        insumo = insumos.get(l['sku'])
+        chave_origem = (insumo.id, l['origem']) if insumo else None
+
+        if not all([l['sku'], l['origem'], l['qtd'] > 0, l['destino']]):
+            resultado['erro'] = 'Todos os campos são obrigatórios.'
+        elif chave_origem not in disponivel:
+            resultado['erro'] = f'Item com SKU {l["sku"]} na posição {l["origem"]} não encontrado.'
+        elif l['qtd'] > disponivel[chave_origem]:
+            resultado['erro'] = 'Quantidade a transferir é maior que o disponível.'
+        if 'erro' in resultado:
+            erros += 1
+            continue
+
+        l['insumo'] = insumo
+        disponivel[chave_origem] -= l['qtd']
+        if l['destino'].startswith('SETOR-'):
+            nome_setor = l['destino'].split('-', 1)[1]
+            l['setor'] = nome_setor
+            resultado['tipo'] = 'SAIDA'
+            resultado['mensagem'] = f'Saída de {l["qtd"]} do insumo {l["sku"]} para o setor {nome_setor} registada com sucesso.'
+        else:
+            chave_destino = (insumo.id, l['destino'])
+            disponivel[chave_destino] = disponivel.get(chave_destino, 0) + l['qtd']
+            resultado['tipo'] = 'TRANSFERENCIA'
+            resultado['mensagem'] = f'Transferência de {l["qtd"]} do insumo {l["sku"]} de {l["origem"]} para {l["destino"]} realizada.'
+        # Uma posição esvaziada deixa de existir, como na rota unitária
+        if disponivel[chave_origem] <= 0:
+            del disponivel[chave_origem]
+
+    resposta = {'dry_run': dry_run, 'total': len(linhas), 'erros': erros, 'resultados': resultados}
+    if erros:
+        resposta['error'] = f'{erros} linha(s) com erro. Nenhuma transferência foi gravada.'
+        return jsonify(resposta), 400
+    if dry_run:
+        resposta['message'] = f'{len(linhas)} linha(s) válidas. Nada foi gravado (dry-run).'
+        return jsonify(resposta)
+
+    # 4. Aplicação: uma única transação e um único commit para o lote inteiro
+    def registrar_lote():
+        novos_setores = {}
+        for l in linhas:
+            nome = l.get('setor')
+            if nome and nome.lower() not in setores and nome.lower() not in novos_setores:
+                novos_setores[nome.lower()] = Setor(nome=nome.capitalize())
+        if novos_setores:
+            db.session.add_all(novos_setores.values())
+            db.session.flush() # Para obter os IDs dos novos setores
+
+        agora = datetime.utcnow()
+        for n, l in enumerate(linhas, start=1):
+            insumo = l['insumo']
+            # Débitos condicionais: se outro worker mexeu no saldo desde a validação, o lote é desfeito
+            if not debitar_estoque(insumo.id, l['origem'], l['qtd']):
+                resultados[n - 1] = {'linha': n, 'sku': l['sku'], 'erro': 'Quantidade a transferir é maior que o disponível.'}
+                resposta.update(erros=1, error='O estoque mudou durante a gravação. Nenhuma transferência foi gravada.')
+                return jsonify(resposta), 409
+            setor_id_associado = None
+            if 'setor' in l:
+                setor = setores.get(l['setor'].lower()) or novos_setores[l['setor'].lower()]
+                setor_id_associado = setor.id
+                atualizar_saldo_insumo(insumo, -l['qtd'])
+                tipo_movimentacao = 'SAIDA'
+            else:
+                creditar_estoque(insumo.id, l['destino'], l['qtd'])
+                tipo_movimentacao = 'TRANSFERENCIA'
+
+            mov = Movimentacao(
+                insumo_id=insumo.id,
+                setor_id=setor_id_associado,
+                quantidade=l['qtd'],
+                tipo=tipo_movimentacao,
+                posicao_origem=l['origem'],
+                posicao_destino=l['destino'],
+                usuario=usuario,
+                data_hora=agora
+            )
+            db.session.add(mov)
+            if tipo_movimentacao == 'SAIDA':
+                registrar_consumo_diario(mov, insumo)
+
+        resposta['message'] = f'{len(linhas)} movimentação(ões) registada(s) com sucesso.'
+        return jsonify(resposta)
 
     try:
-        db.session.commit()
-        return jsonify({'message': mensagem})
+        return executar_escrita(registrar_lote)
     except Exception as e:
         db.session.rollback()
         traceback.print_exc()
-        return jsonify({'error': f'Erro ao salvar a transferência: {e}'}), 500
+        return jsonify({'error': f'Erro ao salvar as transferências: {e}'}), 500
 
 
 @app.route('/api/insumos/sku/<sku>')
@@ -698,6 +2986,7 @@ def api_setores():
     return jsonify([{'id': s.id, 'nome': s.nome} for s in setores])
 
 @app.route('/api/setores/<int:id>/analytics', methods=['GET'])
+@cache_de_resposta
 def api_setor_analytics(id):
     """ 
     Rota que calcula e retorna os dados analíticos para um setor específico.
@@ -705,68 +2994,76 @@ def api_setor_analytics(id):
     """
     setor = Setor.query.get_or_404(id)
 
-    # 1. Busca todas as movimentações de SAÍDA para este setor
-    movimentacoes_do_setor = Movimentacao.query.filter_by(
-        setor_id=setor.id, 
-        tipo='SAIDA'
-    ).order_by(Movimentacao.data_hora.desc()).all()
-
-    # --- A partir daqui, todos os cálculos são feitos em Python ---
+    # Todas as consultas abaixo são limitadas ou agregadas na base de dados,
+    # para que o custo não cresça com o histórico do setor.
+    filtro_saidas_setor = (Movimentacao.setor_id == setor.id, Movimentacao.tipo == 'SAIDA')
+
+    # 1. e 2. Busca apenas as 50 SAÍDAs mais recentes, já juntas ao insumo
+    historico_query = db.session.query(
+        Movimentacao.data_hora,
+        Movimentacao.quantidade,
+        Insumo.descricao,
+        Insumo.unidade_medida,
+        Insumo.valor_unitario
+    ).join(Insumo, Insumo.id == Movimentacao.insumo_id)\
+     .filter(*filtro_saidas_setor)\
+     .order_by(Movimentacao.data_hora.desc(), Movimentacao.id.desc()).limit(50).all()
 
-    # 2. Prepara os dados para o histórico (os 50 mais recentes)
     historico_formatado = []
     # Define os fusos horários uma única vez
     utc_tz = pytz.utc
     sao_paulo_tz = pytz.timezone('America/Sao_Paulo')
 
-    for mov in movimentacoes_do_setor[:50]:
-        insumo = mov.insumo
-        if insumo:
-            # --- LÓGICA DE CONVERSÃO DE FUSO HORÁRIO ---
-            # Converte a data/hora de UTC para o fuso horário de São Paulo
-            data_utc = mov.data_hora.replace(tzinfo=utc_tz)
-            data_local = data_utc.astimezone(sao_paulo_tz)
-            # -------------------------------------------
-
-            historico_formatado.append({
-                'data': data_local.strftime('%d/%m/%Y %H:%M'), # Usa a data local formatada
-                'descricao_insumo': insumo.descricao,
-                'quantidade': mov.quantidade,
-                'unidade': insumo.unidade_medida,
-                'valor_unitario': insumo.valor_unitario or 0,
-                'valor_total': mov.quantidade * (insumo.valor_unitario or 0)
-            })
-    # 3. Calcula os Insumos mais consumidos (Top 5 por valor)
-    consumo_por_insumo = {}
-    for mov in movimentacoes_do_setor: # Usa todos os dados para os cálculos
-        if mov.insumo:
-            valor_mov = mov.quantidade * (mov.insumo.valor_unitario or 0)
-            dados = consumo_por_insumo.get(mov.insumo.id, {'valor_total': 0, 'quantidade_total': 0})
-            consumo_por_insumo[mov.insumo.id] = {
-                'descricao': mov.insumo.descricao,
-                'unidade': mov.insumo.unidade_medida,
-                'valor_total': dados['valor_total'] + valor_mov,
-                'quantidade_total': dados['quantidade_total'] + mov.quantidade,
-            }
-    top_5_insumos = sorted(consumo_por_insumo.values(), key=lambda x: x['valor_total'], reverse=True)[:5]
+    for data_hora, quantidade, descricao, unidade, valor_unitario in historico_query:
+        # --- LÓGICA DE CONVERSÃO DE FUSO HORÁRIO ---
+        # Converte a data/hora de UTC para o fuso horário de São Paulo
+        data_utc = data_hora.replace(tzinfo=utc_tz)
+        data_local = data_utc.astimezone(sao_paulo_tz)
+        # -------------------------------------------
+
+        historico_formatado.append({
+            'data': data_local.strftime('%d/%m/%Y %H:%M'), # Usa a data local formatada
+            'descricao_insumo': descricao,
+            'quantidade': quantidade,
+            'unidade': unidade,
+            'valor_unitario': valor_unitario or 0,
+            'valor_total': quantidade * (valor_unitario or 0)
+        })
+    # 3. Calcula os Insumos mais consumidos (Top 5 por valor) a partir do consumo diário consolidado
+    fonte = fonte_consumo()
+    valor_consumido = func.sum(fonte.c.quantidade * func.coalesce(Insumo.valor_unitario, 0))
+    top_5_query = db.session.query(
+        Insumo.descricao,
+        Insumo.unidade_medida,
+        valor_consumido,
+        func.sum(fonte.c.quantidade)
+    ).join(fonte, fonte.c.insumo_id == Insumo.id)\
+     .filter(fonte.c.setor_id == setor.id)\
+     .group_by(Insumo.id)\
+     .order_by(valor_consumido.desc(), func.max(fonte.c.dia).desc()).limit(5).all()
+    top_5_insumos = [
+        {'descricao': descricao, 'unidade': unidade, 'valor_total': valor_total, 'quantidade_total': quantidade_total}
+        for descricao, unidade, valor_total, quantidade_total in top_5_query
+    ]
     
     # 4. Calcula o Consumo Mês a Mês (para o gráfico)
-    consumo_mensal_dict = {}
-    for mov in movimentacoes_do_setor:
-        if mov.insumo:
-            mes = mov.data_hora.strftime('%Y-%m')
-            valor_mov = mov.quantidade * (mov.insumo.valor_unitario or 0)
-            consumo_mensal_dict[mes] = consumo_mensal_dict.get(mes, 0) + valor_mov
+    mes = func.strftime('%Y-%m', fonte.c.dia)
+    consumo_mensal_query = db.session.query(mes, valor_consumido)\
+        .join(Insumo, Insumo.id == fonte.c.insumo_id)\
+        .filter(fonte.c.setor_id == setor.id)\
+        .group_by(mes).order_by(mes).all()
     
-    consumo_mensal_labels = sorted(consumo_mensal_dict.keys())
-    consumo_mensal_data = [consumo_mensal_dict[mes] for mes in consumo_mensal_labels]
+    consumo_mensal_labels = [row[0] for row in consumo_mensal_query]
+    consumo_mensal_data = [row[1] for row in consumo_mensal_query]
     
-    # 5. Calcula o Consumo médio diário
+    # 5. Calcula o Consumo médio diário (intervalo de datas via MIN/MAX)
     consumo_medio_diario = 0
-    if movimentacoes_do_setor:
-        consumo_total_periodo = sum(m.quantidade * (m.insumo.valor_unitario or 0) for m in movimentacoes_do_setor if m.insumo)
-        data_inicio = min(m.data_hora for m in movimentacoes_do_setor)
-        data_fim = max(m.data_hora for m in movimentacoes_do_setor)
+    data_inicio, data_fim = db.session.query(
+        func.min(Movimentacao.data_hora),
+        func.max(Movimentacao.data_hora)
+    ).filter(*filtro_saidas_setor).one()
+    if data_inicio is not None:
+        consumo_total_periodo = sum(consumo_mensal_data)
         dias = (data_fim - data_inicio).days if data_fim > data_inicio else 1
         consumo_medio_diario = consumo_total_periodo / max(dias, 1)
 
@@ -783,14 +3080,17 @@ def api_setor_analytics(id):
     })
 
 
-@app.route('/api/estoque/exportar', methods=['GET'])
-def exportar_estoque_excel():
+def relatorio_estoque(parametros):
     """
-    Gera um relatório completo do estoque em formato .xlsx e
-    o disponibiliza para download.
+    Relatório completo do estoque: (nome_arquivo, nome_folha, colunas, linhas), ou
+    None se não houver itens. As linhas vêm da consulta em blocos (yield_per) e só
+    são lidas ao percorrer o gerador: a memória usada não cresce com o estoque.
     """
-    try:
-        # 1. Busca todos os itens do estoque, juntando com os dados dos insumos
+    if db.session.query(Estoque.id).join(Insumo).first() is None:
+        return None
+
+    # Busca todos os itens do estoque, juntando com os dados dos insumos
+    def linhas_estoque():
         query = db.session.query(
             Insumo.sku,
             Insumo.descricao,
@@ -798,52 +3098,31 @@ def exportar_estoque_excel():
             Estoque.quantidade,
             Insumo.unidade_medida,
             Insumo.valor_unitario
-        ).join(Estoque).order_by(Insumo.descricao, Estoque.posicao).all()
+        ).join(Estoque).order_by(Insumo.descricao, Estoque.posicao).yield_per(1000)
+        for sku, descricao, posicao, qtd, um, vlr_unit in query:
+            yield sku, descricao, posicao, qtd, um, vlr_unit, qtd * (vlr_unit or 0)
 
-        if not query:
-            return jsonify({'message': 'Nenhum item no estoque para exportar.'}), 404
+    colunas = [('SKU', str), ('NOME DO INSUMO', str), ('POSIÇÃO', str), ('QUANTIDADE', float),
+               ('UNIDADE', str), ('VALOR UNITÁRIO', float), ('VALOR TOTAL', float)]
+    return 'relatorio_estoque', 'Estoque', colunas, linhas_estoque()
 
-        # 2. Prepara os dados para o DataFrame do Pandas
-        export_data = []
-        for sku, descricao, posicao, qtd, um, vlr_unit in query:
-            valor_total = qtd * (vlr_unit or 0)
-            export_data.append({
-                'SKU': sku,
-                'NOME DO INSUMO': descricao,
-                'POSIÇÃO': posicao,
-                'QUANTIDADE': qtd,
-                'UNIDADE': um,
-                'VALOR UNITÁRIO': vlr_unit,
-                'VALOR TOTAL': valor_total
-            })
-        
-        # 3. Cria o DataFrame e o ficheiro Excel em memória
-        df = pd.DataFrame(export_data)
-        
-        output = BytesIO()
-        # Usa o 'ExcelWriter' para formatar os números e auto-ajustar as colunas
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Estoque')
-            
-            # Formatação (opcional, mas melhora a leitura)
-            worksheet = writer.sheets['Estoque']
-            for idx, col in enumerate(df):  # itera sobre as colunas do df
-                series = df[col]
-                max_len = max((
-                    series.astype(str).map(len).max(),
-                    len(str(series.name))
-                )) + 2  # adiciona um pouco de espaço extra
-                worksheet.column_dimensions[chr(65 + idx)].width = max_len # auto-ajuste da largura
-
-        output.seek(0)
-        
-        # 4. Envia o ficheiro para o utilizador
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'relatorio_estoque_{datetime.now().strftime("%Y-%m-%d")}.xlsx'
-        )
+
+@app.route('/api/estoque/exportar', methods=['GET'])
+def exportar_estoque_excel():
+    """
+    Gera um relatório completo do estoque (xlsx por omissão; ?format=csv ou
+    parquet) e o disponibiliza para download.
+    """
+    formato = request.args.get('format', 'xlsx').lower()
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        return erro
+
+    try:
+        resposta = responder_relatorio('estoque', formato)
+        if resposta is None:
+            return jsonify({'message': 'Nenhum item no estoque para exportar.'}), 404
+        return resposta
 
     except Exception as e:
         print(f"Erro ao exportar Excel: {e}")
@@ -857,8 +3136,9 @@ def exportar_estoque_excel():
 def extrair_dados_pdf():
     """
     Extrai dados de um arquivo PDF de nota fiscal.
-    VERSÃO FINAL 3.0: Após encontrar um insumo existente pelo SKU, retorna a 
-    descrição limpa da base de dados em vez da descrição do PDF.
+    Com PDF_TAREFAS_ASSINCRONAS, apenas enfileira a extração e responde 202 com o
+    id da tarefa; o resultado é consultado em /api/recebimento/upload-pdf/<tarefa_id>.
+    Um PDF já extraído antes (cache por SHA-256) é respondido de imediato (200).
     """
     if 'pdf_file' not in request.files:
         return jsonify({'error': 'Nenhum ficheiro PDF foi enviado.'}), 400
@@ -867,126 +3147,101 @@ def extrair_dados_pdf():
         return jsonify({'error': 'Nome de ficheiro inválido.'}), 400
 
     try:
-        text_completo = ''
-        todas_as_tabelas = []
-        with pdfplumber.open(file) as pdf:
-            for page in pdf.pages:
-                text_completo += page.extract_text(x_tolerance=2) or ''
-                page_tables = page.extract_tables()
-                if page_tables:
-                    todas_as_tabelas.extend(page_tables)
-        
-        # Lógica para extrair fornecedor e número do documento...
-        fornecedor_sugerido, numero_documento_sugerido = None, ''
-        cnpj_matches = re.findall(r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})', text_completo)
-        if cnpj_matches:
-            for cnpj_str in cnpj_matches:
-                cnpj_limpo = re.sub(r'[./-]', '', cnpj_str)
-                fornecedor = Fornecedor.query.filter_by(cnpj=cnpj_limpo).first()
-                if fornecedor:
-                    fornecedor_sugerido = {'id': fornecedor.id, 'text': fornecedor.razao_social}
-                    break
-        
-        numero_doc_match = re.search(r'N[º°]\.?\s*([\d\.-]+)', text_completo, re.IGNORECASE)
-        if numero_doc_match:
-            numero_documento_sugerido = numero_doc_match.group(1).replace('.', '').replace('-', '')
+        conteudo = file.read()
+        # PDF já visto (mesmo SHA-256): só a correspondência com o catálogo é refeita
+        dados_brutos = ler_cache_pdf(hashlib.sha256(conteudo).hexdigest())
+        if dados_brutos is not None:
+            return jsonify(interpretar_dados_pdf(dados_brutos))
+
+        if app.config['PDF_TAREFAS_ASSINCRONAS']:
+            tarefa_id = enfileirar_tarefa_pdf(conteudo, file.filename, session.get('username', 'Sistema'))
+            return jsonify({
+                'tarefa_id': tarefa_id,
+                'status': 'PENDENTE',
+                'url_status': url_for('consultar_tarefa_pdf', tarefa_id=tarefa_id)
+            }), 202
+
+        return jsonify(interpretar_dados_pdf(extrair_dados_brutos_pdf(conteudo)))
+
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERRO CRÍTICO AO PROCESSAR PDF: {e}")
+        traceback.print_exc()
+        return jsonify({'error': f'Ocorreu um erro inesperado ao ler o ficheiro PDF: {e}'}), 500
 
 
-        # --- LÓGICA DE PROCESSAMENTO DE ITENS REFINADA ---
-        itens_sugeridos = []
-        novos_produtos_criados = 0
-        
-        for tabela in todas_as_tabelas:
-            if not tabela or not tabela[0]: continue
+@app.route('/api/recebimento/upload-pdf/<tarefa_id>', methods=['GET'])
+def consultar_tarefa_pdf(tarefa_id):
+    """Estado de uma extração de PDF; quando CONCLUIDA inclui os dados extraídos."""
+    tabela = TarefaExtracaoPdf.__table__
+    with db.engine.connect() as conexao:
+        tarefa = conexao.execute(
+            select(tabela.c.status, tabela.c.resultado, tabela.c.erro, tabela.c.nome_arquivo, tabela.c.criado_em)
+            .where(tabela.c.id == tarefa_id)
+        ).first()
+    if not tarefa:
+        return jsonify({'error': 'Tarefa de extração não encontrada.'}), 404
+
+    resposta = {
+        'tarefa_id': tarefa_id,
+        'status': tarefa.status,
+        'nome_arquivo': tarefa.nome_arquivo,
+        'criado_em': tarefa.criado_em.isoformat()
+    }
+    if tarefa.status == 'CONCLUIDA':
+        resposta.update(json.loads(tarefa.resultado))
+    elif tarefa.status == 'ERRO':
+        resposta['error'] = tarefa.erro
+    return jsonify(resposta)
+
+
+@app.route('/api/recebimento/upload-xml', methods=['POST'])
+def extrair_dados_xml():
+    """
+    Importa o XML da NF-e, alternativa determinística e muito mais barata à
+    leitura do PDF; responde no mesmo formato de /api/recebimento/upload-pdf.
+    Um ZIP com vários XMLs (cargas em lote) devolve {'notas': [...]}, com o
+    resultado ou o erro de cada ficheiro.
+    """
+    if 'xml_file' not in request.files:
+        return jsonify({'error': 'Nenhum ficheiro XML foi enviado.'}), 400
+    file = request.files['xml_file']
+    if file.filename == '':
+        return jsonify({'error': 'Nome de ficheiro inválido.'}), 400
 
-            header_processado = [str(h).replace('\n', ' ').strip().upper() if h else '' for h in tabela[0]]
-            
-            idx_desc, idx_qtd, idx_vlr_unit, idx_sku_col = -1, -1, -1, -1
-            for i, h in enumerate(header_processado):
-                if 'DESCRI' in h: idx_desc = i
-                elif 'QTD' in h or 'QUANT' in h: idx_qtd = i
-                elif 'UNIT' in h: idx_vlr_unit = i
-                elif 'SKU' in h or 'CÓD' in h: idx_sku_col = i
-
-            if not (idx_desc != -1 and idx_qtd != -1 and idx_vlr_unit != -1):
-                continue
-            
-            for linha_dados in tabela[1:]:
-                if not linha_dados or len(linha_dados) <= max(idx_desc, idx_qtd, idx_vlr_unit): continue
-                
-                descricao_pdf = str(linha_dados[idx_desc] or '').replace('\n', ' ').strip()
-                if not descricao_pdf: continue
-                
+    try:
+        if not zipfile.is_zipfile(file.stream):
+            file.stream.seek(0)
+            return jsonify(interpretar_nfe_xml(file.stream))
+
+        with zipfile.ZipFile(file.stream) as arquivo_zip:
+            nomes = [n for n in arquivo_zip.namelist()
+                     if n.lower().endswith('.xml') and not n.startswith('__MACOSX/')]
+            if not nomes:
+                return jsonify({'error': 'O ZIP não contém ficheiros XML.'}), 400
+            if len(nomes) > app.config['NFE_ZIP_MAX_ARQUIVOS']:
+                return jsonify({'error': f"O ZIP excede o limite de {app.config['NFE_ZIP_MAX_ARQUIVOS']} notas."}), 400
+
+            notas = []
+            for nome in nomes:
                 try:
-                    qtd_str = str(linha_dados[idx_qtd] or '0').replace('.', '').replace(',', '.')
-                    vlr_unit_str = str(linha_dados[idx_vlr_unit] or '0').replace('.', '').replace(',', '.')
-                    quantidade_doc = float(qtd_str)
-                    valor_unit = float(vlr_unit_str)
-                except (ValueError, TypeError): continue
-
-                insumo_encontrado = None
-                foi_criado_agora = False
-
-                # Lógica de busca por prioridade...
-                if idx_sku_col != -1 and len(linha_dados) > idx_sku_col:
-                    sku_pdf = str(linha_dados[idx_sku_col] or '').strip()
-                    if sku_pdf: insumo_encontrado = Insumo.query.filter_by(sku=sku_pdf).first()
-                
-                if not insumo_encontrado:
-                    match = re.search(r'\b(\d{8})\b', descricao_pdf)
-                    if match:
-                        sku_pescado = match.group(1)
-                        insumo_encontrado = Insumo.query.filter_by(sku=sku_pescado).first()
-                
-                if not insumo_encontrado:
-                    insumo_encontrado = Insumo.query.filter(Insumo.descricao.ilike(descricao_pdf)).first()
-                
-                if not insumo_encontrado:
-                    sku_para_novo_insumo = (re.search(r'\b(\d{8})\b', descricao_pdf).group(1) if re.search(r'\b(\d{8})\b', descricao_pdf) else gerar_novo_sku())
-                    if Insumo.query.filter_by(sku=sku_para_novo_insumo).first(): sku_para_novo_insumo = gerar_novo_sku()
-
-                    print(f"AVISO: Insumo '{descricao_pdf}' não encontrado. Criando novo com SKU: {sku_para_novo_insumo}...")
-                    novo_insumo = Insumo(descricao=descricao_pdf.title(), sku=sku_para_novo_insumo, valor_unitario=valor_unit)
-                    db.session.add(novo_insumo)
-                    db.session.flush()
-                    insumo_encontrado = novo_insumo
-                    novos_produtos_criados += 1
-                    foi_criado_agora = True
-                
-                # *** PONTO-CHAVE DA CORREÇÃO ***
-                # Usa a descrição do insumo encontrado na base de dados, não a do PDF.
-                itens_sugeridos.append({
-                    'insumo_id': insumo_encontrado.id,
-                    'descricao': insumo_encontrado.descricao, # <-- USA A DESCRIÇÃO DO BANCO DE DADOS
-                    'quantidade_documento': quantidade_doc,
-                    'valor_unitario': valor_unit,
-                    'unidade_medida': insumo_encontrado.unidade_medida,
-                    'novo': foi_criado_agora
-                })
-            
-            if itens_sugeridos: break
+                    with arquivo_zip.open(nome) as conteudo:
+                        notas.append(dict(interpretar_nfe_xml(conteudo), nome_arquivo=nome))
+                except (ValueError, ET.ParseError) as e:
+                    db.session.rollback()
+                    notas.append({'nome_arquivo': nome, 'error': f'XML de NF-e inválido: {e}'})
 
-        db.session.commit()
-        
-        mensagem = "Dados extraídos com sucesso!"
-        if novos_produtos_criados > 0:
-            mensagem = f"{novos_produtos_criados} novo(s) produto(s) foi/foram cadastrado(s) automaticamente!"
-        elif not itens_sugeridos:
-            mensagem = "PDF lido, mas nenhum item correspondente foi encontrado na base de dados."
-
-        return jsonify({
-            'fornecedor': fornecedor_sugerido,
-            'numero_documento': numero_documento_sugerido,
-            'itens': itens_sugeridos,
-            'message': mensagem
-        })
+        importadas = sum(1 for nota in notas if 'error' not in nota)
+        return jsonify({'notas': notas, 'message': f"{importadas} de {len(notas)} nota(s) importada(s)."})
 
+    except (ValueError, ET.ParseError, zipfile.BadZipFile) as e:
+        db.session.rollback()
+        return jsonify({'error': f'XML de NF-e inválido: {e}'}), 400
     except Exception as e:
         db.session.rollback()
-        print(f"ERRO CRÍTICO AO PROCESSAR PDF: {e}")
+        print(f"ERRO CRÍTICO AO PROCESSAR XML: {e}")
         traceback.print_exc()
-        return jsonify({'error': f'Ocorreu um erro inesperado ao ler o ficheiro PDF: {e}'}), 500
-
+        return jsonify({'error': f'Ocorreu um erro inesperado ao ler o ficheiro XML: {e}'}), 500
 
 
 @app.route('/api/recebimentos/consultar/<numero_documento>', methods=['GET'])
@@ -1039,10 +3294,24 @@ def buscar_fornecedores():
     """
     # O Select2 envia o termo de busca no parâmetro 'q'
     termo_busca = request.args.get('q', '').lower()
+
+    if app.config['CATALOGO_EM_MEMORIA']:
+        catalogo = obter_catalogo()
+        indice = catalogo['fornecedores']
+        resposta = jsonify([
+            {'id': indice['ids'][i], 'text': indice['respostas'][i][0]}
+            for i in buscar_no_indice(indice, termo_busca)
+        ])
+        resposta.headers['X-Versao-Catalogo'] = str(catalogo['versao'])
+        return resposta
     
     query = Fornecedor.query.filter(Fornecedor.ativo == True)
 
-    if termo_busca:
+    resultado_busca = subconsulta_busca('fornecedor_busca', termo_busca, app.config['BUSCA_MAX_CANDIDATOS'])
+    if resultado_busca is not None:
+        # Índice FTS5: resultados ordenados por relevância
+        query = query.join(resultado_busca, resultado_busca.c.id == Fornecedor.id).order_by(resultado_busca.c.rank)
+    elif termo_busca:
         query = query.filter(
             Fornecedor.razao_social.ilike(f'%{termo_busca}%') |
             Fornecedor.nome_fantasia.ilike(f'%{termo_busca}%') |
@@ -1066,10 +3335,24 @@ def buscar_insumos():
     Recebe um parâmetro de busca 'q' e retorna uma lista de insumos.
     """
     termo_busca = request.args.get('q', '').lower()
+
+    if app.config['CATALOGO_EM_MEMORIA']:
+        catalogo = obter_catalogo()
+        indice = catalogo['insumos']
+        resposta = jsonify([
+            {'id': indice['ids'][i], 'text': indice['respostas'][i][0], 'valor_unitario': indice['respostas'][i][1]}
+            for i in buscar_no_indice(indice, termo_busca)
+        ])
+        resposta.headers['X-Versao-Catalogo'] = str(catalogo['versao'])
+        return resposta
     
     query = Insumo.query
 
-    if termo_busca:
+    resultado_busca = subconsulta_busca('insumo_busca', termo_busca, app.config['BUSCA_MAX_CANDIDATOS'])
+    if resultado_busca is not None:
+        # Índice FTS5: resultados ordenados por relevância
+        query = query.join(resultado_busca, resultado_busca.c.id == Insumo.id).order_by(resultado_busca.c.rank)
+    elif termo_busca:
         query = query.filter(
             Insumo.descricao.ilike(f'%{termo_busca}%') |
             Insumo.sku.ilike(f'%{termo_busca}%')
@@ -1149,42 +3432,139 @@ def registrar_ordem_de_compra():
         return jsonify({'error': 'Ocorreu um erro interno ao salvar a ordem de compra. Verifique os dados enviados e tente novamente.'}), 500
 
 
+# --- ORDENS DE COMPRA: STATUS DE ENTREGA, FILTROS E PAGINAÇÃO ---
+STATUS_ORDENS = ('pendente', 'atrasado', 'recebido_no_prazo', 'recebido_com_atraso')
+
+
+def consultar_ordens_de_compra(hoje):
+    """
+    Monta uma subconsulta estreita das ordens de compra (só as colunas usadas pela
+    listagem e pela exportação, com o nome do fornecedor por join), com o status de
+    entrega e os dias de atraso calculados em SQL em relação a 'hoje'.
+    Filtros, contagens e paginação podem ser aplicados diretamente sobre ela.
+    """
+    chegada, prevista = OrdemDeCompra.data_chegada_real, OrdemDeCompra.data_entrega_prevista
+    # Dias entre a previsão e a chegada (ou hoje, se ainda não chegou); 0 se não houver atraso
+    dias = func.coalesce(cast(func.julianday(func.coalesce(chegada, literal(hoje, Date))) - func.julianday(prevista), db.Integer), 0)
+    atraso = case((dias > 0, dias), else_=0)
+    status = case(
+        (and_(chegada.isnot(None), dias > 0), 'recebido_com_atraso'),
+        (chegada.isnot(None), 'recebido_no_prazo'),
+        (dias > 0, 'atrasado'),
+        else_='pendente'
+    )
+
+    return db.session.query(
+        OrdemDeCompra.id.label('id'),
+        OrdemDeCompra.numero_ordem.label('numero_ordem'),
+        OrdemDeCompra.fornecedor_id.label('fornecedor_id'),
+        Fornecedor.razao_social.label('fornecedor_nome'),
+        OrdemDeCompra.data_compra.label('data_compra'),
+        prevista.label('data_entrega_prevista'),
+        chegada.label('data_chegada_real'),
+        OrdemDeCompra.valor_total.label('valor_total'),
+        OrdemDeCompra.subtotal.label('subtotal'),
+        OrdemDeCompra.frete.label('frete'),
+        OrdemDeCompra.impostos_percentual.label('impostos_percentual'),
+        OrdemDeCompra.solicitado_por.label('solicitado_por'),
+        OrdemDeCompra.observacoes.label('observacoes'),
+        status.label('status_key'),
+        atraso.label('atraso_dias')
+    ).join(Fornecedor, OrdemDeCompra.fornecedor_id == Fornecedor.id).subquery()
+
+
+def ler_filtros_ordens(parametros):
+    """
+    Lê os filtros da listagem e da exportação de ordens: fornecedor_id, status (um de
+    STATUS_ORDENS ou 'todos') e data_inicio/data_fim da compra (AAAA-MM-DD).
+    Levanta ValueError com a mensagem para o utilizador se algum for inválido.
+    """
+    filtros = {}
+    fornecedor_id = (parametros.get('fornecedor_id') or '').strip()
+    if fornecedor_id:
+        if not fornecedor_id.isdigit():
+            raise ValueError('Fornecedor inválido.')
+        filtros['fornecedor_id'] = int(fornecedor_id)
+    status = (parametros.get('status') or 'todos').strip().lower()
+    if status != 'todos':
+        if status not in STATUS_ORDENS:
+            raise ValueError(f"Status inválido: use todos, {', '.join(STATUS_ORDENS)}.")
+        filtros['status'] = status
+    for campo in ('data_inicio', 'data_fim'):
+        valor = (parametros.get(campo) or '').strip()
+        if valor:
+            try:
+                filtros[campo] = datetime.strptime(valor, '%Y-%m-%d').date()
+            except ValueError:
+                raise ValueError(f'Data inválida em {campo}: use o formato AAAA-MM-DD.')
+    return filtros
+
+
+def filtrar_ordens_de_compra(query, ordens, filtros):
+    """Aplica os filtros de ler_filtros_ordens a uma consulta sobre a subconsulta 'ordens'."""
+    if 'fornecedor_id' in filtros:
+        query = query.filter(ordens.c.fornecedor_id == filtros['fornecedor_id'])
+    if 'status' in filtros:
+        query = query.filter(ordens.c.status_key == filtros['status'])
+    if 'data_inicio' in filtros:
+        query = query.filter(ordens.c.data_compra >= filtros['data_inicio'])
+    if 'data_fim' in filtros:
+        query = query.filter(ordens.c.data_compra <= filtros['data_fim'])
+    return query
+
+
+def rotulo_status_ordem(status_key, atraso_dias):
+    """Texto do status de entrega mostrado na listagem e na exportação."""
+    if status_key == 'recebido_com_atraso':
+        return f'Recebido com {atraso_dias} dia(s) de atraso'
+    if status_key == 'atrasado':
+        return f'Atrasado ({atraso_dias} dia(s))'
+    return 'Recebido no prazo' if status_key == 'recebido_no_prazo' else 'Pendente'
+
+
 @app.route('/api/ordens-de-compra', methods=['GET'])
 def listar_ordens_de_compra():
-    """ Lista todas as ordens de compra com cálculo de status de atraso. """
+    """
+    Lista as ordens de compra com o status de atraso (calculado em SQL), paginadas
+    (page, per_page) e filtradas por fornecedor_id, status e data de compra
+    (data_inicio/data_fim).
+    """
     try:
-        ordens = OrdemDeCompra.query.order_by(OrdemDeCompra.data_compra.desc()).all()
-        resultado = []
-        hoje = datetime.utcnow().date()
+        filtros = ler_filtros_ordens(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        for ordem in ordens:
-            status = 'Pendente'
-            atraso = 0
-            
-            if ordem.data_chegada_real:
-                status = 'Recebido'
-                if ordem.data_entrega_prevista and ordem.data_chegada_real > ordem.data_entrega_prevista:
-                    atraso = (ordem.data_chegada_real - ordem.data_entrega_prevista).days
-                    status = f'Recebido com {atraso} dia(s) de atraso'
-                else:
-                    status = 'Recebido no prazo'
-            elif ordem.data_entrega_prevista and hoje > ordem.data_entrega_prevista:
-                atraso = (hoje - ordem.data_entrega_prevista).days
-                status = f'Atrasado ({atraso} dia(s))'
-            
-            resultado.append({
-                'id': ordem.id,
-                'numero_ordem': ordem.numero_ordem,
-                'fornecedor_nome': ordem.fornecedor.razao_social,
-                'data_compra': ordem.data_compra.strftime('%d/%m/%Y'),
-                'data_entrega_prevista': ordem.data_entrega_prevista.strftime('%d/%m/%Y') if ordem.data_entrega_prevista else 'N/A',
-                'valor_total': ordem.valor_total,
-                'status': status,
-                'atraso_dias': atraso,
-                'data_chegada_real': ordem.data_chegada_real.strftime('%d/%m/%Y') if ordem.data_chegada_real else None
-            })
-            
-        return jsonify(resultado)
+    try:
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        ordens = consultar_ordens_de_compra(datetime.utcnow().date())
+        query = filtrar_ordens_de_compra(db.session.query(
+            ordens.c.id, ordens.c.numero_ordem, ordens.c.fornecedor_nome, ordens.c.data_compra,
+            ordens.c.data_entrega_prevista, ordens.c.data_chegada_real, ordens.c.valor_total,
+            ordens.c.status_key, ordens.c.atraso_dias
+        ), ordens, filtros)
+
+        total = query.count()
+        total_pages = (total + per_page - 1) // per_page
+        pagina = query.order_by(ordens.c.data_compra.desc(), ordens.c.id).offset((page - 1) * per_page).limit(per_page).all()
+
+        resultado = [{
+            'id': ordem.id,
+            'numero_ordem': ordem.numero_ordem,
+            'fornecedor_nome': ordem.fornecedor_nome,
+            'data_compra': ordem.data_compra.strftime('%d/%m/%Y'),
+            'data_entrega_prevista': ordem.data_entrega_prevista.strftime('%d/%m/%Y') if ordem.data_entrega_prevista else 'N/A',
+            'valor_total': ordem.valor_total,
+            'status': rotulo_status_ordem(ordem.status_key, ordem.atraso_dias),
+            'status_key': ordem.status_key,
+            'atraso_dias': ordem.atraso_dias,
+            'data_chegada_real': ordem.data_chegada_real.strftime('%d/%m/%Y') if ordem.data_chegada_real else None
+        } for ordem in pagina]
+
+        return jsonify({
+            'items': resultado, 'page': page, 'per_page': per_page, 'total': total,
+            'total_pages': total_pages, 'has_next': page < total_pages, 'has_prev': page > 1
+        })
 
     except Exception as e:
         print(f"Erro ao listar ordens de compra: {e}")
@@ -1237,26 +3617,65 @@ def get_ordem_de_compra_detalhe(id):
     return jsonify(resultado)
 
 
-# app.py - VERSÃO COM ROTAS DO DASHBOARD SEPARADAS
+# --- AGREGAÇÕES DO DASHBOARD ---
+def expressao_status_estoque(estoque_total, estoque_minimo, saida_media_diaria):
+    """
+    Monta as expressões SQL que classificam um insumo em critico/atencao/bom/excelente
+    e que calculam os dias de estoque (NULL quando não se aplicam).
+    """
+    dias = estoque_total / saida_media_diaria
+    status = case(
+        (estoque_total <= 0, 'critico'),
+        (and_(estoque_minimo > 0, estoque_total <= estoque_minimo), 'critico'),
+        (and_(estoque_minimo > 0, estoque_total <= estoque_minimo * 1.5), 'atencao'),
+        (saida_media_diaria <= 0, 'excelente'),
+        (dias <= 30, 'atencao'),
+        (dias <= 60, 'bom'),
+        else_='excelente'
+    )
+    dias_de_estoque = case(
+        (estoque_total <= 0, None),
+        (and_(estoque_minimo > 0, estoque_total <= estoque_minimo * 1.5), None),
+        (saida_media_diaria > 0, dias),
+        else_=None
+    )
+    return status, dias_de_estoque
+
 
-# ... (todo o início do seu arquivo, imports, modelos, etc. - MANTENHA COMO ESTÁ)
-import os
-import re
-import pytz
-import pdfplumber
-import pandas as pd
-from io import BytesIO
-from flask import Flask, jsonify, request, render_template, send_file, session, redirect, url_for, flash
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
-from sqlalchemy import func, cast, Date
-import traceback
-from werkzeug.security import generate_password_hash, check_password_hash
-import unicodedata
-from functools import wraps
+def consultar_metricas_insumos(data_limite, periodo_dias):
+    """
+    Monta uma subconsulta com o estoque total (tabela de saldos), o consumo (SAIDA)
+    no período e o status de cada insumo, agrupado por insumo_id com outer joins.
+    Filtros, contagens e paginação podem ser aplicados diretamente sobre ela.
+    """
+    fonte = fonte_consumo(data_limite)
+    consumo_sq = db.session.query(
+        fonte.c.insumo_id.label('insumo_id'),
+        func.sum(fonte.c.quantidade).label('total')
+    ).group_by(fonte.c.insumo_id).subquery()
+
+    estoque_total = func.coalesce(SaldoInsumo.quantidade_total, 0)
+    qtd_consumida = func.coalesce(consumo_sq.c.total, 0)
+    estoque_minimo = func.coalesce(Insumo.estoque_minimo, 0)
+    saida_media_diaria = qtd_consumida * 1.0 / periodo_dias if periodo_dias > 0 else literal(0.0)
+    status, dias_de_estoque = expressao_status_estoque(estoque_total, estoque_minimo, saida_media_diaria)
+
+    return db.session.query(
+        Insumo.id.label('id'),
+        Insumo.descricao.label('descricao'),
+        Insumo.sku.label('sku'),
+        Insumo.valor_unitario.label('valor_unitario'),
+        estoque_total.label('estoque_total'),
+        qtd_consumida.label('qtd_consumida'),
+        dias_de_estoque.label('dias_de_estoque'),
+        status.label('status_key')
+    ).outerjoin(SaldoInsumo, SaldoInsumo.insumo_id == Insumo.id)\
+     .outerjoin(consumo_sq, consumo_sq.c.insumo_id == Insumo.id)\
+     .subquery()
 
 
 @app.route('/api/dashboard/main', methods=['GET'])
+@cache_de_resposta
 def get_dashboard_main_data():
     try:
         page = request.args.get('page', 1, type=int)
@@ -1267,68 +3686,42 @@ def get_dashboard_main_data():
         filtro_status_normalizado = normalize_text(filtro_status_req)
 
         data_limite = datetime.utcnow() - timedelta(days=periodo_dias)
+        metricas = consultar_metricas_insumos(data_limite, periodo_dias)
         
-        # --- Lógica da Tabela ---
-        base_query = Insumo.query
+        # --- Lógica da Tabela (filtro, contagem e paginação na base de dados) ---
+        tabela_query = db.session.query(metricas)
         if filtro_busca:
-            base_query = base_query.filter(
-                Insumo.descricao.ilike(f'%{filtro_busca}%') | Insumo.sku.ilike(f'%{filtro_busca}%'))
-        
-        insumos_filtrados = base_query.all()
-        todos_itens_calculados = []
-        for insumo in insumos_filtrados:
-            estoque_total = db.session.query(func.sum(Estoque.quantidade)).filter(Estoque.insumo_id == insumo.id).scalar() or 0
-            qtd_consumida = db.session.query(func.sum(Movimentacao.quantidade)).filter(
-                Movimentacao.insumo_id == insumo.id, Movimentacao.tipo == 'SAIDA', Movimentacao.data_hora >= data_limite).scalar() or 0
-            saida_media_diaria = qtd_consumida / periodo_dias if periodo_dias > 0 else 0
-            
-            status_key, dias_de_estoque_display = 'bom', 'N/A'
-            if estoque_total <= 0: status_key = 'critico'
-            elif insumo.estoque_minimo > 0 and estoque_total <= insumo.estoque_minimo: status_key = 'critico'
-            elif insumo.estoque_minimo > 0 and estoque_total <= insumo.estoque_minimo * 1.5: status_key = 'atencao'
-            else:
-                if saida_media_diaria > 0:
-                    dias = estoque_total / saida_media_diaria
-                    dias_de_estoque_display = int(dias)
-                    if dias <= 30: status_key = 'atencao'
-                    elif dias <= 60: status_key = 'bom'
-                    else: status_key = 'excelente'
-                else: status_key = 'excelente'
-            
-            todos_itens_calculados.append({'id': insumo.id, 'descricao': insumo.descricao, 'sku': insumo.sku, 'estoque_atual': estoque_total, 'saida_media_diaria': round(saida_media_diaria, 2), 'dias_de_estoque': dias_de_estoque_display, 'consumo_qtd': qtd_consumida, 'consumo_valor': qtd_consumida * (insumo.valor_unitario or 0), 'status_key': status_key})
-
+            tabela_query = tabela_query.filter(
+                condicao_busca_insumo(filtro_busca, metricas.c.id, metricas.c.descricao, metricas.c.sku))
         if filtro_status_normalizado != 'todos':
-            itens_para_tabela = [item for item in todos_itens_calculados if item['status_key'] == filtro_status_normalizado]
-        else:
-            itens_para_tabela = todos_itens_calculados
+            tabela_query = tabela_query.filter(metricas.c.status_key == filtro_status_normalizado)
 
-        total_items_filtrados = len(itens_para_tabela)
-        paginated_items = itens_para_tabela[(page - 1) * per_page : page * per_page]
+        total_items_filtrados = tabela_query.count()
         total_pages = (total_items_filtrados + per_page - 1) // per_page if per_page > 0 else 0
+        pagina = tabela_query.order_by(metricas.c.id).offset(max(page - 1, 0) * per_page).limit(per_page).all()
 
-        # --- Lógica dos KPIs e Resumo de Status ---
-        total_skus_distintos = Insumo.query.count()
-        total_valor_estoque = db.session.query(func.sum(Estoque.quantidade * Insumo.valor_unitario)).join(Insumo).scalar() or 0
-        
-        consumo_total_periodo, status_counts = 0, {'excelente': 0, 'bom': 0, 'atencao': 0, 'critico': 0}
-        all_insumos_for_kpi = Insumo.query.all()
-        for insumo in all_insumos_for_kpi:
-            qtd_consumida = db.session.query(func.sum(Movimentacao.quantidade)).filter(Movimentacao.insumo_id == insumo.id, Movimentacao.tipo == 'SAIDA', Movimentacao.data_hora >= data_limite).scalar() or 0
-            consumo_total_periodo += qtd_consumida * (insumo.valor_unitario or 0)
-            estoque_total = db.session.query(func.sum(Estoque.quantidade)).filter(Estoque.insumo_id == insumo.id).scalar() or 0
-            saida_media = (qtd_consumida / periodo_dias) if periodo_dias > 0 else 0
-            
-            if estoque_total <= 0: status_counts['critico'] += 1
-            elif insumo.estoque_minimo > 0 and estoque_total <= insumo.estoque_minimo: status_counts['critico'] += 1
-            elif insumo.estoque_minimo > 0 and estoque_total <= insumo.estoque_minimo * 1.5: status_counts['atencao'] += 1
-            else:
-                if saida_media > 0:
-                    dias = estoque_total / saida_media
-                    if dias <= 30: status_counts['atencao'] += 1
-                    elif dias <= 60: status_counts['bom'] += 1
-                    else: status_counts['excelente'] += 1
-                else: status_counts['excelente'] += 1
-        
+        paginated_items = []
+        for row in pagina:
+            estoque_total = row.estoque_total or 0
+            qtd_consumida = row.qtd_consumida or 0
+            saida_media_diaria = qtd_consumida / periodo_dias if periodo_dias > 0 else 0
+            dias_de_estoque_display = int(row.dias_de_estoque) if row.dias_de_estoque is not None else 'N/A'
+            paginated_items.append({'id': row.id, 'descricao': row.descricao, 'sku': row.sku, 'estoque_atual': estoque_total, 'saida_media_diaria': round(saida_media_diaria, 2), 'dias_de_estoque': dias_de_estoque_display, 'consumo_qtd': qtd_consumida, 'consumo_valor': qtd_consumida * (row.valor_unitario or 0), 'status_key': row.status_key})
+
+        # --- Lógica dos KPIs e Resumo de Status (uma linha por status) ---
+        status_counts = {'excelente': 0, 'bom': 0, 'atencao': 0, 'critico': 0}
+        consumo_total_periodo = 0
+        resumo_status = db.session.query(
+            metricas.c.status_key,
+            func.count(),
+            func.sum(metricas.c.qtd_consumida * func.coalesce(metricas.c.valor_unitario, 0))
+        ).group_by(metricas.c.status_key).all()
+        for status_key, quantidade, consumo_valor in resumo_status:
+            status_counts[status_key] = quantidade
+            consumo_total_periodo += consumo_valor or 0
+
+        total_skus_distintos = sum(status_counts.values())
+        total_valor_estoque = valor_total_estoque()
         consumo_diario_medio_geral = consumo_total_periodo / periodo_dias if periodo_dias > 0 else 0
         
         # --- PREPARAÇÃO DOS DADOS PARA OS FILTROS ---
@@ -1354,20 +3747,21 @@ def get_dashboard_main_data():
 
 
 @app.route('/api/dashboard/charts', methods=['GET'])
+@cache_de_resposta
 def get_dashboard_chart_data():
     try:
         periodo_dias = request.args.get('periodo', 30, type=int)
         data_limite = datetime.utcnow() - timedelta(days=periodo_dias)
         
         # --- Gráfico de Consumo por Setor (Lógica já estava correta) ---
+        fonte = fonte_consumo(data_limite)
         setor_consumo_query = db.session.query(
             Setor.nome,
-            func.sum(Movimentacao.quantidade * Insumo.valor_unitario)
-        ).join(Movimentacao, Setor.id == Movimentacao.setor_id)\
-         .join(Insumo, Insumo.id == Movimentacao.insumo_id)\
-         .filter(Movimentacao.tipo == 'SAIDA', Movimentacao.data_hora >= data_limite)\
+            func.sum(fonte.c.quantidade * Insumo.valor_unitario)
+        ).join(fonte, Setor.id == fonte.c.setor_id)\
+         .join(Insumo, Insumo.id == fonte.c.insumo_id)\
          .group_by(Setor.nome)\
-         .order_by(func.sum(Movimentacao.quantidade * Insumo.valor_unitario).desc()).all()
+         .order_by(func.sum(fonte.c.quantidade * Insumo.valor_unitario).desc()).all()
         
         setor_chart_data = {
             "labels": [row[0] for row in setor_consumo_query],
@@ -1376,24 +3770,22 @@ def get_dashboard_chart_data():
 
         # --- LÓGICA CORRIGIDA PARA O GRÁFICO DE TENDÊNCIA ---
 
-        # 1. Faz uma consulta mais simples, sem o CAST na base de dados
-        movimentacoes_periodo = Movimentacao.query\
-            .join(Insumo, Insumo.id == Movimentacao.insumo_id)\
-            .filter(Movimentacao.tipo == 'SAIDA', Movimentacao.data_hora >= data_limite)\
-            .order_by(Movimentacao.data_hora).all()
-
-        # 2. Agrupa os resultados por dia em Python
-        consumo_por_dia = {}
-        for dia, grupo in groupby(movimentacoes_periodo, key=lambda x: x.data_hora.date()):
-            consumo_total_dia = sum(mov.quantidade * (mov.insumo.valor_unitario or 0) for mov in grupo)
-            consumo_por_dia[dia] = consumo_total_dia
+        # 1. Agrupa e valoriza o consumo por dia na própria base de dados
+        #    (uma linha por dia, já com o valor unitário do insumo)
+        consumo_por_dia_query = db.session.query(
+            fonte.c.dia,
+            func.sum(fonte.c.quantidade * func.coalesce(Insumo.valor_unitario, 0))
+        ).join(Insumo, Insumo.id == fonte.c.insumo_id)\
+         .group_by(fonte.c.dia).all()
+        consumo_por_dia = {str(dia): valor for dia, valor in consumo_por_dia_query}
         
-        # 3. Preenche os dias sem consumo com zero para um gráfico contínuo
+        # 2. Preenche os dias sem consumo com zero para um gráfico contínuo
+        hoje = datetime.utcnow().date()
         labels_tendencia, data_tendencia = [], []
         for i in range(periodo_dias - 1, -1, -1):
-            dia_iteracao = (datetime.utcnow() - timedelta(days=i)).date()
+            dia_iteracao = hoje - timedelta(days=i)
             labels_tendencia.append(dia_iteracao.strftime('%d/%m'))
-            data_tendencia.append(consumo_por_dia.get(dia_iteracao, 0))
+            data_tendencia.append(consumo_por_dia.get(dia_iteracao.isoformat(), 0))
 
         tendencia_chart_data = {"labels": labels_tendencia, "data": data_tendencia}
 
@@ -1414,36 +3806,40 @@ def atualizar_estoque_minimo():
     """
     Lê o ficheiro 'dados_mestre_insumos.xlsx' e atualiza o campo
     'estoque_minimo' para cada insumo correspondente.
+    A planilha é comparada com a base de uma vez e só os valores diferentes são
+    gravados, num único executemany.
     """
     try:
         df = pd.read_excel('dados_mestre_insumos.xlsx')
-        
-        insumos_atualizados = 0
-        insumos_nao_encontrados = []
 
-        for index, row in df.iterrows():
-            # Limpa o SKU para remover o prefixo "SKU: "
-            sku_limpo = str(row['SKU']).replace('SKU:', '').strip()
-            
-            # Encontra o insumo no banco de dados pelo SKU
-            insumo = Insumo.query.filter_by(sku=sku_limpo).first()
-            
-            if insumo:
-                # Se encontrou o insumo, atualiza o estoque mínimo
-                estoque_min_val = row.get('estoque minimo')
-                if pd.notna(estoque_min_val):
-                    insumo.estoque_minimo = int(estoque_min_val)
-                    insumos_atualizados += 1
-            else:
-                insumos_nao_encontrados.append(sku_limpo)
+        # Limpa o SKU para remover o prefixo "SKU: "
+        planilha = pd.DataFrame({
+            'sku': df['SKU'].astype(str).str.replace('SKU:', '', regex=False).str.strip(),
+            'estoque_minimo': pd.to_numeric(_coluna_planilha(df, 'estoque minimo'), errors='coerce'),
+        })
+        atuais = pd.DataFrame(db.session.query(Insumo.id, Insumo.sku, Insumo.estoque_minimo).all(),
+                              columns=['id', 'sku', 'estoque_minimo_atual'])
+        comparacao = planilha.merge(atuais, on='sku', how='left')
+
+        insumos_nao_encontrados = comparacao.loc[comparacao['id'].isna(), 'sku'].tolist()
+        com_valor = comparacao[comparacao['id'].notna() & comparacao['estoque_minimo'].notna()]
+        insumos_atualizados = len(com_valor)
+        # Um SKU repetido fica com o valor da última linha
+        com_valor = com_valor.drop_duplicates('id', keep='last')
+        novo_minimo = np.trunc(com_valor['estoque_minimo']).astype('int64')
+        mudou = novo_minimo != com_valor['estoque_minimo_atual']
+        alterados = [{'id': int(i), 'estoque_minimo': int(m)} for i, m in zip(com_valor['id'][mudou], novo_minimo[mudou])]
 
-        db.session.commit()
-        
         mensagem = f'{insumos_atualizados} insumos tiveram o seu estoque mínimo atualizado com sucesso.'
         if insumos_nao_encontrados:
             mensagem += f" Atenção: os seguintes SKUs não foram encontrados e foram ignorados: {', '.join(insumos_nao_encontrados)}"
 
-        return jsonify({'message': mensagem}), 200
+        def aplicar_minimos():
+            if alterados:
+                db.session.execute(update(Insumo), alterados)
+            return jsonify({'message': mensagem}), 200
+
+        return executar_escrita(aplicar_minimos)
 
     except FileNotFoundError:
         return jsonify({'error': "O ficheiro 'dados_mestre_insumos.xlsx' não foi encontrado."}), 404
@@ -1459,64 +3855,76 @@ def finalizar_recebimento():
     """
     Recebe os dados da conferência do frontend, regista o recebimento
     e atualiza o estoque para cada item.
+    Todas as linhas são aplicadas com um número fixo de instruções (executemany),
+    independentemente do tamanho da nota, para libertar depressa o lock de escrita.
     """
     data = request.get_json()
     if not data or not data.get('fornecedor_id') or not data.get('numero_documento') or not data.get('itens'):
         return jsonify({'error': 'Dados incompletos para finalizar o recebimento.'}), 400
 
     try:
-        # 1. Cria o registo principal do Recebimento
-        novo_recebimento = Recebimento(
-            fornecedor_id=data['fornecedor_id'],
-            tipo_documento='NOTA FISCAL', # Pode ser ajustado se necessário
-            numero_documento=data['numero_documento'],
-            data_recebimento=datetime.strptime(data['data_recebimento'], '%Y-%m-%d').date(),
-            valor_total_documento=sum(item['quantidade_conferida'] * item['valor_unitario'] for item in data['itens']),
-            usuario = session.get('username', 'Sistema')
-        )
-        db.session.add(novo_recebimento)
-        db.session.flush() # Para obter o ID do recebimento antes de salvar os itens
-        
-
-        # 2. Itera sobre cada item recebido
-        for item_data in data['itens']:
-            # Cria o registo do item recebido, ligado ao recebimento principal
-            item_recebido = ItemRecebido(
-                recebimento_id=novo_recebimento.id,
-                insumo_id=item_data['insumo_id'],
-                quantidade_documento=item_data['quantidade_documento'],
-                quantidade_conferida=item_data['quantidade_conferida'],
-                valor_unitario=item_data['valor_unitario'],
-                posicao_destino=item_data['posicao_destino'],
-                status_conferencia='CONFERIDO'
+        itens = data['itens']
+
+        # Agrega as linhas antes de abrir a transação: entradas por (insumo, posição)
+        # e, por insumo, a quantidade total e o valor da última linha (o preço final)
+        entradas, por_insumo = {}, {}
+        for item_data in itens:
+            chave = (item_data['insumo_id'], item_data['posicao_destino'])
+            entradas[chave] = entradas.get(chave, 0) + item_data['quantidade_conferida']
+            quantidade_anterior = por_insumo.get(item_data['insumo_id'], (0, None))[0]
+            por_insumo[item_data['insumo_id']] = (
+                quantidade_anterior + item_data['quantidade_conferida'], item_data['valor_unitario']
             )
-            db.session.add(item_recebido)
-
-            # 3. Atualiza o estoque na posição de destino
-            posicao_estoque = Estoque.query.filter_by(
-                insumo_id=item_data['insumo_id'],
-                posicao=item_data['posicao_destino']
-            ).first()
-
-            if posicao_estoque:
-                # Se a posição já existe para este insumo, soma a quantidade
-                posicao_estoque.quantidade += item_data['quantidade_conferida']
-            else:
-                # Se não existe, cria um novo registo de estoque
-                posicao_estoque = Estoque(
-                    insumo_id=item_data['insumo_id'],
-                    posicao=item_data['posicao_destino'],
-                    quantidade=item_data['quantidade_conferida']
-                )
-                db.session.add(posicao_estoque)
-            
-            # 4. (Opcional, mas recomendado) Atualiza o valor unitário do insumo com o valor da última compra
-            insumo = Insumo.query.get(item_data['insumo_id'])
-            if insumo:
-                insumo.valor_unitario = item_data['valor_unitario']
+        # Uma única consulta para saber que insumos existem (só esses recebem preço e saldo)
+        existentes = {
+            insumo_id for (insumo_id,) in
+            db.session.query(Insumo.id).filter(Insumo.id.in_(list(por_insumo)))
+        }
 
-        db.session.commit()
-        return jsonify({'message': 'Recebimento finalizado e estoque atualizado com sucesso!'}), 201
+        def registrar_recebimento():
+            # 1. Cria o registo principal do Recebimento
+            novo_recebimento = Recebimento(
+                fornecedor_id=data['fornecedor_id'],
+                tipo_documento='NOTA FISCAL', # Pode ser ajustado se necessário
+                numero_documento=data['numero_documento'],
+                data_recebimento=datetime.strptime(data['data_recebimento'], '%Y-%m-%d').date(),
+                valor_total_documento=sum(item['quantidade_conferida'] * item['valor_unitario'] for item in itens),
+                usuario = session.get('username', 'Sistema')
+            )
+            db.session.add(novo_recebimento)
+            db.session.flush() # Para obter o ID do recebimento antes de salvar os itens
+
+            # 2. Itens recebidos, ligados ao recebimento principal (um único INSERT em lote)
+            db.session.execute(insert(ItemRecebido), [
+                {
+                    'recebimento_id': novo_recebimento.id,
+                    'insumo_id': item_data['insumo_id'],
+                    'quantidade_documento': item_data['quantidade_documento'],
+                    'quantidade_conferida': item_data['quantidade_conferida'],
+                    'valor_unitario': item_data['valor_unitario'],
+                    'posicao_destino': item_data['posicao_destino'],
+                    'status_conferencia': 'CONFERIDO',
+                }
+                for item_data in itens
+            ])
+
+            # 3. Soma as quantidades nas posições de destino, criando as que não existem
+            creditar_estoques([
+                {'insumo_id': insumo_id, 'posicao': posicao, 'quantidade': quantidade}
+                for (insumo_id, posicao), quantidade in entradas.items()
+            ])
+
+            # 4. Atualiza o valor unitário dos insumos com o valor da última compra
+            # e 5. o saldo consolidado
+            if existentes:
+                db.session.execute(update(Insumo), [
+                    {'id': insumo_id, 'valor_unitario': por_insumo[insumo_id][1]} for insumo_id in existentes
+                ])
+                atualizar_saldos_insumos([(insumo_id, por_insumo[insumo_id][0]) for insumo_id in existentes])
+
+            return jsonify({'message': 'Recebimento finalizado e estoque atualizado com sucesso!'}), 201
+
+        return executar_escrita(registrar_recebimento)
 
     except Exception as e:
         db.session.rollback()
@@ -1583,29 +3991,46 @@ def ajustar_estoque_inventario():
         if nova_quantidade < 0:
             return jsonify({'error': 'A quantidade não pode ser negativa.'}), 400
             
-        item_estoque = Estoque.query.get(estoque_id)
-        if not item_estoque:
-            return jsonify({'error': 'Item de estoque não encontrado.'}), 404
-        
-        quantidade_anterior = item_estoque.quantidade
-        diferenca = nova_quantidade - quantidade_anterior
-        
-        # 1. Atualiza a quantidade no estoque
-        item_estoque.quantidade = nova_quantidade
-        
-        # 2. Cria o registo no histórico de ajustes
-        novo_ajuste = AjusteInventario(
-            estoque_id=estoque_id,
-            quantidade_anterior=quantidade_anterior,
-            quantidade_nova=nova_quantidade,
-            diferenca=diferenca,
-            usuario=usuario,
-            observacao=f"Ajuste manual de inventário por {usuario}"
-        )
-        db.session.add(novo_ajuste)
-        db.session.commit()
-        
-        return jsonify({'message': f'Estoque do item {item_estoque.insumo.sku} ajustado para {nova_quantidade} com sucesso!'})
+        def registrar_ajuste():
+            tabela = Estoque.__table__
+            # Compare-and-set: só grava se a quantidade não mudou desde a leitura. Se mudou,
+            # o UPDATE falhado já abriu a transação de escrita e a releitura fica estável.
+            for _ in range(3):
+                item_estoque = db.session.execute(
+                    select(tabela.c.insumo_id, tabela.c.quantidade).where(tabela.c.id == estoque_id)
+                ).first()
+                if not item_estoque:
+                    return jsonify({'error': 'Item de estoque não encontrado.'}), 404
+                quantidade_anterior = item_estoque.quantidade
+                alterado = db.session.execute(
+                    update(tabela)
+                    .where(tabela.c.id == estoque_id, tabela.c.quantidade == quantidade_anterior)
+                    .values(quantidade=nova_quantidade)
+                ).rowcount
+                if alterado:
+                    break
+            else:
+                return jsonify({'error': 'O item foi alterado por outra operação. Tente novamente.'}), 409
+
+            diferenca = nova_quantidade - quantidade_anterior
+
+            # 1. Atualiza o saldo consolidado (a quantidade da posição já foi gravada acima)
+            insumo = db.session.get(Insumo, item_estoque.insumo_id)
+            atualizar_saldo_insumo(insumo, diferenca)
+
+            # 2. Cria o registo no histórico de ajustes
+            novo_ajuste = AjusteInventario(
+                estoque_id=estoque_id,
+                quantidade_anterior=quantidade_anterior,
+                quantidade_nova=nova_quantidade,
+                diferenca=diferenca,
+                usuario=usuario,
+                observacao=f"Ajuste manual de inventário por {usuario}"
+            )
+            db.session.add(novo_ajuste)
+            return jsonify({'message': f'Estoque do item {insumo.sku} ajustado para {nova_quantidade} com sucesso!'})
+
+        return executar_escrita(registrar_ajuste)
 
     except Exception as e:
         db.session.rollback()
@@ -1613,27 +4038,136 @@ def ajustar_estoque_inventario():
         traceback.print_exc()
         return jsonify({'error': f'Ocorreu um erro interno: {e}'}), 500
 
+# --- HISTÓRICO DE INVENTÁRIO: FILTROS E PAGINAÇÃO POR CURSOR ---
+def ler_filtros_historico(parametros):
+    """
+    Lê os filtros da listagem e da exportação do histórico de ajustes: data_inicio/data_fim
+    do ajuste (AAAA-MM-DD, ambas inclusivas), sku, posicao e usuario (valores exatos).
+    Levanta ValueError com a mensagem para o utilizador se algum for inválido.
+    """
+    filtros = {}
+    for campo in ('data_inicio', 'data_fim'):
+        valor = (parametros.get(campo) or '').strip()
+        if valor:
+            try:
+                filtros[campo] = datetime.strptime(valor, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f'Data inválida em {campo}: use o formato AAAA-MM-DD.')
+    for campo in ('sku', 'posicao', 'usuario'):
+        valor = (parametros.get(campo) or '').strip()
+        if valor:
+            filtros[campo] = valor
+    return filtros
+
+
+def ler_cursor_historico(valor):
+    """Converte o cursor 'data_ajuste ISO_id' de codificar_cursor_historico; ValueError se inválido."""
+    try:
+        data_ajuste, _, ajuste_id = valor.rpartition('_')
+        return datetime.fromisoformat(data_ajuste), int(ajuste_id)
+    except ValueError:
+        raise ValueError('Cursor inválido.')
+
+
+def codificar_cursor_historico(linha):
+    """Cursor da página seguinte: posição (data_ajuste, id) da última linha entregue."""
+    return f'{linha.data_ajuste.isoformat()}_{linha.id}'
+
+
+def consultar_historico_inventario(filtros, cursor=None):
+    """
+    Consulta única do histórico de ajustes (listagem e exportação): só as colunas usadas,
+    com os filtros de ler_filtros_historico, do mais recente para o mais antigo por
+    (data_ajuste, id). Com cursor=(data_ajuste, id) devolve apenas as linhas seguintes,
+    pelo índice ix_ajuste_inventario_data_ajuste_id em vez de OFFSET.
+    """
+    query = db.session.query(
+        AjusteInventario.id,
+        AjusteInventario.data_ajuste,
+        AjusteInventario.usuario,
+        Insumo.sku,
+        Insumo.descricao,
+        Estoque.posicao,
+        AjusteInventario.quantidade_anterior,
+        AjusteInventario.quantidade_nova,
+        AjusteInventario.diferenca
+    ).join(Estoque, AjusteInventario.estoque_id == Estoque.id) \
+        .join(Insumo, Estoque.insumo_id == Insumo.id)
+
+    if 'data_inicio' in filtros:
+        query = query.filter(AjusteInventario.data_ajuste >= filtros['data_inicio'])
+    if 'data_fim' in filtros:
+        query = query.filter(AjusteInventario.data_ajuste < filtros['data_fim'] + timedelta(days=1))
+    if 'sku' in filtros:
+        query = query.filter(Insumo.sku == filtros['sku'])
+    if 'posicao' in filtros:
+        query = query.filter(Estoque.posicao == filtros['posicao'])
+    if 'usuario' in filtros:
+        query = query.filter(AjusteInventario.usuario == filtros['usuario'])
+    if cursor is not None:
+        query = query.filter(tuple_(AjusteInventario.data_ajuste, AjusteInventario.id) < tuple_(*cursor))
+
+    return query.order_by(AjusteInventario.data_ajuste.desc(), AjusteInventario.id.desc())
+
+
+def iterar_historico_inventario(filtros):
+    """
+    Percorre o histórico filtrado em blocos de HISTORICO_INVENTARIO_LINHAS_POR_BLOCO linhas,
+    cada bloco numa consulta curta a partir do cursor do anterior (sem manter a leitura
+    aberta enquanto o ficheiro é escrito).
+    """
+    tamanho_bloco = app.config['HISTORICO_INVENTARIO_LINHAS_POR_BLOCO']
+    cursor = None
+    while True:
+        bloco = consultar_historico_inventario(filtros, cursor).limit(tamanho_bloco).all()
+        yield from bloco
+        if len(bloco) < tamanho_bloco:
+            return
+        cursor = (bloco[-1].data_ajuste, bloco[-1].id)
+
+
 @app.route('/api/inventario/historico', methods=['GET'])
 def get_historico_inventario():
-    """Retorna os últimos 100 ajustes de inventário."""
-    historico = db.session.query(AjusteInventario, Estoque, Insumo) \
-        .join(Estoque, AjusteInventario.estoque_id == Estoque.id) \
-        .join(Insumo, Estoque.insumo_id == Insumo.id) \
-        .order_by(AjusteInventario.data_ajuste.desc()).limit(100).all()
-
-    resultado = []
-    for ajuste, estoque, insumo in historico:
-        resultado.append({
-            'data': ajuste.data_ajuste.strftime('%d/%m/%Y %H:%M'),
-            'sku': insumo.sku,
-            'descricao': insumo.descricao,
-            'posicao': estoque.posicao,
-            'qtd_anterior': ajuste.quantidade_anterior,
-            'qtd_nova': ajuste.quantidade_nova,
-            'diferenca': ajuste.diferenca,
-            'usuario': ajuste.usuario
+    """
+    Lista os ajustes de inventário do mais recente para o mais antigo, filtrados por
+    data_inicio/data_fim, sku, posicao e usuario e paginados por cursor: limit linhas
+    por página e, na seguinte, cursor=proximo_cursor da resposta anterior.
+    """
+    try:
+        filtros = ler_filtros_historico(request.args)
+        cursor = request.args.get('cursor')
+        cursor = ler_cursor_historico(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        limite = request.args.get('limit', app.config['HISTORICO_INVENTARIO_LIMITE_PADRAO'], type=int)
+        limite = min(max(limite, 1), app.config['HISTORICO_INVENTARIO_LIMITE_MAXIMO'])
+        # Uma linha a mais indica se há página seguinte
+        linhas = consultar_historico_inventario(filtros, cursor).limit(limite + 1).all()
+        has_next = len(linhas) > limite
+        linhas = linhas[:limite]
+
+        resultado = [{
+            'data': linha.data_ajuste.strftime('%d/%m/%Y %H:%M'),
+            'sku': linha.sku,
+            'descricao': linha.descricao,
+            'posicao': linha.posicao,
+            'qtd_anterior': linha.quantidade_anterior,
+            'qtd_nova': linha.quantidade_nova,
+            'diferenca': linha.diferenca,
+            'usuario': linha.usuario
+        } for linha in linhas]
+
+        return jsonify({
+            'items': resultado, 'limit': limite, 'has_next': has_next,
+            'proximo_cursor': codificar_cursor_historico(linhas[-1]) if has_next else None
         })
-    return jsonify(resultado)
+
+    except Exception as e:
+        print(f"Erro ao listar histórico de inventário: {e}")
+        traceback.print_exc()
+        return jsonify({'error': 'Ocorreu um erro interno ao buscar o histórico de ajustes.'}), 500
 
 
 
@@ -1643,52 +4177,44 @@ def pagina_inventario():
     return render_template('inventario.html')
 
 
+def relatorio_historico_inventario(parametros):
+    """
+    Histórico de ajustes de inventário com os filtros da listagem, lido em blocos por
+    cursor; None se nenhum ajuste corresponder aos filtros.
+    """
+    filtros = ler_filtros_historico(parametros)
+    if consultar_historico_inventario(filtros).first() is None:
+        return None
+
+    def linhas_historico():
+        for linha in iterar_historico_inventario(filtros):
+            yield (linha.data_ajuste.strftime('%Y-%m-%d %H:%M:%S'), linha.usuario, linha.sku, linha.descricao,
+                   linha.posicao, linha.quantidade_anterior, linha.quantidade_nova, linha.diferenca)
+
+    colunas = [('Data do Ajuste', str), ('Usuário', str), ('SKU', str), ('Descrição do Insumo', str),
+               ('Posição', str), ('Quantidade Anterior', float), ('Quantidade Nova', float), ('Diferença', float)]
+    return 'historico_ajustes', 'Historico_Ajustes', colunas, linhas_historico()
+
+
 @app.route('/api/inventario/historico/exportar', methods=['GET'])
 def exportar_historico_inventario():
     """
-    Gera um relatório Excel com o histórico de ajustes de inventário.
-    VERSÃO CORRIGIDA: Simplificada a lógica de criação do Excel para evitar erros.
+    Gera um relatório (xlsx por omissão; ?format=csv ou parquet) com o histórico
+    de ajustes de inventário, aceitando os mesmos filtros da listagem.
     """
-    try:
-        # 1. Busca todos os registos de ajuste no banco de dados
-        historico_query = db.session.query(AjusteInventario, Estoque, Insumo) \
-            .join(Estoque, AjusteInventario.estoque_id == Estoque.id) \
-            .join(Insumo, Estoque.insumo_id == Insumo.id) \
-            .order_by(AjusteInventario.data_ajuste.desc()).all()
+    formato = request.args.get('format', 'xlsx').lower()
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        return erro
 
-        if not historico_query:
+    try:
+        resposta = responder_relatorio('historico-inventario', formato)
+        if resposta is None:
             return "Nenhum histórico para exportar", 404
+        return resposta
 
-        # 2. Prepara os dados para o DataFrame
-        export_data = []
-        for ajuste, estoque, insumo in historico_query:
-            export_data.append({
-                'Data do Ajuste': ajuste.data_ajuste.strftime('%Y-%m-%d %H:%M:%S'),
-                'Usuário': ajuste.usuario,
-                'SKU': insumo.sku,
-                'Descrição do Insumo': insumo.descricao,
-                'Posição': estoque.posicao,
-                'Quantidade Anterior': ajuste.quantidade_anterior,
-                'Quantidade Nova': ajuste.quantidade_nova,
-                'Diferença': ajuste.diferenca,
-            })
-        
-        # 3. Cria o DataFrame e o ficheiro Excel em memória
-        df = pd.DataFrame(export_data)
-        
-        output = BytesIO()
-        # A criação do Excel agora é mais direta e segura
-        df.to_excel(output, index=False, sheet_name='Historico_Ajustes')
-        output.seek(0)
-        
-        # 4. Envia o ficheiro para o utilizador fazer o download
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'historico_ajustes_{datetime.now().strftime("%Y-%m-%d")}.xlsx'
-        )
-
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Erro ao exportar histórico de inventário: {e}")
         traceback.print_exc()
@@ -1738,119 +4264,231 @@ def logout():
     flash('Você saiu da sua conta.', 'info')
     return redirect(url_for('login'))
 
+def relatorio_fornecedores(parametros):
+    """Todos os dados dos fornecedores; None se não houver nenhum."""
+    if db.session.query(Fornecedor.id).first() is None:
+        return None
+
+    # Pega todas as colunas do modelo dinamicamente
+    colunas = list(Fornecedor.__table__.columns)
+
+    def linhas_fornecedores():
+        for fornecedor in db.session.query(*colunas).order_by(Fornecedor.razao_social).yield_per(1000):
+            yield tuple(fornecedor)
+
+    return 'relatorio_fornecedores', 'Fornecedores', [(c.name, c.type.python_type) for c in colunas], linhas_fornecedores()
+
+
 @app.route('/api/fornecedores/exportar', methods=['GET'])
 def exportar_fornecedores():
     """
-    Gera um relatório Excel completo com todos os dados dos fornecedores.
+    Gera um relatório completo com todos os dados dos fornecedores (xlsx por
+    omissão; ?format=csv ou parquet).
     """
+    formato = request.args.get('format', 'xlsx').lower()
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        return erro
+
     try:
-        fornecedores = Fornecedor.query.order_by(Fornecedor.razao_social).all()
-        if not fornecedores:
+        resposta = responder_relatorio('fornecedores', formato)
+        if resposta is None:
             return "Nenhum fornecedor para exportar", 404
-
-        # Pega todos os nomes das colunas do modelo dinamicamente
-        colunas = [c.name for c in Fornecedor.__table__.columns]
-        dados_export = []
-        for fornecedor in fornecedores:
-            dados_fornecedor = {col: getattr(fornecedor, col) for col in colunas}
-            dados_export.append(dados_fornecedor)
-
-        df = pd.DataFrame(dados_export)
-        
-        output = BytesIO()
-        df.to_excel(output, index=False, sheet_name='Fornecedores')
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'relatorio_fornecedores_{datetime.now().strftime("%Y-%m-%d")}.xlsx'
-        )
+        return resposta
     except Exception as e:
         print(f"Erro ao exportar fornecedores: {e}")
         return "Erro ao gerar o ficheiro.", 500
 
+def relatorio_ordens_de_compra(parametros):
+    """
+    Ordens de compra (com os mesmos filtros da listagem), uma linha por item; None
+    se não houver ordens. Uma única consulta junta ordens, fornecedor, itens e
+    insumos, ordenada por ordem, e é percorrida uma vez em blocos: as colunas da
+    ordem só são preenchidas na primeira linha de cada uma.
+    """
+    filtros = ler_filtros_ordens(parametros)
+    ordens = consultar_ordens_de_compra(datetime.utcnow().date())
+    if filtrar_ordens_de_compra(db.session.query(ordens.c.id), ordens, filtros).first() is None:
+        return None
+
+    def linhas_ordens():
+        query = filtrar_ordens_de_compra(db.session.query(
+            ordens,
+            ItemDaOrdem.id.label('item_id'),
+            Insumo.sku.label('item_sku'),
+            Insumo.descricao.label('item_descricao'),
+            ItemDaOrdem.quantidade.label('item_quantidade'),
+            ItemDaOrdem.preco_unitario.label('item_preco_unitario')
+        ).outerjoin(ItemDaOrdem, ItemDaOrdem.ordem_de_compra_id == ordens.c.id)
+         .outerjoin(Insumo, ItemDaOrdem.insumo_id == Insumo.id), ordens, filtros) \
+            .order_by(ordens.c.data_compra.desc(), ordens.c.id, ItemDaOrdem.id).yield_per(1000)
+
+        ordem_anterior = None
+        for linha in query:
+            if linha.id != ordem_anterior:
+                ordem_anterior = linha.id
+                dados_ordem = (
+                    linha.numero_ordem,
+                    rotulo_status_ordem(linha.status_key, linha.atraso_dias),
+                    linha.fornecedor_nome,
+                    linha.data_compra.strftime('%d/%m/%Y'),
+                    linha.data_entrega_prevista.strftime('%d/%m/%Y') if linha.data_entrega_prevista else '',
+                    linha.data_chegada_real.strftime('%d/%m/%Y') if linha.data_chegada_real else '',
+                    linha.valor_total,
+                    linha.subtotal,
+                    linha.frete,
+                    linha.impostos_percentual,
+                    linha.solicitado_por,
+                    linha.observacoes
+                )
+            else:
+                # Linhas seguintes da mesma ordem ficam em branco nas colunas da ordem
+                dados_ordem = ('',) * len(dados_ordem)
+
+            if linha.item_id is None:
+                yield dados_ordem + ('', '', '', '')
+            else:
+                yield dados_ordem + (linha.item_sku, linha.item_descricao, linha.item_quantidade, linha.item_preco_unitario)
+
+    colunas = [
+        ('Numero Ordem', str), ('Status', str), ('Fornecedor', str), ('Data Compra', str),
+        ('Data Entrega Prevista', str), ('Data Chegada Real', str), ('Valor Total', float), ('Subtotal', float),
+        ('Frete', float), ('Impostos (%)', float), ('Solicitado Por', str), ('Observacoes', str),
+        ('Item SKU', str), ('Item Descricao', str), ('Item Quantidade', float), ('Item Preco Unitario', float)
+    ]
+    return 'relatorio_ordens_compra', 'Ordens_de_Compra', colunas, linhas_ordens()
+
+
 @app.route('/api/ordens-de-compra/exportar', methods=['GET'])
 def exportar_ordens_de_compra():
     """
-    Gera um relatório Excel completo com todas as ordens de compra e seus itens.
+    Gera um relatório com as ordens de compra e seus itens (xlsx por omissão;
+    ?format=csv ou parquet), aceitando os mesmos filtros da listagem.
     """
+    formato = request.args.get('format', 'xlsx').lower()
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        return erro
+
     try:
-        ordens = OrdemDeCompra.query.order_by(OrdemDeCompra.data_compra.desc()).all()
-        if not ordens:
+        resposta = responder_relatorio('ordens-de-compra', formato)
+        if resposta is None:
             return "Nenhuma ordem de compra para exportar", 404
-
-        dados_export = []
-        hoje = datetime.utcnow().date()
-
-        for ordem in ordens:
-            # Lógica de status (a mesma da sua tabela)
-            status = 'Pendente'
-            if ordem.data_chegada_real:
-                status = 'Recebido no prazo'
-                if ordem.data_entrega_prevista and ordem.data_chegada_real > ordem.data_entrega_prevista:
-                    status = f'Recebido com {(ordem.data_chegada_real - ordem.data_entrega_prevista).days} dia(s) de atraso'
-            elif ordem.data_entrega_prevista and hoje > ordem.data_entrega_prevista:
-                status = f'Atrasado ({(hoje - ordem.data_entrega_prevista).days} dia(s))'
-
-            # Dados da Ordem Principal
-            ordem_info = {
-                'Numero Ordem': ordem.numero_ordem,
-                'Status': status,
-                'Fornecedor': ordem.fornecedor.razao_social,
-                'Data Compra': ordem.data_compra.strftime('%d/%m/%Y'),
-                'Data Entrega Prevista': ordem.data_entrega_prevista.strftime('%d/%m/%Y') if ordem.data_entrega_prevista else '',
-                'Data Chegada Real': ordem.data_chegada_real.strftime('%d/%m/%Y') if ordem.data_chegada_real else '',
-                'Valor Total': ordem.valor_total,
-                'Subtotal': ordem.subtotal,
-                'Frete': ordem.frete,
-                'Impostos (%)': ordem.impostos_percentual,
-                'Solicitado Por': ordem.solicitado_por,
-                'Observacoes': ordem.observacoes,
-                # Itens da ordem serão adicionados abaixo
-                'Item SKU': '',
-                'Item Descricao': '',
-                'Item Quantidade': '',
-                'Item Preco Unitario': ''
-            }
-            
-            if not ordem.itens:
-                dados_export.append(ordem_info)
-            else:
-                # Adiciona uma linha para cada item da ordem
-                for i, item in enumerate(ordem.itens):
-                    if i == 0:
-                        # Primeira linha do item usa a info da ordem
-                        item_info = ordem_info.copy()
-                    else:
-                        # Linhas seguintes ficam em branco nas colunas da ordem
-                        item_info = {key: '' for key in ordem_info}
-
-                    item_info['Item SKU'] = item.insumo.sku
-                    item_info['Item Descricao'] = item.insumo.descricao
-                    item_info['Item Quantidade'] = item.quantidade
-                    item_info['Item Preco Unitario'] = item.preco_unitario
-                    dados_export.append(item_info)
-
-        df = pd.DataFrame(dados_export)
-        
-        output = BytesIO()
-        df.to_excel(output, index=False, sheet_name='Ordens_de_Compra')
-        output.seek(0)
-
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'relatorio_ordens_compra_{datetime.now().strftime("%Y-%m-%d")}.xlsx'
-        )
+        return resposta
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Erro ao exportar ordens de compra: {e}")
         traceback.print_exc()
         return "Erro ao gerar o ficheiro.", 500
 
 
+# --- RELATÓRIOS EM SEGUNDO PLANO: ROTAS ---
+# tipo -> (função que monta o relatório, mensagem quando não há dados, filtros aceites,
+#          função que valida os filtros ou None)
+RELATORIOS = {
+    'estoque': (relatorio_estoque, 'Nenhum item no estoque para exportar.', (), None),
+    'historico-inventario': (relatorio_historico_inventario, 'Nenhum histórico para exportar.',
+                             ('data_inicio', 'data_fim', 'sku', 'posicao', 'usuario'), ler_filtros_historico),
+    'fornecedores': (relatorio_fornecedores, 'Nenhum fornecedor para exportar.', (), None),
+    'ordens-de-compra': (relatorio_ordens_de_compra, 'Nenhuma ordem de compra para exportar.',
+                         ('fornecedor_id', 'status', 'data_inicio', 'data_fim'), ler_filtros_ordens),
+}
+
+
+def _estado_tarefa_relatorio(tarefa_id):
+    tabela = TarefaRelatorio.__table__
+    with db.engine.connect() as conexao:
+        tarefa = conexao.execute(
+            select(tabela.c.tipo, tabela.c.formato, tabela.c.status, tabela.c.nome_download, tabela.c.erro, tabela.c.criado_em)
+            .where(tabela.c.id == tarefa_id)
+        ).first()
+    if not tarefa:
+        return None
+
+    estado = {
+        'tarefa_id': tarefa_id,
+        'tipo': tarefa.tipo,
+        'formato': tarefa.formato,
+        'status': tarefa.status,
+        'criado_em': tarefa.criado_em.isoformat(),
+        'url_status': url_for('consultar_tarefa_relatorio', tarefa_id=tarefa_id)
+    }
+    if tarefa.status == 'CONCLUIDA':
+        estado['nome_arquivo'] = tarefa.nome_download
+        estado['url_download'] = url_for('baixar_relatorio', tarefa_id=tarefa_id)
+    elif tarefa.status in ('VAZIO', 'ERRO'):
+        estado['error'] = tarefa.erro
+    return estado
+
+
+@app.route('/api/relatorios/<tipo>', methods=['POST'])
+def pedir_relatorio(tipo):
+    """
+    Pede um relatório (estoque, historico-inventario, fornecedores ou
+    ordens-de-compra; ?format= como nas rotas de exportação) gerado em segundo
+    plano. Se o ficheiro já existir para os dados atuais responde 200 com o
+    url_download; senão 202, e o estado é consultado em url_status. Só os filtros
+    são validados aqui: se não houver dados, a tarefa termina com o status VAZIO
+    (404 logo no pedido se os dados não mudaram desde então).
+    """
+    if tipo not in RELATORIOS:
+        return jsonify({'error': 'Relatório desconhecido.'}), 404
+    formato = request.args.get('format', 'xlsx').lower()
+    erro = validar_formato_exportacao(formato)
+    if erro:
+        return erro
+
+    try:
+        parametros = parametros_exportacao(tipo, formato)
+        ler_filtros = RELATORIOS[tipo][3]
+        if ler_filtros:
+            ler_filtros(parametros)
+        tarefa_id = enfileirar_relatorio(tipo, parametros, session.get('username', 'Sistema'))
+    except ValueError as e: # filtros inválidos
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Erro ao pedir relatório {tipo}: {e}")
+        traceback.print_exc()
+        return jsonify({'error': 'Ocorreu um erro interno ao pedir o relatório.'}), 500
+
+    estado = _estado_tarefa_relatorio(tarefa_id)
+    if estado['status'] == 'CONCLUIDA':
+        return jsonify(estado)
+    if estado['status'] == 'VAZIO':
+        return jsonify(estado), 404
+    garantir_despachante_relatorios()
+    _despachante_relatorios['evento'].set()
+    return jsonify(estado), 202
+
+
+@app.route('/api/relatorios/tarefas/<tarefa_id>', methods=['GET'])
+def consultar_tarefa_relatorio(tarefa_id):
+    """Estado de um relatório pedido; quando CONCLUIDA inclui o url_download, quando VAZIO ou ERRO o error."""
+    estado = _estado_tarefa_relatorio(tarefa_id)
+    if estado is None:
+        return jsonify({'error': 'Tarefa de relatório não encontrada.'}), 404
+    return jsonify(estado)
+
+
+@app.route('/api/relatorios/tarefas/<tarefa_id>/arquivo', methods=['GET'])
+def baixar_relatorio(tarefa_id):
+    """Descarrega o ficheiro de um relatório concluído (410 se já tiver sido apagado)."""
+    tabela = TarefaRelatorio.__table__
+    with db.engine.connect() as conexao:
+        tarefa = conexao.execute(
+            select(tabela.c.chave, tabela.c.formato, tabela.c.nome_download)
+            .where(tabela.c.id == tarefa_id, tabela.c.status == 'CONCLUIDA')
+        ).first()
+    if not tarefa:
+        return jsonify({'error': 'Relatório não encontrado ou ainda não concluído.'}), 404
+    try:
+        arquivo = open(_caminho_relatorio(tarefa.chave, tarefa.formato), 'rb')
+    except OSError:
+        return jsonify({'error': 'O relatório já foi apagado; peça-o novamente.'}), 410
+    return enviar_relatorio(arquivo, tarefa.formato, tarefa.nome_download)
+
+
 # --- EXECUÇÃO ---
 if __name__ == '__main__':
     app.run(debug=True)
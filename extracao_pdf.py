@@ -0,0 +1,31 @@
+"""
+Extração das páginas dos PDFs das notas fiscais, executada nos processos do pool de
+app.py. Fica num módulo próprio, só com pdfplumber, para que os processos criados
+pelo forkserver (ou por spawn) não importem a aplicação Flask.
+"""
+import time
+
+import pdfplumber
+
+
+def gerar_paginas_pdf(origem, inicio, fim, paginas_texto):
+    """
+    Abre o PDF uma só vez e gera, para cada página de [inicio, fim), (texto, tabelas,
+    ms_texto, ms_tabelas). O texto só é extraído nas páginas de índice inferior a
+    'paginas_texto'. Parar de consumir o gerador fecha o PDF.
+    """
+    with pdfplumber.open(origem) as pdf:
+        for indice in range(inicio, min(fim, len(pdf.pages))):
+            page = pdf.pages[indice]
+            t0 = time.perf_counter()
+            texto = (page.extract_text(x_tolerance=2) or '') if indice < paginas_texto else ''
+            t1 = time.perf_counter()
+            tabelas = page.extract_tables() or []
+            t2 = time.perf_counter()
+            page.close() # liberta os objetos de layout já processados
+            yield texto, tabelas, (t1 - t0) * 1000, (t2 - t1) * 1000
+
+
+def extrair_paginas_pdf(origem, inicio, fim, paginas_texto):
+    """Corre num processo do pool: lista das páginas de [inicio, fim) (ver gerar_paginas_pdf)."""
+    return list(gerar_paginas_pdf(origem, inicio, fim, paginas_texto))
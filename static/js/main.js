@@ -94,6 +94,34 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    // Relatórios: gerados em segundo plano no servidor (ou já guardados, se os
+    // dados não mudaram) e descarregados quando ficam prontos
+    async function exportarRelatorio(tipo, botao, parametros = {}) {
+        const textoOriginal = botao.innerHTML;
+        botao.textContent = 'A gerar...';
+        botao.disabled = true;
+        try {
+            const response = await fetch(`/api/relatorios/${tipo}?${new URLSearchParams(parametros).toString()}`, { method: 'POST' });
+            let result = await response.json();
+            if (result.status === 'VAZIO') { alert(result.error); return; }
+            if (!response.ok) throw new Error(result.error);
+            while (result.status === 'PENDENTE' || result.status === 'PROCESSANDO') {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                const statusResponse = await fetch(result.url_status);
+                result = await statusResponse.json();
+                if (!statusResponse.ok) throw new Error(result.error);
+            }
+            if (result.status === 'VAZIO') { alert(result.error); return; }
+            if (result.status === 'ERRO') throw new Error(result.error);
+            window.location.href = result.url_download;
+        } catch (error) {
+            alert(`Erro ao exportar o relatório: ${error.message}`);
+        } finally {
+            botao.innerHTML = textoOriginal;
+            botao.disabled = false;
+        }
+    }
+
     // --- 2. SEÇÃO DO DASHBOARD (CORRIGIDA E UNIFICADA) ---
 
 function initDashboardPage() {
@@ -343,7 +371,7 @@ function initDashboardPage() {
         filtroPosicao.value = '';
         loadEstoque();
     });
-    btnExportar.addEventListener('click', () => { window.location.href = '/api/estoque/exportar'; });
+    btnExportar.addEventListener('click', () => exportarRelatorio('estoque', btnExportar));
 
     // Evento na tabela para capturar cliques nos botões "Detalhes"
     tableBody.addEventListener('click', (e) => {
@@ -505,7 +533,7 @@ function initDashboardPage() {
         btnNovo.onclick = () => showPage('fornecedor-form-page');
         if (btnExportar) {
             btnExportar.addEventListener('click', () => {
-                window.location.href = '/api/fornecedores/exportar';
+                exportarRelatorio('fornecedores', btnExportar);
             });
         }
 
@@ -661,11 +689,16 @@ function initDashboardPage() {
         if (itensRecebidos.length === 0) { tabelaItensBody.innerHTML = '<tr><td colspan="5" class="text-center py-4 text-gray-500">Nenhum item adicionado à conferência.</td></tr>'; }
         
         itensRecebidos.forEach((item, index) => {
-            const classeDestaque = item.novo ? 'bg-blue-50' : (item.quantidade_documento != item.quantidade_conferida ? 'bg-yellow-50' : '');
+            // Correspondência aproximada por descrição: o utilizador confirma o insumo ou remove a linha
+            const porConfirmar = item.correspondencia === 'aproximada' && !item.confirmado;
+            const classeDestaque = porConfirmar ? 'bg-orange-100' : (item.novo ? 'bg-blue-50' : (item.quantidade_documento != item.quantidade_conferida ? 'bg-yellow-50' : ''));
+            const avisoAproximada = porConfirmar ? `
+                    <p class="text-xs text-orange-700 mt-1">Correspondência aproximada. Na nota: "${item.descricao_documento}"</p>
+                    <button type="button" class="text-xs text-orange-700 font-semibold underline confirmar-item-btn" data-index="${index}">Confirmar insumo</button>` : '';
             const tr = document.createElement('tr');
             tr.className = classeDestaque;
             tr.innerHTML = `
-                <td class="px-4 py-2 text-sm align-middle">${item.descricao}</td>
+                <td class="px-4 py-2 text-sm align-middle">${item.descricao}${avisoAproximada}</td>
                 <td class="align-middle"><input type="number" value="${item.quantidade_documento}" class="w-full border-gray-300 rounded-md item-input" data-index="${index}" data-field="quantidade_documento"></td>
                 <td class="align-middle"><input type="number" value="${item.quantidade_conferida}" class="w-full border-gray-300 rounded-md item-input" data-index="${index}" data-field="quantidade_conferida"></td>
                 <td class="align-middle"><input type="text" value="${item.posicao_destino}" required placeholder="Ex: A-01-01" class="w-full border-gray-300 rounded-md item-input" data-index="${index}" data-field="posicao_destino"></td>
@@ -712,16 +745,39 @@ function initDashboardPage() {
 
     btnExtrairPdf.addEventListener('click', async () => {
         const fileInput = document.getElementById('pdf-upload-input');
-        if (fileInput.files.length === 0) { alert('Selecione um ficheiro PDF primeiro.'); return; }
+        if (fileInput.files.length === 0) { alert('Selecione um ficheiro PDF, XML ou ZIP primeiro.'); return; }
+        // O XML da NF-e (ou um ZIP de XMLs) é lido diretamente, sem passar pela extração do PDF
+        const nomeFicheiro = fileInput.files[0].name.toLowerCase();
+        const ehXml = nomeFicheiro.endsWith('.xml') || nomeFicheiro.endsWith('.zip');
         const formData = new FormData();
-        formData.append('pdf_file', fileInput.files[0]);
+        formData.append(ehXml ? 'xml_file' : 'pdf_file', fileInput.files[0]);
         btnExtrairPdf.textContent = 'A extrair...';
         btnExtrairPdf.disabled = true;
 
         try {
-            const response = await fetch('/api/recebimento/upload-pdf', { method: 'POST', body: formData });
-            const result = await response.json();
+            const response = await fetch(ehXml ? '/api/recebimento/upload-xml' : '/api/recebimento/upload-pdf', { method: 'POST', body: formData });
+            let result = await response.json();
             if (!response.ok) throw new Error(result.error);
+
+            // 202: a extração corre em segundo plano; consulta o estado até terminar
+            if (response.status === 202) {
+                while (result.status === 'PENDENTE' || result.status === 'PROCESSANDO') {
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                    const statusResponse = await fetch(result.url_status);
+                    result = await statusResponse.json();
+                    if (!statusResponse.ok) throw new Error(result.error);
+                }
+                if (result.status === 'ERRO') throw new Error(result.error);
+            }
+
+            // ZIP: o formulário recebe uma nota; as restantes e os erros ficam no aviso
+            if (result.notas) {
+                const resumo = [result.message, ...result.notas.filter(nota => nota.error).map(nota => `${nota.nome_arquivo}: ${nota.error}`)];
+                const importadas = result.notas.filter(nota => !nota.error);
+                if (importadas.length === 0) throw new Error(resumo.join('\n'));
+                if (importadas.length > 1) resumo.push(`Carregada no formulário: ${importadas[0].nome_arquivo}. Envie as outras ${importadas.length - 1} nota(s) separadamente.`);
+                result = { ...importadas[0], message: resumo.join('\n') };
+            }
             
             if (result.fornecedor) { 
                 const option = new Option(result.fornecedor.text, result.fornecedor.id, true, true); 
@@ -732,7 +788,7 @@ function initDashboardPage() {
             renderizarTabelaEAtualizarResumo();
             alert(result.message || "Itens extraídos com sucesso!");
         } catch (error) { 
-            alert(`Erro ao processar o PDF: ${error.message}`); 
+            alert(`Erro ao processar o ${ehXml ? (nomeFicheiro.endsWith('.zip') ? 'ZIP' : 'XML') : 'PDF'}: ${error.message}`); 
         } finally {
             btnExtrairPdf.textContent = 'Extrair Itens';
             btnExtrairPdf.disabled = false;
@@ -754,6 +810,10 @@ function initDashboardPage() {
             itensRecebidos.splice(index, 1); 
             renderizarTabelaEAtualizarResumo(); 
         } 
+        if (e.target.classList.contains('confirmar-item-btn')) {
+            itensRecebidos[e.target.dataset.index].confirmado = true;
+            renderizarTabelaEAtualizarResumo();
+        }
     });
 
     // --- CORREÇÃO PRINCIPAL APLICADA AQUI ---
@@ -772,6 +832,10 @@ function initDashboardPage() {
             alert('Todas as posições de destino devem ser preenchidas.'); 
             return; 
         }
+        if (itensRecebidos.some(item => item.correspondencia === 'aproximada' && !item.confirmado)) {
+            alert('Confirme ou remova os itens com correspondência aproximada (destacados a laranja).');
+            return;
+        }
 
         // Desativa o botão para evitar cliques duplos
         btnFinalizar.disabled = true;
@@ -1072,6 +1136,14 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
     const dataChegadaInput = document.getElementById('data-chegada-input');
     const ordemIdInput = document.getElementById('ordem-id-chegada');
     const btnExportar = document.getElementById('btn-exportar-ordens');
+    const filtroFornecedor = document.getElementById('filtro-ordens-fornecedor');
+    const filtroStatus = document.getElementById('filtro-ordens-status');
+    const filtroDataInicio = document.getElementById('filtro-ordens-data-inicio');
+    const filtroDataFim = document.getElementById('filtro-ordens-data-fim');
+    const btnFiltrar = document.getElementById('btn-filtrar-ordens');
+    const btnLimpar = document.getElementById('btn-limpar-ordens');
+    const paginacao = document.getElementById('lista-compras-paginacao');
+    let paginaAtual = 1;
     const formatarMoeda = (valor) => {
         const numero = valor || 0;
         return numero.toLocaleString('pt-BR', {
@@ -1086,20 +1158,64 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
         if (status.includes('atraso')) return 'bg-yellow-100 text-yellow-800';
         return 'bg-gray-100 text-gray-800';
     }
+    // Filtros aplicados no servidor, tanto na listagem paginada como na exportação
+    function filtrosOrdens() {
+        const filtros = { status: filtroStatus.value };
+        if (filtroFornecedor.value) filtros.fornecedor_id = filtroFornecedor.value;
+        if (filtroDataInicio.value) filtros.data_inicio = filtroDataInicio.value;
+        if (filtroDataFim.value) filtros.data_fim = filtroDataFim.value;
+        return filtros;
+    }
+
+    async function carregarFornecedoresFiltro() {
+        if (filtroFornecedor.options.length > 1) return;
+        try {
+            const response = await fetch('/api/fornecedores');
+            const fornecedores = await response.json();
+            fornecedores.forEach(f => filtroFornecedor.append(new Option(f.razao_social, f.id)));
+        } catch (error) { console.error('Erro:', error); }
+    }
+
+    function renderizarPaginacao(data) {
+        if (data.total_pages <= 1) { paginacao.innerHTML = ''; return; }
+        paginacao.innerHTML = `
+            <span class="text-gray-600 mr-2">Página ${data.page} de ${data.total_pages} (${data.total} ordens)</span>
+            <button class="px-3 py-1 border rounded-md hover:bg-gray-100 disabled:opacity-50 pagina-ordens-btn" data-page="${data.page - 1}" ${data.has_prev ? '' : 'disabled'}>Anterior</button>
+            <button class="px-3 py-1 border rounded-md hover:bg-gray-100 disabled:opacity-50 pagina-ordens-btn" data-page="${data.page + 1}" ${data.has_next ? '' : 'disabled'}>Próxima</button>
+        `;
+    }
+
     if(btnExportar) {
-        btnExportar.addEventListener('click', () => {
-            window.location.href = '/api/ordens-de-compra/exportar';
-        });
+        btnExportar.onclick = () => exportarRelatorio('ordens-de-compra', btnExportar, filtrosOrdens());
     }
-    async function loadOrdens() {
+    btnFiltrar.onclick = () => loadOrdens(1);
+    btnLimpar.onclick = () => {
+        filtroFornecedor.value = '';
+        filtroStatus.value = 'todos';
+        filtroDataInicio.value = '';
+        filtroDataFim.value = '';
+        loadOrdens(1);
+    };
+    paginacao.onclick = (e) => {
+        if (e.target.classList.contains('pagina-ordens-btn') && !e.target.disabled) {
+            loadOrdens(parseInt(e.target.dataset.page, 10));
+        }
+    };
+
+    async function loadOrdens(page = paginaAtual) {
         tableBody.innerHTML = '<tr><td colspan="6" class="text-center py-4">Carregando...</td></tr>';
         try {
-            const response = await fetch('/api/ordens-de-compra');
-            const ordens = await response.json();
+            const params = new URLSearchParams({ ...filtrosOrdens(), page: page });
+            const response = await fetch(`/api/ordens-de-compra?${params.toString()}`);
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.error);
+            const ordens = data.items;
+            paginaAtual = data.page;
+            renderizarPaginacao(data);
             tableBody.innerHTML = '';
             
             if (ordens.length === 0) {
-                tableBody.innerHTML = '<tr><td colspan="6" class="text-center py-4">Nenhuma ordem de compra registrada.</td></tr>';
+                tableBody.innerHTML = '<tr><td colspan="6" class="text-center py-4">Nenhuma ordem de compra encontrada.</td></tr>';
                 return;
             }
 
@@ -1124,7 +1240,7 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
 
         } catch (error) {
             console.error('Erro:', error);
-            tableBody.innerHTML = '<tr><td colspan="6" class="text-center py-4 text-red-500">Erro ao carregar ordens.</td></tr>';
+            tableBody.innerHTML = `<tr><td colspan="6" class="text-center py-4 text-red-500">Erro ao carregar ordens: ${error.message}</td></tr>`;
         }
     }
     
@@ -1174,7 +1290,8 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
         }
     });
 
-    loadOrdens();
+    carregarFornecedoresFiltro();
+    loadOrdens(1);
 }
 
     // --- 11. PÁGINA DE INVENTÁRIO ---
@@ -1188,8 +1305,17 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
     const containerResultado = document.getElementById('container-resultado');
     const containerHistorico = document.getElementById('container-historico');
     const btnExportar = document.getElementById('btn-exportar-historico');
+    const filtroDataInicio = document.getElementById('filtro-historico-data-inicio');
+    const filtroDataFim = document.getElementById('filtro-historico-data-fim');
+    const filtroSKU = document.getElementById('filtro-historico-sku');
+    const filtroPosicao = document.getElementById('filtro-historico-posicao');
+    const filtroUsuario = document.getElementById('filtro-historico-usuario');
+    const btnFiltrar = document.getElementById('btn-filtrar-historico');
+    const btnLimparFiltros = document.getElementById('btn-limpar-historico');
+    const btnMais = document.getElementById('btn-mais-historico');
     
     let itemEncontrado = null;
+    let proximoCursor = null;
     
     async function buscarItem(e) {
         if (e) e.preventDefault();
@@ -1267,13 +1393,49 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
         }
     }
 
-    async function carregarHistorico() {
+    function filtrosHistorico() {
+        const filtros = {};
+        if (filtroDataInicio.value) filtros.data_inicio = filtroDataInicio.value;
+        if (filtroDataFim.value) filtros.data_fim = filtroDataFim.value;
+        if (filtroSKU.value.trim()) filtros.sku = filtroSKU.value.trim();
+        if (filtroPosicao.value.trim()) filtros.posicao = filtroPosicao.value.trim();
+        if (filtroUsuario.value.trim()) filtros.usuario = filtroUsuario.value.trim();
+        return filtros;
+    }
+
+    function linhaHistorico(h) {
+        return `
+            <tr>
+                <td class="px-4 py-2">${h.data}</td>
+                <td class="px-4 py-2 font-semibold">${h.sku}</td>
+                <td class="px-4 py-2">${h.posicao}</td>
+                <td class="px-4 py-2">${h.qtd_anterior}</td>
+                <td class="px-4 py-2">${h.qtd_nova}</td>
+                <td class="px-4 py-2 font-bold ${h.diferenca > 0 ? 'text-green-600' : 'text-red-600'}">${h.diferenca > 0 ? '+' : ''}${h.diferenca}</td>
+                <td class="px-4 py-2">${h.usuario}</td>
+            </tr>`;
+    }
+
+    // Sem 'continuar' recomeça do ajuste mais recente; com ele acrescenta a página seguinte (proximoCursor)
+    async function carregarHistorico(continuar = false) {
         try {
-            const response = await fetch('/api/inventario/historico');
+            const params = new URLSearchParams(filtrosHistorico());
+            if (continuar && proximoCursor) params.set('cursor', proximoCursor);
+            const response = await fetch(`/api/inventario/historico?${params.toString()}`);
             const data = await response.json();
             if (!response.ok) throw new Error(data.error);
-            if (data.length === 0) {
-                containerHistorico.innerHTML = '<p class="text-center text-gray-500 py-4">Nenhum ajuste realizado ainda.</p>';
+            proximoCursor = data.proximo_cursor;
+            btnMais.classList.toggle('hidden', !data.has_next);
+            if (continuar) {
+                const tbody = containerHistorico.querySelector('tbody');
+                if (tbody) {
+                    tbody.insertAdjacentHTML('beforeend', data.items.map(linhaHistorico).join(''));
+                    return;
+                }
+            }
+            if (data.items.length === 0) {
+                const mensagem = Object.keys(filtrosHistorico()).length ? 'Nenhum ajuste encontrado para os filtros.' : 'Nenhum ajuste realizado ainda.';
+                containerHistorico.innerHTML = `<p class="text-center text-gray-500 py-4">${mensagem}</p>`;
                 return;
             }
             const table = `
@@ -1290,21 +1452,12 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
                         </tr>
                     </thead>
                     <tbody class="bg-white divide-y divide-gray-200 text-sm">
-                        ${data.map(h => `
-                            <tr>
-                                <td class="px-4 py-2">${h.data}</td>
-                                <td class="px-4 py-2 font-semibold">${h.sku}</td>
-                                <td class="px-4 py-2">${h.posicao}</td>
-                                <td class="px-4 py-2">${h.qtd_anterior}</td>
-                                <td class="px-4 py-2">${h.qtd_nova}</td>
-                                <td class="px-4 py-2 font-bold ${h.diferenca > 0 ? 'text-green-600' : 'text-red-600'}">${h.diferenca > 0 ? '+' : ''}${h.diferenca}</td>
-                                <td class="px-4 py-2">${h.usuario}</td>
-                            </tr>
-                        `).join('')}
+                        ${data.items.map(linhaHistorico).join('')}
                     </tbody>
                 </table>`;
             containerHistorico.innerHTML = table;
         } catch (error) {
+            btnMais.classList.add('hidden');
             containerHistorico.innerHTML = `<p class="text-center text-red-500 py-4">Erro ao carregar histórico: ${error.message}</p>`;
         }
     }
@@ -1316,8 +1469,14 @@ function initRegistroCompraPage(context = { id: null, mode: 'create' }) {
     });
 
     btnExportar.addEventListener('click', () => {
-        window.location.href = '/api/inventario/historico/exportar';
+        exportarRelatorio('historico-inventario', btnExportar, filtrosHistorico());
     });
+    btnFiltrar.onclick = () => carregarHistorico();
+    btnLimparFiltros.onclick = () => {
+        [filtroDataInicio, filtroDataFim, filtroSKU, filtroPosicao, filtroUsuario].forEach(campo => { campo.value = ''; });
+        carregarHistorico();
+    };
+    btnMais.onclick = () => carregarHistorico(true);
 
     carregarHistorico();
 }
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py cria as tabelas ao ser importado: os testes usam uma base de dados temporária
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'insumos_teste.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def banco():
+    """
+    Contexto da aplicação com a base vazia: só os setores iniciais e o contador de SKUs.
+    Os contadores de versão avançam (em vez de voltar a zero) para invalidar as caches.
+    """
+    from sqlalchemy import text, update
+
+    from app import INDICES_BUSCA, SETORES_INICIAIS, Setor, VersaoDados, app, db, sincronizar_sequencia_sku
+
+    app.config['PDF_TAREFAS_ASSINCRONAS'] = False
+    with app.app_context():
+        for tabela in reversed(db.metadata.sorted_tables):
+            if tabela.name != VersaoDados.__table__.name:
+                db.session.execute(tabela.delete())
+        if app.config['BUSCA_FTS_DISPONIVEL']:
+            for tabela in INDICES_BUSCA:
+                db.session.execute(text(f'DELETE FROM {tabela}'))
+        db.session.execute(update(VersaoDados).values(valor=VersaoDados.valor + 1))
+        db.session.add_all(Setor(nome=nome) for nome in SETORES_INICIAIS)
+        sincronizar_sequencia_sku()
+        db.session.commit()
+        yield db
+        db.session.rollback()
+        db.session.remove()
+
+
+@pytest.fixture
+def cliente(banco):
+    from app import app
+    return app.test_client()
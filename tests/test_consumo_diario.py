@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, inspect, select, text
+
+from app import (ConsumoDiario, Insumo, Movimentacao, Setor, app, consolidar_consumo_diario, fonte_consumo,
+                 registrar_consumo_diario, remover_colunas_de_valor, verificar_consumo_diario)
+
+# (data_hora, quantidade): o primeiro dia tem SAIDAs antes e depois do início da janela
+SAIDAS = [
+    (datetime(2026, 3, 1, 8, 0), 1),
+    (datetime(2026, 3, 1, 15, 30), 2),
+    (datetime(2026, 3, 2, 10, 0), 4),
+    (datetime(2026, 3, 2, 23, 59), 8),
+    (datetime(2026, 3, 3, 0, 0), 16),
+]
+
+
+@pytest.fixture
+def saidas(banco):
+    """Regista as SAIDAs como as rotas: movimentação e upsert incremental na consolidação."""
+    insumo = Insumo(sku='30000001', descricao='Luva Nitrilica', valor_unitario=2.0)
+    banco.session.add(insumo)
+    banco.session.flush()
+    setor = Setor.query.filter_by(nome='Picking').one()
+    for data_hora, quantidade in SAIDAS:
+        mov = Movimentacao(insumo_id=insumo.id, setor_id=setor.id, quantidade=quantidade, tipo='SAIDA',
+                           posicao_origem='A-01', posicao_destino='SETOR-PICKING', data_hora=data_hora)
+        banco.session.add(mov)
+        registrar_consumo_diario(mov, insumo)
+    # Outros tipos de movimentação não contam como consumo
+    banco.session.add(Movimentacao(insumo_id=insumo.id, quantidade=50, tipo='TRANSFERENCIA', posicao_origem='A-01',
+                                   posicao_destino='B-02', data_hora=datetime(2026, 3, 2, 12, 0)))
+    banco.session.commit()
+    return insumo
+
+
+def linhas_consolidadas(banco):
+    return sorted(banco.session.query(ConsumoDiario.dia, ConsumoDiario.insumo_id, ConsumoDiario.setor_id,
+                                      ConsumoDiario.quantidade).all())
+
+
+def total_fonte(banco, data_limite):
+    fonte = fonte_consumo(data_limite)
+    return banco.session.execute(select(func.sum(fonte.c.quantidade))).scalar()
+
+
+def total_bruto(banco, data_limite):
+    query = banco.session.query(func.sum(Movimentacao.quantidade)).filter(Movimentacao.tipo == 'SAIDA')
+    if data_limite is not None:
+        query = query.filter(Movimentacao.data_hora >= data_limite)
+    return query.scalar()
+
+
+def test_consolidacao_incremental_igual_a_reconstrucao(banco, saidas):
+    incremental = linhas_consolidadas(banco)
+    assert [(dia.isoformat(), quantidade) for dia, _, _, quantidade in incremental] == [
+        ('2026-03-01', 3), ('2026-03-02', 12), ('2026-03-03', 16)]
+    assert verificar_consumo_diario() == []
+
+    consolidar_consumo_diario()
+    assert linhas_consolidadas(banco) == incremental
+
+
+@pytest.mark.parametrize('data_limite', [
+    None,
+    datetime(2026, 3, 1, 12, 0), # primeiro dia parcial: só a SAIDA das 15:30
+    datetime(2026, 3, 2, 0, 0),
+    datetime(2026, 3, 2, 23, 59),
+    datetime(2026, 3, 3, 0, 0, 1),
+])
+def test_fonte_consumo_igual_as_movimentacoes(banco, saidas, data_limite, monkeypatch):
+    esperado = total_bruto(banco, data_limite)
+    assert total_fonte(banco, data_limite) == esperado
+    monkeypatch.setitem(app.config, 'USAR_CONSUMO_DIARIO', False)
+    assert total_fonte(banco, data_limite) == esperado
+
+
+def test_tabela_antiga_com_coluna_valor_e_recriada(banco, saidas):
+    banco.session.commit()
+    with banco.engine.begin() as conexao:
+        conexao.execute(text('DROP TABLE consumo_diario'))
+        conexao.execute(text(
+            'CREATE TABLE consumo_diario (id INTEGER PRIMARY KEY, dia DATE NOT NULL, insumo_id INTEGER NOT NULL, '
+            'setor_id INTEGER, quantidade FLOAT NOT NULL, valor FLOAT NOT NULL, UNIQUE (dia, insumo_id, setor_id))'))
+        conexao.execute(text("INSERT INTO consumo_diario (dia, insumo_id, setor_id, quantidade, valor) "
+                             "VALUES ('2026-03-01', :insumo, NULL, 999, 999)"), {'insumo': saidas.id})
+
+    assert remover_colunas_de_valor() == ['consumo_diario']
+    assert 'valor' not in {c['name'] for c in inspect(banco.engine).get_columns('consumo_diario')}
+    assert verificar_consumo_diario() == []
+    assert total_fonte(banco, datetime(2026, 3, 1, 12, 0)) == total_bruto(banco, datetime(2026, 3, 1, 12, 0))
+
+    # As escritas incrementais voltam a funcionar sem a coluna NOT NULL
+    mov = Movimentacao(insumo_id=saidas.id, quantidade=1, tipo='SAIDA', data_hora=datetime(2026, 3, 3, 9, 0))
+    banco.session.add(mov)
+    registrar_consumo_diario(mov, saidas)
+    banco.session.commit()
+    assert verificar_consumo_diario() == []
+    assert remover_colunas_de_valor() == []
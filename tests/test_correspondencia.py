@@ -0,0 +1,65 @@
+import pytest
+
+from app import _normalizar_chave, _palavras_descricao, buscar_descricao_aproximada, similaridade_descricoes
+
+
+def palavras(descricao):
+    return _palavras_descricao(_normalizar_chave(descricao))
+
+
+def indice(*descricoes):
+    """Índice em memória no formato de obter_indice_descricoes, com ids 1..n."""
+    por_id, por_palavra = {}, {}
+    for insumo_id, descricao in enumerate(descricoes, start=1):
+        por_id[insumo_id] = palavras(descricao)
+        for palavra in por_id[insumo_id]:
+            por_palavra.setdefault(palavra, []).append(insumo_id)
+    return {'exatas': {}, 'palavras': por_palavra, 'por_id': por_id}
+
+
+@pytest.mark.parametrize('nota, catalogo', [
+    ('COPO DESCART TRANSP 200ML', 'Copo Descartável Transparente 200ml'),
+    ('LUVA NITR DESCART SEM PO AZUL TAM G', 'Luva Nitrílica Descartável sem Pó Azul Tamanho G'),
+    ('PAPEL TOALHA INTERF 2 DOBRAS', 'Papel Toalha Interfolhado de 2 Dobras'),
+])
+def test_abreviacoes_correspondem(nota, catalogo):
+    assert similaridade_descricoes(palavras(nota), palavras(catalogo)) >= 0.5
+
+
+def test_descricoes_iguais_pontuam_um():
+    assert similaridade_descricoes(palavras('Sabonete Liquido 5L'), palavras('SABONETE LÍQUIDO 5L')) == 1.0
+
+
+@pytest.mark.parametrize('nota, catalogo', [
+    # Tamanho
+    ('LUVA NITRILICA DESCARTAVEL SEM PO AZUL TAMANHO G', 'Luva Nitrilica Descartavel sem Po Azul Tamanho M'),
+    ('CAMISETA ALGODAO MANGA CURTA BRANCA TAM P', 'Camiseta Algodao Manga Curta Branca Tam GG'),
+    ('AVENTAL DESCARTAVEL TAM U', 'Avental Descartavel'),
+    # Cor
+    ('LUVA NITRILICA DESCARTAVEL SEM PO AZUL TAMANHO G', 'Luva Nitrilica Descartavel sem Po Preta Tamanho G'),
+    ('SACO DE LIXO PRETO 100L', 'Saco de Lixo Azul 100L'),
+    # Medida e palavra a mais
+    ('COPO DESCARTAVEL 200ML', 'Copo Descartavel 300ml'),
+    ('LUVA CIRURGICA ESTERIL 7', 'Luva Cirurgica 7'),
+])
+def test_variantes_diferentes_nao_correspondem(nota, catalogo):
+    assert similaridade_descricoes(palavras(nota), palavras(catalogo)) == 0.0
+
+
+def test_busca_aproximada_escolhe_o_tamanho_certo():
+    catalogo = indice('Luva Nitrilica Descartavel sem Po Azul Tamanho P',
+                      'Luva Nitrilica Descartavel sem Po Azul Tamanho M',
+                      'Luva Nitrilica Descartavel sem Po Azul Tamanho G')
+    chave = _normalizar_chave('LUVA NITR DESCART SEM PO AZUL TAM M')
+    assert buscar_descricao_aproximada(catalogo, chave) == 2
+
+
+def test_busca_aproximada_prefere_mais_palavras_iguais():
+    catalogo = indice('Detergente Neutro Concentrado 5L', 'Detergente Neutro Conc 5L')
+    assert buscar_descricao_aproximada(catalogo, _normalizar_chave('DETERGENTE NEUTRO CONC 5L')) == 2
+
+
+def test_busca_aproximada_sem_par_devolve_none():
+    catalogo = indice('Luva Nitrilica Descartavel sem Po Azul Tamanho G')
+    assert buscar_descricao_aproximada(catalogo, _normalizar_chave('LUVA NITRILICA DESCARTAVEL SEM PO AZUL TAMANHO GG')) is None
+    assert buscar_descricao_aproximada(catalogo, _normalizar_chave('MASCARA CIRURGICA TRIPLA')) is None
@@ -0,0 +1,45 @@
+import zipfile
+from io import BytesIO
+
+NFE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe"><NFe><infNFe Id="NFe35240100000000000191550010000012341000012345">
+<ide><nNF>1234</nNF></ide><emit><CNPJ>00000000000191</CNPJ></emit>
+<det nItem="1"><prod><cProd>A1</cProd><xProd>LUVA NITRILICA M</xProd><qCom>10.0000</qCom><vUnCom>2.5000</vUnCom></prod></det>
+<total><ICMSTot><vProd>25.00</vProd><vNF>25.00</vNF></ICMSTot></total>
+</infNFe></NFe></nfeProc>"""
+
+BOMBA = b"""<?xml version="1.0"?>
+<!DOCTYPE NFe [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>
+<NFe xmlns="http://www.portalfiscal.inf.br/nfe"><infNFe Id="NFe1"><ide><nNF>&b;</nNF></ide></infNFe></NFe>"""
+
+
+def enviar(cliente, conteudo, nome):
+    return cliente.post('/api/recebimento/upload-xml', data={'xml_file': (BytesIO(conteudo), nome)},
+                        content_type='multipart/form-data')
+
+
+def test_xml_valido_devolve_itens(cliente):
+    resposta = enviar(cliente, NFE, 'nota.xml')
+    assert resposta.status_code == 200
+    corpo = resposta.get_json()
+    assert corpo['numero_documento'] == '1234'
+    assert corpo['totais']['valor_nota'] == 25.0
+    assert [item['quantidade_documento'] for item in corpo['itens']] == [10.0]
+
+
+def test_xml_com_doctype_e_recusado(cliente):
+    resposta = enviar(cliente, BOMBA, 'nota.xml')
+    assert resposta.status_code == 400
+    assert 'XML de NF-e inválido' in resposta.get_json()['error']
+
+
+def test_zip_reporta_cada_ficheiro(cliente):
+    arquivo = BytesIO()
+    with zipfile.ZipFile(arquivo, 'w') as arquivo_zip:
+        arquivo_zip.writestr('boa.xml', NFE)
+        arquivo_zip.writestr('bomba.xml', BOMBA)
+    resposta = enviar(cliente, arquivo.getvalue(), 'notas.zip')
+    assert resposta.status_code == 200
+    notas = {nota['nome_arquivo']: nota for nota in resposta.get_json()['notas']}
+    assert notas['boa.xml']['numero_documento'] == '1234'
+    assert 'XML de NF-e inválido' in notas['bomba.xml']['error']
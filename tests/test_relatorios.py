@@ -0,0 +1,57 @@
+import app as aplicacao
+from app import Estoque, Insumo, app, chave_relatorio, parametros_exportacao, processar_proximo_relatorio
+
+
+def test_chave_ignora_parametros_alheios_ao_relatorio(banco):
+    with app.test_request_context('/?_=123&sku=%20300%20&posicao=&pagina=2'):
+        parametros = parametros_exportacao('historico-inventario', 'csv')
+    assert parametros == {'sku': '300', 'format': 'csv'}
+
+    with app.test_request_context('/?_=456&sku=300'):
+        outra = parametros_exportacao('historico-inventario', 'csv')
+    assert chave_relatorio('historico-inventario', parametros) == chave_relatorio('historico-inventario', outra)
+
+    with app.test_request_context('/?status=aberta&sku=300'):
+        assert parametros_exportacao('estoque', 'xlsx') == {'format': 'xlsx'}
+
+
+def test_csv_com_nome_de_ficheiro_entre_aspas(banco, cliente):
+    insumo = Insumo(sku='30000001', descricao='LUVA', valor_unitario=2.0)
+    banco.session.add(insumo)
+    banco.session.flush()
+    banco.session.add(Estoque(insumo_id=insumo.id, posicao='A-01', quantidade=3))
+    banco.session.commit()
+
+    resposta = cliente.get('/api/estoque/exportar?format=csv&_=1')
+    assert resposta.status_code == 200
+    disposicao = resposta.headers['Content-Disposition']
+    assert disposicao.startswith('attachment; filename="relatorio_estoque_') and disposicao.endswith('.csv"')
+    assert 'LUVA' in resposta.get_data(as_text=True)
+
+
+def test_relatorio_vazio_termina_no_worker(banco, cliente, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'RELATORIOS_DIR', str(tmp_path))
+    monkeypatch.setattr(aplicacao, 'garantir_despachante_relatorios', lambda: None)
+
+    # O pedido não monta o relatório: fica na fila mesmo sem dados
+    resposta = cliente.post('/api/relatorios/estoque?format=csv')
+    assert resposta.status_code == 202
+    estado = resposta.get_json()
+    assert estado['status'] == 'PENDENTE'
+
+    assert processar_proximo_relatorio()
+    estado = cliente.get(estado['url_status']).get_json()
+    assert estado['status'] == 'VAZIO'
+    assert estado['error'] == 'Nenhum item no estoque para exportar.'
+    assert 'url_download' not in estado
+    assert not list(tmp_path.iterdir())
+
+    # Enquanto os dados não mudarem, o mesmo pedido responde logo 404
+    resposta = cliente.post('/api/relatorios/estoque?format=csv')
+    assert resposta.status_code == 404
+    assert resposta.get_json()['tarefa_id'] == estado['tarefa_id']
+
+
+def test_filtros_invalidos_sao_recusados_no_pedido(cliente):
+    resposta = cliente.post('/api/relatorios/ordens-de-compra?status=perdida')
+    assert resposta.status_code == 400
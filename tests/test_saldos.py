@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import func
+
+from app import Estoque, Fornecedor, Insumo, SaldoInsumo, verificar_saldos
+
+
+def saldos_coincidem_com_estoque(banco):
+    """Saldo consolidado de cada insumo igual a SUM(Estoque.quantidade)."""
+    estoque = dict(banco.session.query(Estoque.insumo_id, func.sum(Estoque.quantidade)).group_by(Estoque.insumo_id))
+    saldos = dict(banco.session.query(SaldoInsumo.insumo_id, SaldoInsumo.quantidade_total))
+    return verificar_saldos() == [] and {i: q for i, q in saldos.items() if q} == {i: q for i, q in estoque.items() if q}
+
+
+def valor_do_dashboard(cliente):
+    return cliente.get('/api/dashboard/main').get_json()['kpis']['valor_total']
+
+
+def test_saldo_e_valor_acompanham_recebimento_transferencia_e_preco(banco, cliente):
+    fornecedor = Fornecedor(razao_social='Fornecedor Teste', cnpj='12345678000199')
+    luva = Insumo(sku='30000001', descricao='Luva Nitrilica', valor_unitario=1.0)
+    banco.session.add_all([fornecedor, luva])
+    banco.session.commit()
+
+    resposta = cliente.post('/api/recebimentos', json={
+        'fornecedor_id': fornecedor.id, 'numero_documento': 'NF-1', 'data_recebimento': '2026-01-10',
+        'itens': [{'insumo_id': luva.id, 'quantidade_documento': 10, 'quantidade_conferida': 10,
+                   'valor_unitario': 2.5, 'posicao_destino': 'A-01'}],
+    })
+    assert resposta.status_code == 201
+    assert saldos_coincidem_com_estoque(banco)
+    assert valor_do_dashboard(cliente) == pytest.approx(25.0)
+
+    resposta = cliente.post('/api/transferencias/lote', json={'itens': [
+        {'sku': '30000001', 'posicao_origem': 'A-01', 'qtd': 4, 'destino': 'B-02'},
+        {'sku': '30000001', 'posicao_origem': 'B-02', 'qtd': 3, 'destino': 'SETOR-PICKING'},
+    ]})
+    assert resposta.status_code == 200
+    assert saldos_coincidem_com_estoque(banco)
+    assert banco.session.get(SaldoInsumo, luva.id).quantidade_total == 7
+    assert valor_do_dashboard(cliente) == pytest.approx(17.5)
+
+    # Mudança de preço sem movimento de estoque: o valor acompanha-a
+    banco.session.get(Insumo, luva.id).valor_unitario = 4.0
+    banco.session.commit()
+    assert saldos_coincidem_com_estoque(banco)
+    assert valor_do_dashboard(cliente) == pytest.approx(28.0)
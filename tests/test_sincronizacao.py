@@ -0,0 +1,37 @@
+import pandas as pd
+
+from app import AjusteInventario, Estoque, Insumo, SaldoInsumo, sincronizar_planilhas
+
+
+def planilhas(tmp_path, posicoes):
+    """Grava as duas planilhas do ERP em CSV: um material e as 'posicoes' {posição: quantidade}."""
+    skus, estoque = tmp_path / 'skus.csv', tmp_path / 'estoque.csv'
+    pd.DataFrame([{'SKU': '30000001', 'Material': 'LUVA NITRILICA', 'Valor Unit.': 2.0, 'estoque_minimo': 0}]).to_csv(skus, index=False)
+    pd.DataFrame([{'Material': 'LUVA NITRILICA', 'Posição': posicao, 'Quantidade': quantidade}
+                  for posicao, quantidade in posicoes.items()]).to_csv(estoque, index=False)
+    return str(skus), str(estoque)
+
+
+def test_posicao_com_ajustes_fica_a_zero_e_mantem_o_historico(banco, cliente, tmp_path):
+    sincronizar_planilhas(*planilhas(tmp_path, {'A-01': 10, 'B-02': 5, 'C-03': 3}))
+    banco.session.commit()
+    ajustada = Estoque.query.filter_by(posicao='A-01').one()
+    banco.session.add(AjusteInventario(estoque_id=ajustada.id, quantidade_anterior=10, quantidade_nova=10,
+                                       diferenca=0, usuario='auditor'))
+    banco.session.commit()
+
+    resultado = sincronizar_planilhas(*planilhas(tmp_path, {'C-03': 3}))
+    banco.session.commit()
+
+    assert resultado['posicoes_apagadas'] == 1
+    assert resultado['posicoes_zeradas'] == 1
+    assert {e.posicao: e.quantidade for e in Estoque.query} == {'A-01': 0, 'C-03': 3}
+    insumo = Insumo.query.filter_by(sku='30000001').one()
+    assert banco.session.get(SaldoInsumo, insumo.id).quantidade_total == 3
+
+    historico = cliente.get('/api/inventario/historico').get_json()['items']
+    assert [(h['sku'], h['posicao'], h['usuario']) for h in historico] == [('30000001', 'A-01', 'auditor')]
+
+    # Numa nova sincronização a posição já está a zero: não volta a ser contada
+    resultado = sincronizar_planilhas(*planilhas(tmp_path, {'C-03': 3}))
+    assert resultado['posicoes_zeradas'] == 0 and resultado['posicoes_apagadas'] == 0
@@ -0,0 +1,47 @@
+from app import Insumo, Sequencia, SKU_INICIAL, gerar_novo_sku, gerar_novos_skus, sincronizar_sequencia_sku
+
+
+def contador(banco):
+    return banco.session.get(Sequencia, 'sku').proximo
+
+
+def test_base_vazia_comeca_em_sku_inicial(banco):
+    assert gerar_novos_skus(3) == [str(SKU_INICIAL), str(SKU_INICIAL + 1), str(SKU_INICIAL + 2)]
+    assert contador(banco) == SKU_INICIAL + 3
+
+
+def test_sequencia_avanca_para_la_dos_skus_existentes(banco):
+    banco.session.add_all([Insumo(sku='30000050', descricao='A'), Insumo(sku='ABC-1', descricao='B'),
+                           Insumo(sku='99999999', descricao='C')])
+    banco.session.flush()
+    sincronizar_sequencia_sku()
+    # Só os SKUs numéricos começados por '3' definem o próximo número
+    assert contador(banco) == 30000051
+    assert gerar_novo_sku() == '30000051'
+
+
+def test_skus_ocupados_sao_saltados(banco):
+    # SKUs digitados à mão depois do contador, dentro do bloco que vai ser reservado
+    banco.session.add_all([Insumo(sku=str(SKU_INICIAL + n), descricao=f'Manual {n}') for n in (1, 2, 4)])
+    banco.session.flush()
+
+    novos = gerar_novos_skus(5)
+    ocupados = {sku for (sku,) in banco.session.query(Insumo.sku)}
+    assert len(novos) == len(set(novos)) == 5
+    assert not set(novos) & ocupados
+    assert novos == [str(SKU_INICIAL + n) for n in (0, 3, 5, 6, 7)]
+    # O contador fica logo a seguir ao último SKU entregue
+    assert contador(banco) == SKU_INICIAL + 8
+
+    banco.session.add_all([Insumo(sku=sku, descricao=f'Novo {sku}') for sku in novos])
+    banco.session.flush()
+    seguinte = gerar_novo_sku()
+    assert seguinte == str(SKU_INICIAL + 8) and seguinte not in ocupados | set(novos)
+
+
+def test_sincronizar_nunca_recua(banco):
+    gerar_novos_skus(10)
+    sincronizar_sequencia_sku(['30000002'])
+    assert contador(banco) == SKU_INICIAL + 10
+    sincronizar_sequencia_sku(['30000500', 'X-9'])
+    assert contador(banco) == 30000501
@@ -0,0 +1,98 @@
+import pytest
+
+import app as aplicacao
+from app import AjusteInventario, ConsumoDiario, Estoque, Insumo, Movimentacao, debitar_estoque, recalcular_saldos_insumos
+
+
+@pytest.fixture
+def luva(banco):
+    """Insumo com 10 unidades em A-01 e 4 em B-02."""
+    insumo = Insumo(sku='30000001', descricao='Luva Nitrilica', valor_unitario=2.0)
+    banco.session.add(insumo)
+    banco.session.flush()
+    banco.session.add_all([Estoque(insumo_id=insumo.id, posicao='A-01', quantidade=10),
+                           Estoque(insumo_id=insumo.id, posicao='B-02', quantidade=4)])
+    recalcular_saldos_insumos([insumo.id])
+    banco.session.commit()
+    return insumo
+
+
+def posicoes():
+    return dict(aplicacao.db.session.query(Estoque.posicao, Estoque.quantidade))
+
+
+def test_debito_acima_do_disponivel_e_recusado(banco, luva):
+    assert debitar_estoque(luva.id, 'A-01', 11) is False
+    assert debitar_estoque(luva.id, 'Z-99', 1) is False
+    assert posicoes() == {'A-01': 10, 'B-02': 4}
+
+
+def test_posicao_que_chega_a_zero_e_removida(banco, luva):
+    assert debitar_estoque(luva.id, 'B-02', 4) is True
+    assert debitar_estoque(luva.id, 'A-01', 3) is True
+    assert posicoes() == {'A-01': 7}
+
+
+def test_posicao_com_ajustes_fica_a_zero(banco, luva):
+    estoque = Estoque.query.filter_by(posicao='B-02').one()
+    banco.session.add(AjusteInventario(estoque_id=estoque.id, quantidade_anterior=5, quantidade_nova=4, diferenca=-1))
+    banco.session.flush()
+    assert debitar_estoque(luva.id, 'B-02', 4) is True
+    assert posicoes() == {'A-01': 10, 'B-02': 0}
+
+
+def test_lote_com_uma_linha_invalida_nao_grava_nada(cliente, luva):
+    resposta = cliente.post('/api/transferencias/lote', json={'itens': [
+        {'sku': '30000001', 'posicao_origem': 'A-01', 'qtd': 5, 'destino': 'C-03'},
+        {'sku': '30000001', 'posicao_origem': 'B-02', 'qtd': 9, 'destino': 'SETOR-PICKING'},
+    ]})
+    corpo = resposta.get_json()
+    assert resposta.status_code == 400
+    assert corpo['erros'] == 1 and 'erro' in corpo['resultados'][1] and 'erro' not in corpo['resultados'][0]
+    assert posicoes() == {'A-01': 10, 'B-02': 4}
+    assert Movimentacao.query.count() == 0
+
+
+def test_lote_desfeito_se_o_estoque_muda_durante_a_gravacao(cliente, luva, monkeypatch):
+    original = aplicacao.debitar_estoque
+    chamadas = []
+
+    def debitar_com_concorrencia(insumo_id, posicao, quantidade):
+        # Antes do segundo débito, "outro worker" esvazia a posição de origem
+        chamadas.append(posicao)
+        if len(chamadas) == 2:
+            aplicacao.db.session.execute(aplicacao.update(Estoque).where(Estoque.posicao == posicao).values(quantidade=0))
+        return original(insumo_id, posicao, quantidade)
+
+    monkeypatch.setattr(aplicacao, 'debitar_estoque', debitar_com_concorrencia)
+    resposta = cliente.post('/api/transferencias/lote', json={'itens': [
+        {'sku': '30000001', 'posicao_origem': 'A-01', 'qtd': 5, 'destino': 'C-03'},
+        {'sku': '30000001', 'posicao_origem': 'B-02', 'qtd': 2, 'destino': 'SETOR-PICKING'},
+    ]})
+    assert resposta.status_code == 409
+    assert resposta.get_json()['resultados'][1]['erro']
+    assert posicoes() == {'A-01': 10, 'B-02': 4}
+    assert Movimentacao.query.count() == 0 and ConsumoDiario.query.count() == 0
+
+
+def test_dry_run_valida_sem_gravar(cliente, luva):
+    resposta = cliente.post('/api/transferencias/lote', json={'dry_run': True, 'itens': [
+        {'sku': '30000001', 'posicao_origem': 'A-01', 'qtd': 10, 'destino': 'C-03'},
+        {'sku': '30000001', 'posicao_origem': 'C-03', 'qtd': 2, 'destino': 'SETOR-PICKING'},
+    ]})
+    corpo = resposta.get_json()
+    assert resposta.status_code == 200
+    assert corpo['dry_run'] is True and corpo['erros'] == 0
+    assert [r['tipo'] for r in corpo['resultados']] == ['TRANSFERENCIA', 'SAIDA']
+    assert posicoes() == {'A-01': 10, 'B-02': 4}
+    assert Movimentacao.query.count() == 0 and ConsumoDiario.query.count() == 0
+
+
+def test_lote_valido_grava_tudo(cliente, luva):
+    resposta = cliente.post('/api/transferencias/lote', json={'itens': [
+        {'sku': '30000001', 'posicao_origem': 'A-01', 'qtd': 10, 'destino': 'C-03'},
+        {'sku': '30000001', 'posicao_origem': 'C-03', 'qtd': 2, 'destino': 'SETOR-PICKING'},
+    ]})
+    assert resposta.status_code == 200
+    assert posicoes() == {'B-02': 4, 'C-03': 8}
+    assert Movimentacao.query.count() == 2